@@ -1,4 +1,5 @@
-import copy
+import random
+from collections import OrderedDict
 
 # CLI Chess Game
 # Unicode representations for chess pieces and empty squares
@@ -20,12 +21,170 @@ current_board_state = [
     ['wr', 'wn', 'wb', 'wq', 'wk', 'wb', 'wn', 'wr']
 ]
 
+# Side to move and the last move played, as a dict with piece_code, from_position and to_position
+current_player = 'w'
+last_move = None
+
 # Tracking castling pieces movement
 pieces_moved = {
     'wk': False, 'wr1': False, 'wr2': False,
     'bk': False, 'br1': False, 'br2': False
 }
 
+# Moves since the last capture or pawn move, and the number of the current full move, as in FEN
+halfmove_clock = 0
+fullmove_number = 1
+
+# Moves of the game played by main(), so they can be taken back. Each entry is the move, its
+# undo record from make_move and the player, last move and FEN counters from before it.
+# The entries from history_ply on have been taken back, and can be played again until
+# another move is played.
+move_history = []
+history_ply = 0
+
+# Squares of both kings, kept up to date by move_piece, unmake_move and perform_castling
+king_positions = {'w': (7, 4), 'b': (0, 4)}
+
+# Order in which make_move saves the pieces_moved flags in its undo record
+castling_flags = ('wk', 'wr1', 'wr2', 'bk', 'br1', 'br2')
+
+# Starting squares of the kings and rooks, and the pieces_moved flag for each
+castling_squares = {
+    (7, 4): 'wk', (7, 0): 'wr1', (7, 7): 'wr2',
+    (0, 4): 'bk', (0, 0): 'br1', (0, 7): 'br2'
+}
+
+
+def build_target_table(offsets):
+    '''Returns, for each (row, col), the list of squares reached by jumping the given offsets from it.'''
+    return [[[(row + d_row, col + d_col) for d_row, d_col in offsets if 0 <= row + d_row < 8 and 0 <= col + d_col < 8]
+             for col in range(8)] for row in range(8)]
+
+
+# Precomputed target squares of knights and kings from every square
+knight_targets = build_target_table([(1, 2), (1, -2), (-1, 2), (-1, -2), (2, 1), (2, -1), (-2, 1), (-2, -1)])
+king_targets = build_target_table([(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, -1), (-1, 1)])
+
+# Squares attacked by a pawn of each colour from every square, white pawns move up the board
+pawn_attacks = {
+    'w': build_target_table([(-1, -1), (-1, 1)]),
+    'b': build_target_table([(1, -1), (1, 1)])
+}
+
+
+def build_ray_table(directions):
+    '''Returns, for each (row, col), one list of squares per direction running out to the edge of the board.'''
+    table = [[[] for col in range(8)] for row in range(8)]
+    for row in range(8):
+        for col in range(8):
+            for d_row, d_col in directions:
+                ray = []
+                r, c = row + d_row, col + d_col
+                while 0 <= r < 8 and 0 <= c < 8:
+                    ray.append((r, c))
+                    r, c = r + d_row, c + d_col
+                if ray:
+                    table[row][col].append(ray)
+    return table
+
+
+# Precomputed rays of sliding pieces from every square, nearest square first
+rook_rays = build_ray_table([(1, 0), (-1, 0), (0, 1), (0, -1)])  # down, up, right, left
+bishop_rays = build_ray_table([(1, 1), (1, -1), (-1, -1), (-1, 1)])  # diagonal directions
+queen_rays = [[rook_rays[row][col] + bishop_rays[row][col] for col in range(8)] for row in range(8)]
+
+# Material values of the pieces in centipawns
+piece_values = {'p': 100, 'n': 320, 'b': 330, 'r': 500, 'q': 900, 'k': 0}
+
+# Piece-square tables from white's point of view, row 0 is the 8th rank.
+# Black uses the same tables mirrored top to bottom.
+piece_square_tables = {
+    'p': [[0, 0, 0, 0, 0, 0, 0, 0],
+          [50, 50, 50, 50, 50, 50, 50, 50],
+          [10, 10, 20, 30, 30, 20, 10, 10],
+          [5, 5, 10, 25, 25, 10, 5, 5],
+          [0, 0, 0, 20, 20, 0, 0, 0],
+          [5, -5, -10, 0, 0, -10, -5, 5],
+          [5, 10, 10, -20, -20, 10, 10, 5],
+          [0, 0, 0, 0, 0, 0, 0, 0]],
+    'n': [[-50, -40, -30, -30, -30, -30, -40, -50],
+          [-40, -20, 0, 0, 0, 0, -20, -40],
+          [-30, 0, 10, 15, 15, 10, 0, -30],
+          [-30, 5, 15, 20, 20, 15, 5, -30],
+          [-30, 0, 15, 20, 20, 15, 0, -30],
+          [-30, 5, 10, 15, 15, 10, 5, -30],
+          [-40, -20, 0, 5, 5, 0, -20, -40],
+          [-50, -40, -30, -30, -30, -30, -40, -50]],
+    'b': [[-20, -10, -10, -10, -10, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 10, 10, 5, 0, -10],
+          [-10, 5, 5, 10, 10, 5, 5, -10],
+          [-10, 0, 10, 10, 10, 10, 0, -10],
+          [-10, 10, 10, 10, 10, 10, 10, -10],
+          [-10, 5, 0, 0, 0, 0, 5, -10],
+          [-20, -10, -10, -10, -10, -10, -10, -20]],
+    'r': [[0, 0, 0, 0, 0, 0, 0, 0],
+          [5, 10, 10, 10, 10, 10, 10, 5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [0, 0, 0, 5, 5, 0, 0, 0]],
+    'q': [[-20, -10, -10, -5, -5, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 5, 5, 5, 0, -10],
+          [-5, 0, 5, 5, 5, 5, 0, -5],
+          [0, 0, 5, 5, 5, 5, 0, -5],
+          [-10, 5, 5, 5, 5, 5, 0, -10],
+          [-10, 0, 5, 0, 0, 0, 0, -10],
+          [-20, -10, -10, -5, -5, -10, -10, -20]],
+    'k': [[-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-20, -30, -30, -40, -40, -30, -30, -20],
+          [-10, -20, -20, -20, -20, -20, -20, -10],
+          [20, 20, 0, 0, 0, 0, 20, 20],
+          [20, 30, 10, 0, 0, 10, 30, 20]]
+}
+
+
+def build_piece_square_values():
+    '''Returns the value of each piece plus its piece-square bonus, indexed [piece][row][col].
+
+    Black pieces count negatively, so the sum over the board is the score with
+    white positive.
+    '''
+    values = {}
+    for kind, table in piece_square_tables.items():
+        values['w' + kind] = [[piece_values[kind] + table[row][col] for col in range(8)] for row in range(8)]
+        values['b' + kind] = [[-piece_values[kind] - table[7 - row][col] for col in range(8)] for row in range(8)]
+    return values
+
+
+piece_square_values = build_piece_square_values()
+
+# Number of each piece at the start of a game, for working out the taken pieces
+starting_piece_counts = {
+    'wp': 8, 'wn': 2, 'wb': 2, 'wr': 2, 'wq': 1, 'wk': 1,
+    'bp': 8, 'bn': 2, 'bb': 2, 'br': 2, 'bq': 1, 'bk': 1
+}
+
+# Zobrist keys: a random 64-bit number per piece per square, for black to move,
+# for each combination of castling rights and for each en passant file.
+# A position's key is the XOR of the numbers that apply to it, so a move
+# updates it by XORing in and out only what changed. The fixed seed keeps
+# keys stable between runs.
+zobrist_random = random.Random(20231224)
+zobrist_pieces = {
+    piece: [[zobrist_random.getrandbits(64) for col in range(8)] for row in range(8)]
+    for piece in ['wp', 'wn', 'wb', 'wr', 'wq', 'wk', 'bp', 'bn', 'bb', 'br', 'bq', 'bk']
+}
+zobrist_black_to_move = zobrist_random.getrandbits(64)
+zobrist_castling = [zobrist_random.getrandbits(64) for rights in range(16)]
+zobrist_en_passant = [zobrist_random.getrandbits(64) for col in range(8)]
+
 
 def display_board(board_state):
     # Add two spaces before the column headers
@@ -85,147 +244,215 @@ def get_pawn_moves(start_position, board_state, is_first_move, last_move):
                 moves.append((double_forward_row, col))
 
     # Diagonal captures including en passant
-    for diagonal_col in [col - 1, col + 1]:
-        if 0 <= diagonal_col < 8:
-            diagonal_row = row + direction
-            target_piece = board_state[diagonal_row][diagonal_col]
-
-            if target_piece and target_piece[0] != board_state[row][col][0]:
-                moves.append((diagonal_row, diagonal_col))
-
-            elif not target_piece and last_move:
-                # Adjusted Conditions for En Passant
-                condition_1 = last_move and last_move['piece_code'][1] == 'p' and abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2
-                condition_2 = abs(last_move['to_position'][1] - col) == 1  # Adjacent column
-                condition_3 = (direction == -1 and row == 3) or (direction == 1 and row == 4)
-                condition_4 = abs(diagonal_col - col) == 1  # Diagonal to adjacent column
-                condition_5 = diagonal_col == last_move['to_position'][1]  # Diagonal towards last move's pawn
-
-                if condition_1 and condition_2 and condition_3 and condition_4 and condition_5:
-                    en_passant_capture_row = row  # The row of the captured pawn
-                    en_passant_capture_col = diagonal_col  # The column of the captured pawn
-                    board_state[en_passant_capture_row][en_passant_capture_col] = None  # Remove the captured pawn
-                    moves.append((diagonal_row, diagonal_col))  # Add en passant move
+    color = board_state[row][col][0]
+    for diagonal_row, diagonal_col in pawn_attacks[color][row][col]:
+        target_piece = board_state[diagonal_row][diagonal_col]
+
+        if target_piece and target_piece[0] != color:
+            moves.append((diagonal_row, diagonal_col))
+
+        elif not target_piece and last_move:
+            # Adjusted Conditions for En Passant
+            condition_1 = last_move and last_move['piece_code'][1] == 'p' and abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2
+            condition_2 = abs(last_move['to_position'][1] - col) == 1  # Adjacent column
+            condition_3 = (direction == -1 and row == 3) or (direction == 1 and row == 4)
+            condition_4 = diagonal_col == last_move['to_position'][1]  # Diagonal towards last move's pawn
+
+            if condition_1 and condition_2 and condition_3 and condition_4:
+                # The captured pawn is removed by make_move, not here
+                moves.append((diagonal_row, diagonal_col))  # Add en passant move
     return moves
 
 
 def get_knight_moves(start_position, board_state):
     '''Returns a list of valid moves for a knight given the current board state.'''
     moves = []
-    directions = [(1, 2), (1, -2), (-1, 2), (-1, -2), (2, 1), (2, -1), (-2, 1), (-2, -1)]
     start_piece = board_state[start_position[0]][start_position[1]]
 
-    for direction in directions:
-        row = start_position[0] + direction[0]
-        col = start_position[1] + direction[1]
-
-        if 0 <= row < 8 and 0 <= col < 8:
-            target_piece = board_state[row][col]
-            if target_piece is None or target_piece[0] != start_piece[0]:
-                moves.append((row, col))
+    for target in knight_targets[start_position[0]][start_position[1]]:
+        target_piece = board_state[target[0]][target[1]]
+        if target_piece is None or target_piece[0] != start_piece[0]:
+            moves.append(target)
     return moves
 
 
-def get_bishop_moves(start_position, board_state):
-    '''Returns a list of valid moves for a bishop given the current board state.'''
+def get_sliding_moves(start_position, board_state, rays):
+    '''Returns a list of valid moves along the precomputed rays of a sliding piece.'''
     moves = []
-    directions = [(1, 1), (1, -1), (-1, -1), (-1, 1)]  # diagonal directions
     start_piece = board_state[start_position[0]][start_position[1]]
 
-    for direction in directions:
-        for i in range(1, 8):
-            row = start_position[0] + direction[0] * i
-            col = start_position[1] + direction[1] * i
-
-            if not (0 <= row < 8 and 0 <= col < 8):
-                break
-
-            target_piece = board_state[row][col]
+    for ray in rays[start_position[0]][start_position[1]]:
+        for target in ray:
+            target_piece = board_state[target[0]][target[1]]
             if target_piece is None:
-                moves.append((row, col))
+                moves.append(target)
             else:
-                if target_piece[0] != start_piece[0]:
-                    moves.append((row, col))
+                if target_piece[0] != start_piece[0]:  # Capture if it's an opponent's piece
+                    moves.append(target)
                 break
     return moves
 
 
-def get_rook_moves(start_position, board_state):
-    '''Returns a list of valid moves for a rook given the current board state.'''
-    moves = []
-    directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]  # down, up, right, left
-    start_piece = board_state[start_position[0]][start_position[1]]
-
-    for direction in directions:
-        for i in range(1, 8):
-            row = start_position[0] + direction[0] * i
-            col = start_position[1] + direction[1] * i
+def get_bishop_moves(start_position, board_state):
+    '''Returns a list of valid moves for a bishop given the current board state.'''
+    return get_sliding_moves(start_position, board_state, bishop_rays)
 
-            if not (0 <= row < 8 and 0 <= col < 8):
-                break
 
-            target_piece = board_state[row][col]
-            if target_piece is None:
-                moves.append((row, col))
-            else:
-                if target_piece[0] != start_piece[0]:  # Capture if it's an opponent's piece
-                    moves.append((row, col))
-                break
-    return moves
+def get_rook_moves(start_position, board_state):
+    '''Returns a list of valid moves for a rook given the current board state.'''
+    return get_sliding_moves(start_position, board_state, rook_rays)
 
 
 def get_queen_moves(start_position, board_state):
     '''Returns a list of valid moves for a queen given the current board state.'''
-    # Combine the moves of a rook and a bishop
-    return get_rook_moves(start_position, board_state) + get_bishop_moves(start_position, board_state)
+    # The queen's rays are the rook's and the bishop's together
+    return get_sliding_moves(start_position, board_state, queen_rays)
 
 
 def get_king_moves(start_position, board_state):
     '''Returns a list of valid moves for a king given the current board state.'''
     moves = []
-    directions = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, -1), (-1, 1)]
     start_piece = board_state[start_position[0]][start_position[1]]
 
-    for direction in directions:
-        row = start_position[0] + direction[0]
-        col = start_position[1] + direction[1]
-
-        if 0 <= row < 8 and 0 <= col < 8:
-            target_piece = board_state[row][col]
-            if target_piece is None or target_piece[0] != start_piece[0]:
-                moves.append((row, col))
+    for target in king_targets[start_position[0]][start_position[1]]:
+        target_piece = board_state[target[0]][target[1]]
+        if target_piece is None or target_piece[0] != start_piece[0]:
+            moves.append(target)
     return moves
 
 
 def is_move_valid(start_position, end_position, board_state):
     '''Returns True if the move is valid, False otherwise.'''
     piece = board_state[start_position[0]][start_position[1]]
-    temp_board = copy.deepcopy(board_state)
-    move_piece(temp_board, start_position, end_position)
-    king_position = find_king(temp_board, piece[0])
-    return not is_in_check(king_position, temp_board)
+    undo = make_move(board_state, start_position, end_position)
+    in_check = is_in_check(get_king_position(piece[0]), board_state)
+    unmake_move(board_state, undo)
+    return not in_check
 
 
 def move_piece(board, from_index, to_index):
     '''Moves a piece from the from_index to the to_index on the board.'''
-    global pieces_moved
+    global pieces_moved, zobrist_key, en_passant_file, material_score
     piece = board[from_index[0]][from_index[1]]
     captured_piece = board[to_index[0]][to_index[1]]
 
     board[from_index[0]][from_index[1]] = None
     board[to_index[0]][to_index[1]] = piece
 
-    # Update pieces_moved flag for kings and rooks
-    if piece in ['wk', 'wr', 'bk', 'br']:
-        if piece in ['wk', 'bk']:  # Kings
-            pieces_moved[piece] = True
-        elif piece in ['wr', 'br']:  # Rooks
-            rook_index = '1' if from_index[1] == 0 else '2'
-            pieces_moved[piece + rook_index] = True
-
+    if piece[1] == 'k':
+        king_positions[piece[0]] = to_index
+
+    # Update the material counts and evaluation score
+    values = piece_square_values[piece]
+    material_score += values[to_index[0]][to_index[1]] - values[from_index[0]][from_index[1]]
+    if captured_piece:
+        material_score -= piece_square_values[captured_piece][to_index[0]][to_index[1]]
+        piece_counts[captured_piece] -= 1
+
+    # Update the Zobrist key for the moved and captured pieces and the other side to move
+    key = zobrist_key ^ zobrist_black_to_move
+    key ^= zobrist_pieces[piece][from_index[0]][from_index[1]] ^ zobrist_pieces[piece][to_index[0]][to_index[1]]
+    if captured_piece:
+        key ^= zobrist_pieces[captured_piece][to_index[0]][to_index[1]]
+
+    # Only a pawn that has just moved two squares can be captured en passant
+    if en_passant_file is not None:
+        key ^= zobrist_en_passant[en_passant_file]
+        en_passant_file = None
+    if piece[1] == 'p' and abs(from_index[0] - to_index[0]) == 2:
+        en_passant_file = to_index[1]
+        key ^= zobrist_en_passant[en_passant_file]
+
+    # Update pieces_moved flags when a king or rook leaves its starting square,
+    # or a rook is captured on it
+    if from_index in castling_squares or to_index in castling_squares:
+        key ^= zobrist_castling[castling_rights()]
+        if from_index in castling_squares:
+            pieces_moved[castling_squares[from_index]] = True
+        if to_index in castling_squares:
+            pieces_moved[castling_squares[to_index]] = True
+        key ^= zobrist_castling[castling_rights()]
+
+    zobrist_key = key
     return captured_piece
 
 
+def make_move(board_state, from_position, to_position, promotion=None):
+    '''Makes a move on the board in place and returns an undo record for unmake_move.
+
+    Besides plain moves and captures this handles en passant (a pawn moving
+    diagonally onto an empty square), castling (a king moving two files) and
+    promotion, which is to a queen unless another piece is given.
+    '''
+    global zobrist_key, material_score
+    from_row, from_col = from_position
+    to_row, to_col = to_position
+    piece = board_state[from_row][from_col]
+    flags = (pieces_moved['wk'], pieces_moved['wr1'], pieces_moved['wr2'],
+             pieces_moved['bk'], pieces_moved['br1'], pieces_moved['br2'])
+    saved_state = (zobrist_key, en_passant_file, material_score)
+    captured_position = to_position
+    rook_move = None
+
+    if piece[1] == 'p' and from_col != to_col and board_state[to_row][to_col] is None:
+        # En passant, the captured pawn sits beside the moving pawn
+        captured_position = (from_row, to_col)
+        captured_piece = board_state[from_row][to_col]
+        board_state[from_row][to_col] = None
+        zobrist_key ^= zobrist_pieces[captured_piece][from_row][to_col]
+        material_score -= piece_square_values[captured_piece][from_row][to_col]
+        piece_counts[captured_piece] -= 1
+        move_piece(board_state, from_position, to_position)
+    else:
+        if piece[1] == 'k' and abs(to_col - from_col) == 2:
+            # Castling, bring the rook over to the other side of the king
+            rook_move = ((from_row, 7), (from_row, 5)) if to_col > from_col else ((from_row, 0), (from_row, 3))
+            rook = board_state[from_row][rook_move[0][1]]
+            board_state[from_row][rook_move[1][1]] = rook
+            board_state[from_row][rook_move[0][1]] = None
+            zobrist_key ^= zobrist_pieces[rook][from_row][rook_move[0][1]] ^ zobrist_pieces[rook][from_row][rook_move[1][1]]
+            material_score += piece_square_values[rook][from_row][rook_move[1][1]] - piece_square_values[rook][from_row][rook_move[0][1]]
+        captured_piece = move_piece(board_state, from_position, to_position)
+        if piece[1] == 'p' and to_row in (0, 7):
+            promoted_piece = piece[0] + (promotion or 'q')
+            board_state[to_row][to_col] = promoted_piece
+            zobrist_key ^= zobrist_pieces[piece][to_row][to_col] ^ zobrist_pieces[promoted_piece][to_row][to_col]
+            material_score += piece_square_values[promoted_piece][to_row][to_col] - piece_square_values[piece][to_row][to_col]
+            piece_counts[piece] -= 1
+            piece_counts[promoted_piece] += 1
+
+    return (from_position, to_position, piece, captured_piece, captured_position, rook_move, flags, saved_state)
+
+
+def unmake_move(board_state, undo):
+    '''Takes back a move made with make_move, restoring the board, pieces_moved flags, Zobrist key and material.'''
+    global zobrist_key, en_passant_file, material_score
+    from_position, to_position, piece, captured_piece, captured_position, rook_move, flags, saved_state = undo
+    zobrist_key, en_passant_file, material_score = saved_state
+
+    if captured_piece:
+        piece_counts[captured_piece] += 1
+    promoted_piece = board_state[to_position[0]][to_position[1]]
+    if promoted_piece != piece:
+        piece_counts[promoted_piece] -= 1
+        piece_counts[piece] += 1
+
+    board_state[to_position[0]][to_position[1]] = None
+    board_state[captured_position[0]][captured_position[1]] = captured_piece
+    board_state[from_position[0]][from_position[1]] = piece
+
+    if piece[1] == 'k':
+        king_positions[piece[0]] = from_position
+
+    if rook_move:
+        (rook_row, rook_start_col), (_, rook_end_col) = rook_move
+        board_state[rook_row][rook_start_col] = board_state[rook_row][rook_end_col]
+        board_state[rook_row][rook_end_col] = None
+
+    for flag, moved in zip(castling_flags, flags):
+        pieces_moved[flag] = moved
+
+
 def is_legal_move(from_position, to_position, board_state, player, last_move):
     from_row, from_col = from_position
     to_row, to_col = to_position
@@ -256,76 +483,255 @@ def is_legal_move(from_position, to_position, board_state, player, last_move):
 
 def is_in_check(king_position, board_state):
     '''Returns True if the king is in check, False otherwise.'''
-    king_row, king_col = king_position
-    king_piece = board_state[king_row][king_col]
+    king_piece = board_state[king_position[0]][king_position[1]]
     opponent = 'b' if king_piece[0] == 'w' else 'w'
+    return is_square_attacked(king_position, opponent, board_state)
+
+
+def is_square_attacked(position, attacker, board_state):
+    '''Returns True if any of the attacker's pieces attacks the square, False otherwise.'''
+    row, col = position
+
+    # Check for threats from rooks and queens along the ranks and files,
+    # the first piece on each ray is the only one that can attack
+    for ray in rook_rays[row][col]:
+        for r, c in ray:
+            piece = board_state[r][c]
+            if piece:
+                if piece[0] == attacker and piece[1] in 'rq':
+                    return True
+                break
 
-    # Directions for rooks, bishops, and queens
-    directions = [(1, 0), (0, 1), (-1, 0), (0, -1),  # Rook moves
-                  (1, 1), (1, -1), (-1, -1), (-1, 1)]  # Bishop moves
-
-    # Check for threats from rooks, bishops, and queens
-    for d_row, d_col in directions:
-        r, c = king_row, king_col
-        while 0 <= r < 8 and 0 <= c < 8:
-            r, c = r + d_row, c + d_col
-            if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c]:
-                if board_state[r][c][0] == opponent:
-                    if (abs(d_row) + abs(d_col) == 1 and board_state[r][c][1] in ['r', 'q']) or \
-                       (abs(d_row) + abs(d_col) == 2 and board_state[r][c][1] in ['b', 'q']):
-                        return True
+    # Check for threats from bishops and queens along the diagonals
+    for ray in bishop_rays[row][col]:
+        for r, c in ray:
+            piece = board_state[r][c]
+            if piece:
+                if piece[0] == attacker and piece[1] in 'bq':
+                    return True
                 break
 
     # Check for threats from knights
-    knight_moves = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
-    for d_row, d_col in knight_moves:
-        r, c = king_row + d_row, king_col + d_col
-        if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c] and board_state[r][c] == opponent + 'n':
+    knight = attacker + 'n'
+    for r, c in knight_targets[row][col]:
+        if board_state[r][c] == knight:
             return True
 
-    # Check for threats from pawns
-    pawn_directions = [(-1, -1), (-1, 1)] if opponent == 'w' else [(1, -1), (1, 1)]
-    for d_row, d_col in pawn_directions:
-        r, c = king_row + d_row, king_col + d_col
-        if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c] and board_state[r][c] == opponent + 'p':
+    # Check for threats from pawns, an enemy pawn attacks the square from
+    # a square the defender's own pawns would attack from it
+    pawn = attacker + 'p'
+    for r, c in pawn_attacks['b' if attacker == 'w' else 'w'][row][col]:
+        if board_state[r][c] == pawn:
             return True
 
     # Check for threats from the enemy king (not common but possible in some cases)
-    king_moves = [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (1, -1), (-1, -1), (-1, 1)]
-    for d_row, d_col in king_moves:
-        r, c = king_row + d_row, king_col + d_col
-        if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c] and board_state[r][c] == opponent + 'k':
+    king = attacker + 'k'
+    for r, c in king_targets[row][col]:
+        if board_state[r][c] == king:
             return True
 
     return False
 
 
+def find_checks_and_pins(king_position, player, board_state):
+    '''Returns the checks against the player's king and the player's pinned pieces.
+
+    Each check is the set of squares a piece other than the king can move to
+    to answer it: the checking piece's square and, for a slider, the squares
+    between it and the king. Pins map the square of each pinned piece to the
+    squares on the line between the king and the pinning piece.
+    '''
+    king_row, king_col = king_position
+    opponent = 'b' if player == 'w' else 'w'
+    checks = []
+    pins = {}
+
+    # Walk out from the king along every ray, a check is an enemy slider with
+    # nothing in between and a pin is one with exactly one of our pieces in between
+    for rays, attackers in ((rook_rays, 'rq'), (bishop_rays, 'bq')):
+        for ray in rays[king_row][king_col]:
+            pinned = None
+            for index, (r, c) in enumerate(ray):
+                piece = board_state[r][c]
+                if piece is None:
+                    continue
+                if piece[0] == player:
+                    if pinned:
+                        break
+                    pinned = (r, c)
+                    continue
+                if piece[1] in attackers:
+                    if pinned:
+                        pins[pinned] = set(ray[:index + 1])
+                    else:
+                        checks.append(set(ray[:index + 1]))
+                break
+
+    # Knight and pawn checks can only be answered by capturing the checking piece
+    knight = opponent + 'n'
+    for r, c in knight_targets[king_row][king_col]:
+        if board_state[r][c] == knight:
+            checks.append({(r, c)})
+    pawn = opponent + 'p'
+    for r, c in pawn_attacks[player][king_row][king_col]:
+        if board_state[r][c] == pawn:
+            checks.append({(r, c)})
+
+    return checks, pins
+
+
 def has_legal_moves(board_state, player, last_move):
     # Check for any legal moves for all pieces of the given player
+    return len(get_legal_moves(board_state, player, last_move)) > 0
+
+def piece_has_legal_moves(start_position, board_state, player, last_move):
+    # Check if any of the player's legal moves starts from this square
+    for move in get_legal_moves(board_state, player, last_move):
+        if move[0] == start_position:
+            return True
+    return False
+
+
+def get_legal_moves(board_state, player, last_move):
+    '''Returns the legal moves of a position, generating them only once per position.
+
+    Moves are cached by the Zobrist key the game state keeps, together with
+    the player and en passant square given, so only moves of the current
+    board (or one reached from it with make_move) are cached; any other board
+    has its moves generated every time. The least recently used positions are
+    dropped once the cache holds legal_move_cache_size of them.
+    '''
+    if board_state is not current_board_state:
+        return tuple(generate_legal_moves(board_state, player, last_move))
+    en_passant = last_move['to_position'] if last_move and last_move['piece_code'][1] == 'p' and \
+        abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2 else None
+    key = (zobrist_key, player, en_passant)
+    moves = legal_move_cache.get(key)
+    if moves is not None:
+        legal_move_cache.move_to_end(key)
+        return moves
+
+    moves = tuple(generate_legal_moves(board_state, player, last_move))
+    legal_move_cache[key] = moves
+    if len(legal_move_cache) > legal_move_cache_size:
+        legal_move_cache.popitem(last=False)
+    return moves
+
+
+def get_castling_moves(start_position, board_state, moved=None):
+    '''Returns the squares the king on start_position can castle to, given the pieces_moved flags (by default the game's).'''
+    if moved is None:
+        moved = pieces_moved
+    row, col = start_position
+    player = board_state[row][col][0]
+
+    # The king must be unmoved on its starting square and not in check
+    if start_position != (7 if player == 'w' else 0, 4) or moved[f'{player}k']:
+        return []
+    opponent = 'b' if player == 'w' else 'w'
+    if is_square_attacked(start_position, opponent, board_state):
+        return []
+
+    # The rook must be unmoved, the path clear and the squares the king passes over and lands on not attacked
+    moves = []
+    if not moved[f'{player}r2'] and board_state[row][7] == f'{player}r' and \
+       is_path_clear(start_position, (row, 7), board_state) and \
+       not is_square_attacked((row, 5), opponent, board_state) and not is_square_attacked((row, 6), opponent, board_state):
+        moves.append((row, 6))
+    if not moved[f'{player}r1'] and board_state[row][0] == f'{player}r' and \
+       is_path_clear(start_position, (row, 0), board_state) and \
+       not is_square_attacked((row, 3), opponent, board_state) and not is_square_attacked((row, 2), opponent, board_state):
+        moves.append((row, 2))
+    return moves
+
+
+def generate_legal_moves(board_state, player, last_move, moved=None, king_position=None):
+    '''Returns every legal move for the player as (from_position, to_position, promotion) tuples.
+
+    Checks and pins are worked out once for the position, so apart from en
+    passant no move has to be tried on the board to see if it leaves the king
+    in check. Nothing but board_state is read or changed, except that for the
+    current board the player's king square and the pieces_moved flags default
+    to the game state's. For any other board the king is found on it, and
+    castling is only generated if moved gives the flags.
+    '''
+    opponent = 'b' if player == 'w' else 'w'
+    if board_state is current_board_state:
+        if king_position is None:
+            king_position = king_positions[player]
+        if moved is None:
+            moved = pieces_moved
+    elif king_position is None:
+        king_position = find_king(board_state, player)
+    king_row, king_col = king_position
+    checks, pins = find_checks_and_pins(king_position, player, board_state)
+    moves = []
+
+    # The king can go to any square that isn't attacked. Lift it off the board
+    # while checking so a slider checking it also covers the squares behind it
+    board_state[king_row][king_col] = None
+    for target in king_targets[king_row][king_col]:
+        target_piece = board_state[target[0]][target[1]]
+        if (target_piece is None or target_piece[0] == opponent) and \
+           not is_square_attacked(target, opponent, board_state):
+            moves.append((king_position, target, None))
+    board_state[king_row][king_col] = player + 'k'
+
+    # In double check only the king can move
+    if len(checks) > 1:
+        return moves
+
+    if checks:
+        evasions = checks[0]
+    else:
+        evasions = None
+        if moved is not None:
+            for target in get_castling_moves(king_position, board_state, moved):
+                moves.append((king_position, target, None))
+
     for row in range(8):
         for col in range(8):
-            if board_state[row][col] and board_state[row][col].startswith(player):
-                if piece_has_legal_moves((row, col), board_state, player, last_move):
-                    return True
-    return False
+            piece = board_state[row][col]
+            if not piece or piece[0] != player or piece[1] == 'k':
+                continue
 
-def piece_has_legal_moves(start_position, board_state, player, last_move):
-    piece = board_state[start_position[0]][start_position[1]]
-    if not piece:
-        return False
+            start_position = (row, col)
+            pin_line = pins.get(start_position)
+            for end_position in get_potential_moves(start_position, piece, board_state, last_move):
+                if piece[1] == 'p' and end_position[1] != col and board_state[end_position[0]][end_position[1]] is None:
+                    # En passant takes two pawns off the same rank which can uncover
+                    # an attack on the king no pin test sees, so play it out instead
+                    if not is_en_passant_safe(start_position, end_position, king_position, board_state):
+                        continue
+                elif (pin_line is not None and end_position not in pin_line) or \
+                     (evasions is not None and end_position not in evasions):
+                    continue
 
-    # Get all potential moves for the piece
-    potential_moves = get_potential_moves(start_position, piece, board_state, last_move)
-    # Check if any of the potential moves are legal
-    for end_position in potential_moves:
-        if is_legal_move(start_position, end_position, board_state, player, last_move):
-            # Simulate the move and check if it leaves the king in check
-            temp_board = copy.deepcopy(board_state)
-            move_piece(temp_board, start_position, end_position)
-            king_position = find_king(temp_board, player)
-            if not is_in_check(king_position, temp_board):
-                return True
-    return False
+                if piece[1] == 'p' and end_position[0] in (0, 7):
+                    for promotion in 'qrbn':
+                        moves.append((start_position, end_position, promotion))
+                else:
+                    moves.append((start_position, end_position, None))
+    return moves
+
+
+def is_en_passant_safe(start_position, end_position, king_position, board_state):
+    '''Returns True if an en passant capture leaves the capturing side's king unattacked.
+
+    The capture is tried on the board alone and taken back, without touching
+    the game state make_move keeps.
+    '''
+    (from_row, from_col), (to_row, to_col) = start_position, end_position
+    pawn = board_state[from_row][from_col]
+    captured_pawn = board_state[from_row][to_col]
+    board_state[from_row][from_col] = None
+    board_state[from_row][to_col] = None
+    board_state[to_row][to_col] = pawn
+    safe = not is_square_attacked(king_position, 'b' if pawn[0] == 'w' else 'w', board_state)
+    board_state[to_row][to_col] = None
+    board_state[from_row][to_col] = captured_pawn
+    board_state[from_row][from_col] = pawn
+    return safe
 
 
 def get_potential_moves(start_position, piece, board_state, last_move):
@@ -380,6 +786,7 @@ def is_opponents_piece(start_position, end_position, board_state):
 
 
 def perform_castling(move, board_state, player):
+    global zobrist_key, en_passant_file, material_score
 
     # Determine the row for the king and rook based on the player
     row = 7 if player == 'w' else 0
@@ -395,19 +802,133 @@ def perform_castling(move, board_state, player):
         print("Cannot castle due to castling rules.")
         return False
 
+    # The king may not pass over or land on an attacked square either
+    opponent = 'b' if player == 'w' else 'w'
+    if is_square_attacked((row, (king_start_col + king_end_col) // 2), opponent, board_state) or \
+       is_square_attacked((row, king_end_col), opponent, board_state):
+        print("Cannot castle through or into check.")
+        return False
+
     # Move king and rook to their new positions
     board_state[row][king_start_col] = None
     board_state[row][rook_start_col] = None
     board_state[row][king_end_col] = f'{player}k'
     board_state[row][rook_end_col] = f'{player}r'
-
-    # Update pieces_moved flags
+    king_positions[player] = (row, king_end_col)
+    king_values = piece_square_values[f'{player}k']
+    rook_values = piece_square_values[f'{player}r']
+    material_score += king_values[row][king_end_col] - king_values[row][king_start_col]
+    material_score += rook_values[row][rook_end_col] - rook_values[row][rook_start_col]
+
+    # Update pieces_moved flags and the Zobrist key
+    key = zobrist_key ^ zobrist_black_to_move ^ zobrist_castling[castling_rights()]
     pieces_moved[f'{player}k'] = True
     pieces_moved[f'{player}r{1 if move in ["e1c1", "e8c8"] else 2}'] = True
+    key ^= zobrist_castling[castling_rights()]
+    key ^= zobrist_pieces[f'{player}k'][row][king_start_col] ^ zobrist_pieces[f'{player}k'][row][king_end_col]
+    key ^= zobrist_pieces[f'{player}r'][row][rook_start_col] ^ zobrist_pieces[f'{player}r'][row][rook_end_col]
+    if en_passant_file is not None:
+        key ^= zobrist_en_passant[en_passant_file]
+        en_passant_file = None
+    zobrist_key = key
 
     return True
 
 
+def castling_rights(moved=None):
+    '''Returns the castling rights left as a number from 0 to 15, one bit each for
+    white kingside, white queenside, black kingside and black queenside.
+
+    moved defaults to the game's pieces_moved flags.
+    '''
+    if moved is None:
+        moved = pieces_moved
+    return ((not moved['wk'] and not moved['wr2'])
+            | (not moved['wk'] and not moved['wr1']) << 1
+            | (not moved['bk'] and not moved['br2']) << 2
+            | (not moved['bk'] and not moved['br1']) << 3)
+
+
+def pieces_moved_from_rights(rights):
+    '''Returns pieces_moved flags that give the castling rights, a lost right marking its rook as moved.'''
+    return {
+        'wk': not rights & 3, 'wr1': not rights & 2, 'wr2': not rights & 1,
+        'bk': not rights & 12, 'br1': not rights & 8, 'br2': not rights & 4
+    }
+
+
+def compute_zobrist_key(board_state, player, last_move, moved=None):
+    '''Computes the Zobrist key of a position from scratch.
+
+    Returns the key and the en passant file (None if there is none), with the
+    castling rights taken from moved, by default the game's pieces_moved flags.
+    '''
+    key = 0
+    for row in range(8):
+        for col in range(8):
+            piece = board_state[row][col]
+            if piece:
+                key ^= zobrist_pieces[piece][row][col]
+
+    if player == 'b':
+        key ^= zobrist_black_to_move
+    key ^= zobrist_castling[castling_rights(moved)]
+
+    file = None
+    if last_move and last_move['piece_code'][1] == 'p' and \
+       abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2:
+        file = last_move['to_position'][1]
+        key ^= zobrist_en_passant[file]
+
+    return key, file
+
+
+def compute_material(board_state):
+    '''Returns the count of each piece on the board and the material and piece-square score, white positive.'''
+    counts = dict.fromkeys(starting_piece_counts, 0)
+    score = 0
+    for row in range(8):
+        for col in range(8):
+            piece = board_state[row][col]
+            if piece:
+                counts[piece] += 1
+                score += piece_square_values[piece][row][col]
+    return counts, score
+
+
+def evaluate():
+    '''Returns the score of the current position in centipawns, positive when white is better.'''
+    return material_score
+
+
+def get_taken_pieces(counts=None):
+    '''Returns the pieces each side has taken, as {'white': [...], 'black': [...]}.
+
+    Works from the piece counts (by default the game's) rather than the board,
+    so promoted pawns count as taken only once the promoted piece is.
+    '''
+    if counts is None:
+        counts = piece_counts
+    taken_pieces = {'white': [], 'black': []}
+    for piece, count in starting_piece_counts.items():
+        color = 'white' if piece[0] == 'b' else 'black'
+        taken_pieces[color].extend([piece] * (count - counts[piece]))
+    return taken_pieces
+
+
+# Piece counts and score of the current position, kept up to date by move_piece,
+# make_move, unmake_move and perform_castling
+piece_counts, material_score = compute_material(current_board_state)
+
+# Zobrist key of the current position and the file a pawn can be captured on en passant,
+# kept up to date by move_piece, make_move, unmake_move and perform_castling
+zobrist_key, en_passant_file = compute_zobrist_key(current_board_state, 'w', None)
+
+# Legal moves of recently seen positions by Zobrist key, player and en passant square, least recently used first
+legal_move_cache = OrderedDict()
+legal_move_cache_size = 1024
+
+
 def find_king(board_state, color):
     for row in range(8):
         for col in range(8):
@@ -416,19 +937,64 @@ def find_king(board_state, color):
     return None
 
 
+def get_king_position(color):
+    '''Returns the square of the king of the given colour on the current board without scanning it.'''
+    return king_positions[color]
+
+
 def is_game_over(board_state, player, last_move):
-    king_position = find_king(board_state, player)
-    if is_in_check(king_position, board_state):
-        # Player is in check. Check if they have any legal moves left
-        if not has_legal_moves(board_state, player, last_move):
-            print(f"Checkmate! {'Black' if player == 'w' else 'White'} wins!")
-            return True
-        
-    return False
+    if has_legal_moves(board_state, player, last_move):
+        return False
+
+    # No legal moves left, it's checkmate if the player is in check and stalemate otherwise
+    if is_in_check(get_king_position(player), board_state):
+        print(f"Checkmate! {'Black' if player == 'w' else 'White'} wins!")
+    else:
+        print("Stalemate! The game is a draw.")
+    return True
+
+
+def save_state():
+    '''Returns the current game state, for restore_state to put back after the game state has been used for something else.'''
+    return (current_board_state, current_player, last_move, pieces_moved, zobrist_key, en_passant_file,
+            piece_counts, material_score, halfmove_clock, fullmove_number, dict(king_positions))
+
+
+def restore_state(state):
+    '''Makes a game state returned by save_state the current one again.'''
+    global current_board_state, current_player, last_move, pieces_moved, zobrist_key, en_passant_file
+    global piece_counts, material_score, halfmove_clock, fullmove_number
+    (current_board_state, current_player, last_move, pieces_moved, zobrist_key, en_passant_file,
+     piece_counts, material_score, halfmove_clock, fullmove_number, kings) = state
+    king_positions.update(kings)
+
+
+def load_position(board_state, player='w', previous_move=None, moved=None, halfmove=0, fullmove=1):
+    '''Makes the given position the current game state.
+
+    moved holds the pieces_moved flags, by default none of the kings and rooks
+    have moved. halfmove and fullmove are the FEN move counters.
+    '''
+    global current_board_state, current_player, last_move, pieces_moved, zobrist_key, en_passant_file
+    global piece_counts, material_score, halfmove_clock, fullmove_number
+    current_board_state = board_state
+    current_player = player
+    last_move = previous_move
+    halfmove_clock = halfmove
+    fullmove_number = fullmove
+    pieces_moved = moved if moved is not None else {
+        'wk': False, 'wr1': False, 'wr2': False,
+        'bk': False, 'br1': False, 'br2': False
+    }
+    zobrist_key, en_passant_file = compute_zobrist_key(board_state, player, previous_move)
+    piece_counts, material_score = compute_material(board_state)
+    king_positions['w'] = find_king(board_state, 'w')
+    king_positions['b'] = find_king(board_state, 'b')
 
 
 def reset_game():
-    global current_board_state, current_player, last_move, pieces_moved
+    global current_board_state, current_player, last_move, pieces_moved, zobrist_key, en_passant_file
+    global piece_counts, material_score, halfmove_clock, fullmove_number
     # Reset the board to the initial state
     current_board_state = [
         ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br'],
@@ -449,6 +1015,77 @@ def reset_game():
         'wk': False, 'wr1': False, 'wr2': False,
         'bk': False, 'br1': False, 'br2': False
     }
+    zobrist_key, en_passant_file = compute_zobrist_key(current_board_state, current_player, last_move)
+    piece_counts, material_score = compute_material(current_board_state)
+    halfmove_clock = 0
+    fullmove_number = 1
+    king_positions['w'] = (7, 4)
+    king_positions['b'] = (0, 4)
+
+
+def clear_history():
+    global history_ply
+    move_history.clear()
+    history_ply = 0
+
+
+def record_history(move, undo, previous_state):
+    '''Adds a move main() has just played to the history, dropping any moves taken back.'''
+    global history_ply
+    del move_history[history_ply:]
+    move_history.append((move, undo, previous_state))
+    history_ply += 1
+
+
+def take_back():
+    '''Takes back the last move played with its undo record, returning False if there is none.'''
+    global history_ply, current_player, last_move, halfmove_clock, fullmove_number
+    if history_ply == 0:
+        return False
+    history_ply -= 1
+    move, undo, previous_state = move_history[history_ply]
+    unmake_move(current_board_state, undo)
+    current_player, last_move, halfmove_clock, fullmove_number = previous_state
+    return True
+
+
+def replay():
+    '''Plays the last move taken back again, returning False if there is none.'''
+    global history_ply, current_player, last_move
+    if history_ply == len(move_history):
+        return False
+    move, undo, previous_state = move_history[history_ply]
+    from_position, to_position, promotion = move
+    piece_code = current_board_state[from_position[0]][from_position[1]]
+    undo = make_move(current_board_state, from_position, to_position, promotion)
+    move_history[history_ply] = (move, undo, previous_state)
+    history_ply += 1
+    update_move_counters(piece_code, undo[3] is not None)
+    last_move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+    current_player = 'b' if current_player == 'w' else 'w'
+    return True
+
+
+def go_to_ply(ply):
+    '''Takes back or plays again moves, one step each, until ply moves of the history are played.
+
+    Returns False, changing nothing, if the history doesn't have that many.
+    '''
+    if not 0 <= ply <= len(move_history):
+        return False
+    while history_ply > ply:
+        take_back()
+    while history_ply < ply:
+        replay()
+    return True
+
+
+def update_move_counters(piece_code, is_capture):
+    '''Advances the FEN move counters after a move by the piece.'''
+    global halfmove_clock, fullmove_number
+    halfmove_clock = 0 if piece_code[1] == 'p' or is_capture else halfmove_clock + 1
+    if piece_code[0] == 'b':
+        fullmove_number += 1
 
 
 def get_piece_type(piece_code):
@@ -470,10 +1107,32 @@ def get_square_color(row, col):
 
 def get_user_move():
     while True:
-        user_input = input("Enter your move: ").lower().strip()
+        raw_input = input("Enter your move: ").strip()
+        user_input = raw_input.lower()
 
-        if user_input == 'reset':
-            return 'reset', None
+        if user_input in ['reset', 'hint', 'fen', 'undo', 'redo']:
+            return user_input, None
+
+        # 'goto' is followed by the number of moves to go back or forward to
+        if user_input.split()[:1] == ['goto']:
+            ply = user_input.split()[1:2]
+            if ply and ply[0].isdigit():
+                return 'goto', int(ply[0])
+            print("Usage: 'goto <number of moves>'.")
+            continue
+
+        # 'load' is followed by a FEN, which is case sensitive
+        if user_input.split()[:1] == ['load']:
+            return 'load', raw_input[4:].strip()
+
+        # 'go' lets the computer move, optionally followed by its thinking time in seconds
+        if user_input.split()[:1] == ['go']:
+            seconds = user_input.split()[1:2]
+            try:
+                return 'go', float(seconds[0]) if seconds else None
+            except ValueError:
+                print("Usage: 'go' or 'go <seconds>'.")
+                continue
 
         # Normalize the input by removing ' to ' if present
         normalized_input = user_input.replace(' to ', '')
@@ -499,24 +1158,27 @@ def convert_position(pos):
     return (row, column)
 
 
-def process_move(from_position, to_position, board_state, current_player, last_move):
-    # Make the move temporarily
-    temp_board = copy.deepcopy(board_state)
-    move_piece(temp_board, from_position, to_position)
+def convert_to_square(position):
+    # Converts a tuple of array indices (row, column) back to algebraic notation
+    return 'abcdefgh'[position[1]] + str(8 - position[0])
+
+
+def process_move(from_position, to_position, board_state, current_player, last_move, promotion=None):
+    # Make the move, taking it back if it leaves our own king in check.
+    # Returns the move's undo record, or None if it was illegal.
+    undo = make_move(board_state, from_position, to_position, promotion)
+
+    if is_in_check(get_king_position(current_player), board_state):
+        unmake_move(board_state, undo)
+        print("Illegal move: cannot leave or place own king in check.")
+        return None  # Illegal move
 
     # Check if the opponent is now in check
     opponent = 'b' if current_player == 'w' else 'w'
-    opponent_king_position = find_king(temp_board, opponent)
-
-    if is_in_check(opponent_king_position, temp_board):
+    if is_in_check(get_king_position(opponent), board_state):
         print("Check!")
-    elif is_in_check(find_king(temp_board, current_player), temp_board):
-        print("Illegal move: cannot leave or place own king in check.")
-        return False  # Illegal move
 
-    # Confirm and make the actual move
-    move_piece(board_state, from_position, to_position)
-    return True
+    return undo
 
 
 # Main Game Loop
@@ -526,7 +1188,10 @@ def main():
     last_move = None  # Initialize last_move
     print("Welcome to Chess!")
     print("Enter moves in algebraic notation or verbose notation (e.g., 'e2e4' or 'e2 to e4').")
-    print("Enter 'reset' to reset the game.")
+    print("Enter 'reset' to reset the game or 'hint' to list the legal moves.")
+    print("Enter 'go' (or 'go <seconds>') to let the computer play the move.")
+    print("Enter 'load <fen>' to set up a position or 'fen' to print the current one.")
+    print("Enter 'undo' to take back a move, 'redo' to play it again or 'goto <n>' to go to move n.")
 
     while not is_game_over(current_board_state, current_player, last_move):
         display_board(current_board_state)
@@ -537,14 +1202,95 @@ def main():
         # Check for reset command
         if from_move == 'reset':
             reset_game()
+            clear_history()
             print("Game has been reset.")
             display_board(current_board_state)
             continue
 
+        # List the legal moves
+        if from_move == 'hint':
+            legal_moves = get_legal_moves(current_board_state, current_player, last_move)
+            print("Legal moves:", ' '.join(sorted(set(
+                convert_to_square(start) + convert_to_square(end) for start, end, promotion in legal_moves))))
+            continue
+
+        # Set up a position from a FEN
+        if from_move == 'load':
+            import fen
+            try:
+                board_state, player, previous_move, moved, halfmove, fullmove = fen.parse_fen(to_move)
+            except ValueError as e:
+                print(e)
+                continue
+            load_position(board_state, player, previous_move, moved, halfmove, fullmove)
+            clear_history()
+            print("Position loaded.")
+            continue
+
+        # Take back, play again or go to a move of the history
+        if from_move in ['undo', 'redo', 'goto']:
+            if from_move == 'undo':
+                done = take_back()
+            elif from_move == 'redo':
+                done = replay()
+            else:
+                done = go_to_ply(to_move)
+            if done:
+                print(f"At move {history_ply} of {len(move_history)}.")
+            else:
+                print("No move to go to.")
+            continue
+
+        # Print the current position as a FEN
+        if from_move == 'fen':
+            import fen
+            print(fen.to_fen(current_board_state, current_player, last_move, pieces_moved, halfmove_clock, fullmove_number))
+            continue
+
+        # Let the engine pick and play the move
+        if from_move == 'go':
+            import engine
+            move, info = engine.search_position(current_board_state, current_player, last_move, pieces_moved,
+                                                time_limit=to_move or 3)
+            (from_row, from_col), (to_row, to_col), promotion = move
+            print(f"Computer plays {convert_to_square((from_row, from_col))}{convert_to_square((to_row, to_col))}"
+                  f"{promotion or ''} (depth {info['depth']}, score {info['score']}, "
+                  f"{info['nodes']} nodes in {info['time']:.2f}s, {info['nps']} nodes/second)")
+            # The search ran on a copy of the board, so play the move on the real one
+            previous_state = (current_player, last_move, halfmove_clock, fullmove_number)
+            piece_code = current_board_state[from_row][from_col]
+            update_move_counters(piece_code, current_board_state[to_row][to_col] is not None or
+                                 (piece_code[1] == 'p' and from_col != to_col))
+            last_move = {
+                'piece_code': piece_code,
+                'from_position': (from_row, from_col),
+                'to_position': (to_row, to_col)
+            }
+            undo = process_move((from_row, from_col), (to_row, to_col), current_board_state, current_player, last_move,
+                                promotion)
+            record_history(move, undo, previous_state)
+            current_player = 'b' if current_player == 'w' else 'w'
+            continue
+
         # Handle castling moves
         if to_move is None and from_move in ['e1g1', 'e1c1', 'e8g8', 'e8c8']:
             print("Castling move")
+            previous_state = (current_player, last_move, halfmove_clock, fullmove_number)
+            # What perform_castling changes, for an undo record like make_move's
+            flags = tuple(pieces_moved[flag] for flag in castling_flags)
+            saved_state = (zobrist_key, en_passant_file, material_score)
             if perform_castling(from_move, current_board_state, current_player):
+                row = 7 if current_player == 'w' else 0
+                rook_move = ((row, 7), (row, 5)) if from_move[2] == 'g' else ((row, 0), (row, 3))
+                move = (convert_position(from_move[:2]), convert_position(from_move[2:]), None)
+                record_history(move, (move[0], move[1], f'{current_player}k', None, move[1], rook_move, flags,
+                                      saved_state), previous_state)
+                update_move_counters(f'{current_player}k', False)
+                last_move = {
+                    'piece_code': f'{current_player}k',
+                    'from_position': convert_position(from_move[:2]),
+                    'to_position': convert_position(from_move[2:])
+                }
                 # Toggle player after a successful castling move
                 current_player = 'b' if current_player == 'w' else 'w'
                 continue
@@ -557,7 +1303,9 @@ def main():
             to_row, to_col = convert_position(to_move)
             piece_code = current_board_state[from_row][from_col]
 
-            if is_legal_move((from_row, from_col), (to_row, to_col), current_board_state, current_player, last_move):
+            legal_moves = get_legal_moves(current_board_state, current_player, last_move)
+            if any(move[0] == (from_row, from_col) and move[1] == (to_row, to_col) for move in legal_moves):
+                previous_state = (current_player, last_move, halfmove_clock, fullmove_number)
                 # Update last_move before processing the current move
                 last_move = {
                     'piece_code': piece_code,
@@ -565,9 +1313,14 @@ def main():
                     'to_position': (to_row, to_col)
                 }
 
-                if not process_move((from_row, from_col), (to_row, to_col), current_board_state, current_player, last_move):
+                is_capture = current_board_state[to_row][to_col] is not None or \
+                    (piece_code[1] == 'p' and from_col != to_col)
+                undo = process_move((from_row, from_col), (to_row, to_col), current_board_state, current_player, last_move)
+                if not undo:
                     print("Invalid move. Please try again.")
                     continue
+                record_history(((from_row, from_col), (to_row, to_col), None), undo, previous_state)
+                update_move_counters(piece_code, is_capture)
 
                 # Toggle player after a successful move
                 current_player = 'b' if current_player == 'w' else 'w'
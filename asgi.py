@@ -0,0 +1,157 @@
+# Async (ASGI) variant of old.py's game server
+#
+# Usage:
+#   uvicorn asgi:app        (or any other ASGI server, e.g. hypercorn asgi:app)
+#
+# Serves the JSON game routes of old.py, both the legacy ones and the
+# /games/<game_id>/... ones, from a single event loop, which only parses
+# requests and writes responses:
+# - playing a move takes the game's lock and runs the rules code, so it runs
+#   on a pool of threads;
+# - the engine searches in a pool of processes, each with its own copy of
+#   app.py's game state, so a search neither holds the engine lock the rules
+#   code needs nor competes with it for the interpreter;
+# - looking a game up may read it back from disk, so it runs on the rules
+#   threads too;
+# - the current board is read from the game's packed history on the loop.
+# Requests for other games, and board reads for the same one, keep flowing
+# while a move is checked or the engine thinks.
+#
+# The games are old.py's, so a process can serve both: the Flask app for
+# pages and event streams, this one for the move traffic.
+import asyncio
+import json
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import engine
+import old
+
+RULES_THREADS = 4
+ENGINE_PROCESSES = 1
+
+rules_executor = ThreadPoolExecutor(RULES_THREADS, thread_name_prefix='rules')
+engine_executor = ProcessPoolExecutor(ENGINE_PROCESSES, mp_context=multiprocessing.get_context('spawn'),
+                                      initializer=engine.set_hash_size, initargs=(old.ENGINE_HASH_MB,))
+
+
+async def in_thread(function, *args):
+    '''Runs a function on the rules threads and returns its result.'''
+    return await asyncio.get_running_loop().run_in_executor(rules_executor, function, *args)
+
+
+def search_request(game, data):
+    '''Returns a copy of the game's position and the search limits of an engine request.'''
+    time_limit, node_limit = old.search_limits(data)
+    with game.lock:
+        return ([row[:] for row in game.board_state], data.get('player') or game.player, game.last_move,
+                dict(game.pieces_moved), time_limit, node_limit)
+
+
+async def record_move(game, data):
+    return await in_thread(old.play_move, game, data)
+
+
+async def attempt_castle(game, data):
+    return await in_thread(old.play_castle, game, data)
+
+
+async def reset_game(game, data):
+    return await in_thread(old.reset, game)
+
+
+async def take_back_move(game, data):
+    return await in_thread(old.navigate, game, data, -1)
+
+
+async def redo_move(game, data):
+    return await in_thread(old.navigate, game, data, 1)
+
+
+async def go_to_ply(game, data):
+    return await in_thread(old.navigate, game, data)
+
+
+async def engine_move(game, data):
+    board_state, player, last_move, moved, time_limit, node_limit = await in_thread(search_request, game, data)
+    move, info = await asyncio.get_running_loop().run_in_executor(
+        engine_executor, engine.search_position, board_state, player, last_move, moved, time_limit, node_limit)
+    return old.search_response(move, info)
+
+
+async def get_current_board(game, data):
+    return old.current_board(game)
+
+
+# Handlers by (method, route name), each taking the game and the request's JSON
+# data and returning the response data and status
+routes = {
+    ('POST', 'record_move'): record_move,
+    ('POST', 'attempt_castle'): attempt_castle,
+    ('POST', 'reset_game'): reset_game,
+    ('POST', 'take_back_move'): take_back_move,
+    ('POST', 'redo_move'): redo_move,
+    ('POST', 'go_to_ply'): go_to_ply,
+    ('POST', 'engine_move'): engine_move,
+    ('GET', 'get_current_board'): get_current_board,
+}
+
+path_pattern = re.compile(r'^(?:/games/([^/]+))?/(\w+)$')
+
+
+async def read_body(receive):
+    '''Returns the whole body of an HTTP request.'''
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data, separators=(',', ':')).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    '''Answers the server's startup and shutdown messages, shutting the executors down at the end.'''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            rules_executor.shutdown(wait=False)
+            engine_executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    '''The ASGI application.'''
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    match = path_pattern.match(scope['path'])
+    handler = routes.get((scope['method'], match.group(2))) if match else None
+    if handler is None:
+        return await send_json(send, {'success': False, 'message': 'Not found'}, 404)
+
+    body = await read_body(receive)
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        return await send_json(send, {'success': False, 'message': 'Request body is not valid JSON'}, 400)
+
+    game_id = match.group(1) or old.DEFAULT_GAME_ID
+    game = await in_thread(old.find_game, game_id)
+    if game is None:
+        return await send_json(send, {'success': False, 'message': f'Unknown game {game_id}'}, 404)
+
+    response_data, status = await handler(game, data)
+    await send_json(send, response_data, status)
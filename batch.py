@@ -0,0 +1,162 @@
+# Batch validation of PGN games or EPD positions across a pool of worker processes
+#
+# Usage:
+#   python batch.py [options] <file.pgn|file.epd>
+#
+# PGN games are replayed move by move through the rules engine (see pgn.py).
+# EPD positions are checked for a legal setup, for 'bm'/'am' moves that are
+# legal in the position and for perft counts given as 'D<depth> <nodes>'
+# operations, up to --max-depth.
+#
+# The main process reads the file and hands it out in chunks, with only a few
+# chunks per worker in flight at once, so the file is never held in memory.
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import app
+import perft
+from fen import parse_fen
+from pgn import read_games, replay_game, parse_san
+
+
+def parse_epd(line):
+    '''Returns the FEN and the dict of operations (opcode to operand) of an EPD line.'''
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError(f"Invalid EPD: expected at least 4 fields in '{line}'")
+    operations = {}
+    for operation in (fields[4] if len(fields) > 4 else '').split(';'):
+        parts = operation.split(None, 1)
+        if parts:
+            operations[parts[0]] = parts[1].strip().strip('"') if len(parts) > 1 else ''
+    return ' '.join(fields[:4]), operations
+
+
+def validate_position(line, max_depth):
+    '''Validates one EPD line and returns the number of checks made, raising ValueError on the first failure.'''
+    fen, operations = parse_epd(line)
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    checks = 1
+
+    legal_moves = app.generate_legal_moves(board_state, player, last_move)
+    for opcode in ('bm', 'am'):
+        for san in operations.get(opcode, '').split():
+            parse_san(san, board_state, player, legal_moves)
+            checks += 1
+
+    for opcode, operand in operations.items():
+        if opcode[0] == 'D' and opcode[1:].isdigit() and int(opcode[1:]) <= max_depth:
+            nodes = perft.perft(int(opcode[1:]), board_state, player, last_move)
+            if nodes != int(operand):
+                raise ValueError(f"perft {opcode[1:]} is {nodes}, expected {operand}")
+            checks += 1
+    return checks
+
+
+def validate_chunk(task):
+    '''Worker entry point: validates a chunk of games or positions.
+
+    Returns the results, one (index, ok, detail) per item where detail is
+    the number of plies or checks, or the error, plus (pid, items, seconds)
+    for the worker's throughput stats.
+    '''
+    kind, max_depth, items = task
+    start = time.perf_counter()
+    results = []
+    for index, item in items:
+        try:
+            if kind == 'pgn':
+                results.append((index, True, len(replay_game(*item))))
+            else:
+                results.append((index, True, validate_position(item, max_depth)))
+        except ValueError as e:
+            results.append((index, False, str(e)))
+    return results, (os.getpid(), len(items), time.perf_counter() - start)
+
+
+def read_items(path):
+    '''Yields (index, item) for each game of a PGN file or each position of an EPD file, counting from 1.'''
+    if path.lower().endswith('.pgn'):
+        yield from enumerate(read_games(path), 1)
+    else:
+        with open(path, encoding='utf-8', errors='replace') as epd_file:
+            index = 0
+            for line in epd_file:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    index += 1
+                    yield index, line
+
+
+def validate_file(path, workers=None, chunk_size=50, ordered=True, max_depth=3, worker_stats=None):
+    '''Validates every game or position in a file on a pool of worker processes.
+
+    Yields (index, ok, detail) results as chunks finish: in file order if
+    ordered, otherwise as soon as each chunk is done. If worker_stats is a
+    dict it is filled in with [items, seconds] per worker pid.
+    '''
+    kind = 'pgn' if path.lower().endswith('.pgn') else 'epd'
+    workers = workers or os.cpu_count() or 1
+    # Cap the chunks waiting in the pool so reading the file can't run ahead of the workers
+    in_flight = threading.BoundedSemaphore(workers * 4)
+
+    def tasks():
+        chunk = []
+        for item in read_items(path):
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                in_flight.acquire()
+                yield kind, max_depth, chunk
+                chunk = []
+        if chunk:
+            in_flight.acquire()
+            yield kind, max_depth, chunk
+
+    with multiprocessing.Pool(workers) as pool:
+        run = pool.imap if ordered else pool.imap_unordered
+        for results, (pid, items, seconds) in run(validate_chunk, tasks()):
+            in_flight.release()
+            if worker_stats is not None:
+                stats = worker_stats.setdefault(pid, [0, 0.0])
+                stats[0] += items
+                stats[1] += seconds
+            yield from results
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Validate a PGN or EPD file on a pool of worker processes.")
+    parser.add_argument('path', help="a .pgn file of games or an EPD file of positions")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--chunk-size', type=int, default=50, help="games or positions handed to a worker at once")
+    parser.add_argument('--unordered', action='store_true', help="report results as they finish, not in file order")
+    parser.add_argument('--max-depth', type=int, default=3, help="deepest EPD perft count to check")
+    options = parser.parse_args(args)
+
+    worker_stats = {}
+    total = failed = work = 0
+    start = time.perf_counter()
+    for index, ok, detail in validate_file(options.path, options.workers, options.chunk_size,
+                                           not options.unordered, options.max_depth, worker_stats):
+        total += 1
+        if ok:
+            work += detail
+        else:
+            failed += 1
+            print(f"#{index}: {detail}")
+    elapsed = time.perf_counter() - start
+
+    unit = 'plies' if options.path.lower().endswith('.pgn') else 'checks'
+    for pid, (items, seconds) in sorted(worker_stats.items()):
+        print(f"Worker {pid}: {items} items in {seconds:.2f}s, {items / seconds if seconds else 0:.0f} items/second")
+    print(f"{total} items ({failed} failed), {work} {unit} in {elapsed:.2f}s, "
+          f"{total / elapsed if elapsed else 0:.0f} items/second with {len(worker_stats)} workers")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
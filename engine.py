@@ -0,0 +1,371 @@
+# Computer opponent: alpha-beta search over app.py's move generator
+#
+# The search plays moves on the board with app.make_move/unmake_move, so the
+# board it is given must be app.py's current game state (see app.load_position).
+import time
+from array import array
+
+import app
+
+MATE_SCORE = 100000
+INFINITY = 1000000
+
+# Transposition table bound types: the stored score is exact, a lower bound (it caused
+# a beta cutoff) or an upper bound (no move raised alpha)
+EXACT, LOWER_BOUND, UPPER_BOUND = 1, 2, 3
+
+# Promotion piece of a packed move, index 0 meaning no promotion
+promotion_codes = (None, 'q', 'r', 'b', 'n')
+
+# Bit layout of a packed transposition table entry
+SCORE_OFFSET = 1 << 19
+DEPTH_SHIFT = 20
+BOUND_SHIFT = 28
+GENERATION_SHIFT = 30
+MOVE_SHIFT = 36
+
+
+class SearchTimeout(Exception):
+    '''Raised inside the search when the time or node budget runs out.'''
+
+
+def pack_move(move):
+    '''Packs a move into 15 bits: from square, to square and promotion piece.'''
+    if move is None:
+        return 0
+    (from_row, from_col), (to_row, to_col), promotion = move
+    return (from_row * 8 + from_col) | (to_row * 8 + to_col) << 6 | promotion_codes.index(promotion) << 12
+
+
+def unpack_move(packed):
+    '''Returns the move packed by pack_move, or None for 0.'''
+    if packed == 0:
+        return None
+    from_square, to_square = packed & 63, packed >> 6 & 63
+    return (divmod(from_square, 8), divmod(to_square, 8), promotion_codes[packed >> 12])
+
+
+class TranspositionTable:
+    '''Fixed-size table of search results keyed by the position's Zobrist key.
+
+    Entries live in two flat arrays of 64-bit integers, one for the keys and
+    one for the packed depth, bound, score, search generation and best move,
+    so the table takes 16 bytes per entry and never grows after it is made.
+    Each bucket has two entries: a depth-preferred one that keeps the deepest
+    result of the current search, and an always-replace one that takes
+    everything else.
+    '''
+
+    def __init__(self, size_mb=16):
+        # Round the bucket count down to a power of two so a mask picks the bucket
+        buckets = 1
+        while buckets * 2 * 32 <= size_mb * 1024 * 1024:
+            buckets *= 2
+        self.mask = buckets - 1
+        self.keys = array('Q', [0]) * (buckets * 2)
+        self.data = array('Q', [0]) * (buckets * 2)
+        self.generation = 0
+
+    def size_bytes(self):
+        return (len(self.keys) + len(self.data)) * 8
+
+    def clear(self):
+        self.keys = array('Q', [0]) * len(self.keys)
+        self.data = array('Q', [0]) * len(self.data)
+        self.generation = 0
+
+    def new_search(self):
+        '''Marks the entries of earlier searches as replaceable.'''
+        self.generation = (self.generation + 1) & 63
+
+    def probe(self, key):
+        '''Returns (depth, bound, score, best move) stored for the key, or None.'''
+        index = (key & self.mask) * 2
+        keys = self.keys
+        if keys[index] == key:
+            data = self.data[index]
+        elif keys[index + 1] == key:
+            data = self.data[index + 1]
+        else:
+            return None
+        return (data >> DEPTH_SHIFT & 255, data >> BOUND_SHIFT & 3,
+                (data & 0xFFFFF) - SCORE_OFFSET, unpack_move(data >> MOVE_SHIFT))
+
+    def store(self, key, depth, bound, score, move):
+        index = (key & self.mask) * 2
+        data = ((score + SCORE_OFFSET) | depth << DEPTH_SHIFT | bound << BOUND_SHIFT
+                | self.generation << GENERATION_SHIFT | pack_move(move) << MOVE_SHIFT)
+
+        # The depth-preferred entry takes the result if it is as deep as what it holds,
+        # for the same position, or left over from an earlier search
+        old = self.data[index]
+        if (self.keys[index] == key or depth >= (old >> DEPTH_SHIFT & 255)
+                or (old >> GENERATION_SHIFT & 63) != self.generation):
+            self.keys[index] = key
+            self.data[index] = data
+        else:
+            self.keys[index + 1] = key
+            self.data[index + 1] = data
+
+    def hashfull(self):
+        '''Returns how full the table is in permille, sampled from the first 1000 entries.'''
+        sample = min(1000, len(self.keys))
+        used = sum(1 for index in range(sample)
+                   if self.keys[index] and (self.data[index] >> GENERATION_SHIFT & 63) == self.generation)
+        return used * 1000 // sample
+
+
+# Shared by every search in this process; resize it with set_hash_size
+transposition_table = TranspositionTable()
+
+
+def set_hash_size(size_mb):
+    '''Replaces the transposition table with an empty one of size_mb megabytes.'''
+    global transposition_table
+    transposition_table = TranspositionTable(size_mb)
+
+
+def score_to_table(score, ply):
+    # Mate scores count plies from the root; the table stores them from the position itself
+    if score >= MATE_SCORE - 1000:
+        return score + ply
+    if score <= -MATE_SCORE + 1000:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score >= MATE_SCORE - 1000:
+        return score - ply
+    if score <= -MATE_SCORE + 1000:
+        return score + ply
+    return score
+
+
+class Search:
+    '''One search of a position, holding the budget, node count and killer moves.'''
+
+    def __init__(self, board_state, time_limit=None, node_limit=None, table=None):
+        self.board_state = board_state
+        self.table = table
+        self.deadline = time.perf_counter() + time_limit if time_limit else None
+        self.node_limit = node_limit
+        self.nodes = 0
+        # Two quiet moves per ply that recently caused a beta cutoff
+        self.killers = [[None, None] for ply in range(128)]
+
+    def check_budget(self):
+        if self.node_limit and self.nodes >= self.node_limit:
+            raise SearchTimeout()
+        if self.deadline and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+    def order_moves(self, moves, ply, best_move=None):
+        '''Sorts moves best first: the previous best move, captures by MVV-LVA, promotions, then killer moves.'''
+        board_state = self.board_state
+        killers = self.killers[ply]
+
+        def score(move):
+            if move == best_move:
+                return 1000000
+            start, end, promotion = move
+            victim = board_state[end[0]][end[1]]
+            attacker = board_state[start[0]][start[1]]
+            if victim:
+                # Most valuable victim first, least valuable attacker breaking ties
+                return 100000 + app.piece_values[victim[1]] * 10 - app.piece_values[attacker[1]]
+            if attacker[1] == 'p' and start[1] != end[1]:
+                return 100000 + app.piece_values['p'] * 10 - app.piece_values['p']  # En passant
+            if promotion:
+                return 90000 + app.piece_values[promotion]
+            if move == killers[0]:
+                return 80000
+            if move == killers[1]:
+                return 70000
+            return 0
+
+        return sorted(moves, key=score, reverse=True)
+
+    def negamax(self, depth, alpha, beta, player, last_move, ply):
+        '''Returns the score of the position for the player to move, searched depth plies deep.'''
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_budget()
+
+        board_state = self.board_state
+        key = app.zobrist_key
+        table_move = None
+        if depth > 0 and self.table:
+            entry = self.table.probe(key)
+            if entry:
+                table_depth, bound, table_score, table_move = entry
+                if table_depth >= depth:
+                    table_score = score_from_table(table_score, ply)
+                    if bound == EXACT:
+                        return max(alpha, min(beta, table_score))
+                    if bound == LOWER_BOUND and table_score >= beta:
+                        return beta
+                    if bound == UPPER_BOUND and table_score <= alpha:
+                        return alpha
+
+        moves = app.generate_legal_moves(board_state, player, last_move)
+        if not moves:
+            # Checkmate (sooner is worse) or stalemate
+            return -MATE_SCORE + ply if app.is_in_check(app.get_king_position(player), board_state) else 0
+        if depth <= 0:
+            return self.quiescence(alpha, beta, player, last_move, ply, moves)
+
+        opponent = 'b' if player == 'w' else 'w'
+        original_alpha = alpha
+        best_move = None
+        for move in self.order_moves(moves, ply, table_move):
+            start, end, promotion = move
+            piece_code = board_state[start[0]][start[1]]
+            is_quiet = board_state[end[0]][end[1]] is None and not promotion
+            undo = app.make_move(board_state, start, end, promotion)
+            try:
+                score = -self.negamax(depth - 1, -beta, -alpha, opponent,
+                                      {'piece_code': piece_code, 'from_position': start, 'to_position': end}, ply + 1)
+            finally:
+                # Also taken back when the budget runs out, so the board is left as it was found
+                app.unmake_move(board_state, undo)
+
+            if score >= beta:
+                if is_quiet and move != self.killers[ply][0]:
+                    self.killers[ply][1] = self.killers[ply][0]
+                    self.killers[ply][0] = move
+                if self.table:
+                    self.table.store(key, depth, LOWER_BOUND, score_to_table(beta, ply), move)
+                return beta
+            if score > alpha:
+                alpha = score
+                best_move = move
+
+        if self.table:
+            if alpha > original_alpha:
+                self.table.store(key, depth, EXACT, score_to_table(alpha, ply), best_move)
+            else:
+                self.table.store(key, depth, UPPER_BOUND, score_to_table(alpha, ply), None)
+        return alpha
+
+    def quiescence(self, alpha, beta, player, last_move, ply, moves):
+        '''Searches captures only until the position is quiet, so the evaluation isn't taken mid-exchange.'''
+        board_state = self.board_state
+        stand_pat = app.evaluate() if player == 'w' else -app.evaluate()
+        if stand_pat >= beta:
+            return beta
+        alpha = max(alpha, stand_pat)
+
+        # Captures as make_move plays them: onto an occupied square, or a pawn changing file (en passant)
+        captures = [move for move in moves if board_state[move[1][0]][move[1][1]] or move[2] == 'q'
+                    or (move[0][1] != move[1][1] and board_state[move[0][0]][move[0][1]][1] == 'p')]
+        opponent = 'b' if player == 'w' else 'w'
+        for move in self.order_moves(captures, ply):
+            start, end, promotion = move
+            piece_code = board_state[start[0]][start[1]]
+            undo = app.make_move(board_state, start, end, promotion)
+            try:
+                self.nodes += 1
+                if self.nodes & 1023 == 0:
+                    self.check_budget()
+                next_move = {'piece_code': piece_code, 'from_position': start, 'to_position': end}
+                replies = app.generate_legal_moves(board_state, opponent, next_move)
+                if replies:
+                    score = -self.quiescence(-beta, -alpha, opponent, next_move, ply + 1, replies)
+                elif app.is_in_check(app.get_king_position(opponent), board_state):
+                    score = MATE_SCORE - ply - 1
+                else:
+                    score = 0
+            finally:
+                app.unmake_move(board_state, undo)
+
+            if score >= beta:
+                return beta
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def search_root(self, depth, player, last_move, moves, best_move):
+        '''Searches every root move depth plies deep, returning the best move and its score.'''
+        board_state = self.board_state
+        opponent = 'b' if player == 'w' else 'w'
+        alpha = -INFINITY
+        best = None
+        for move in self.order_moves(moves, 0, best_move):
+            start, end, promotion = move
+            piece_code = board_state[start[0]][start[1]]
+            undo = app.make_move(board_state, start, end, promotion)
+            try:
+                score = -self.negamax(depth - 1, -INFINITY, -alpha, opponent,
+                                      {'piece_code': piece_code, 'from_position': start, 'to_position': end}, 1)
+            finally:
+                app.unmake_move(board_state, undo)
+            if score > alpha:
+                alpha = score
+                best = move
+        if self.table:
+            self.table.store(app.zobrist_key, depth, EXACT, score_to_table(alpha, 0), best)
+        return best, alpha
+
+
+def find_best_move(board_state, player, last_move, time_limit=None, node_limit=None, max_depth=None):
+    '''Searches the position with iterative deepening and returns the best move and search info.
+
+    The search deepens one ply at a time until the time limit (in seconds),
+    node limit or max_depth is reached, and plays the best move of the last
+    depth it finished. The info dict has the depth reached, score (centipawns
+    for the player to move), nodes searched, time taken, nodes per second and
+    how full the transposition table is in permille.
+    Returns None as the move when the player has no legal moves.
+    '''
+    if time_limit is None and node_limit is None and max_depth is None:
+        time_limit = 3
+    transposition_table.new_search()
+    search = Search(board_state, time_limit, node_limit, transposition_table)
+    start_time = time.perf_counter()
+
+    moves = app.generate_legal_moves(board_state, player, last_move)
+    best_move = moves[0] if moves else None
+    entry = transposition_table.probe(app.zobrist_key)
+    if entry and entry[3] in moves:
+        best_move = entry[3]
+    score = 0
+    depth_reached = 0
+
+    depth = 1
+    while moves and (max_depth is None or depth <= max_depth):
+        try:
+            move, move_score = search.search_root(depth, player, last_move, moves, best_move)
+        except SearchTimeout:
+            break
+        best_move, score, depth_reached = move, move_score, depth
+        # No need to look deeper once a forced mate has been found
+        if abs(score) >= MATE_SCORE - 128:
+            break
+        depth += 1
+
+    elapsed = time.perf_counter() - start_time
+    info = {
+        'depth': depth_reached,
+        'score': score,
+        'nodes': search.nodes,
+        'time': elapsed,
+        'nps': int(search.nodes / elapsed) if elapsed > 0 else 0,
+        'hashfull': transposition_table.hashfull()
+    }
+    return best_move, info
+
+
+def search_position(board_state, player, last_move, moved, time_limit=None, node_limit=None, max_depth=None):
+    '''Loads a copy of the position into app.py's game state and returns find_best_move's result for it.
+
+    For callers that keep their own game state, e.g. the Flask server or
+    app.py's game loop. app.py's game state is put back as it was afterwards.
+    '''
+    saved_state = app.save_state()
+    board_copy = [row[:] for row in board_state]
+    app.load_position(board_copy, player, last_move, dict(moved))
+    try:
+        return find_best_move(board_copy, player, last_move, time_limit, node_limit, max_depth)
+    finally:
+        app.restore_state(saved_state)
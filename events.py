@@ -0,0 +1,99 @@
+# Server-sent events: pushes each game's moves to everyone watching it
+#
+# Every message is serialized once and appended to one shared log, however
+# many subscribers there are; each subscriber keeps its own place in the log
+# and reads everything new in one go. The log only keeps the last few
+# hundred messages: a subscriber that falls further behind than that gets a
+# 'resync' event and its stream ends, so one slow client can't hold up the
+# others or keep messages around for ever.
+import collections
+import itertools
+import json
+import threading
+
+EVENT_BACKLOG = 256
+KEEPALIVE_SECONDS = 15
+
+
+def sse_message(event, data, event_id=None):
+    '''Returns the bytes of one server-sent event, its data encoded as JSON.'''
+    event_line = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{event_line}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+resync_message = sse_message('resync', {})
+keepalive_message = b': keepalive\n\n'
+
+
+class Broadcaster:
+    '''The events of one game and the count of subscribers reading them.
+
+    A subscriber is just the index of the next message it will read, as
+    returned by subscribe and then by each read.
+    '''
+
+    def __init__(self, backlog=EVENT_BACKLOG):
+        self.messages = collections.deque(maxlen=backlog)
+        self.next_index = 0
+        self.subscribers = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.subscribers
+
+    def subscribe(self):
+        '''Adds a subscriber, which will read the messages published from now on, and returns its index.'''
+        with self.condition:
+            self.subscribers += 1
+            return self.next_index
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def publish(self, event, data, event_id=None):
+        '''Sends an event to every subscriber and returns how many there are.'''
+        message = sse_message(event, data, event_id)
+        with self.condition:
+            self.messages.append(message)
+            self.next_index += 1
+            self.condition.notify_all()
+            return self.subscribers
+
+    def close(self):
+        '''Ends every subscription once it has read what was already published, e.g. when the game is deleted.'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def read(self, index, timeout):
+        '''Returns the messages from index on and the index to read from next, waiting up to timeout for one.
+
+        The messages are an empty list if the wait timed out, and None once the
+        broadcaster is closed and everything has been read. A subscriber that
+        has fallen out of the backlog gets the resync message and no next index.
+        '''
+        with self.condition:
+            if index == self.next_index and not self.closed:
+                self.condition.wait(timeout)
+            first_index = self.next_index - len(self.messages)
+            if index < first_index:
+                return [resync_message], None
+            if index == self.next_index:
+                return (None if self.closed else []), index
+            return list(itertools.islice(self.messages, index - first_index, None)), self.next_index
+
+
+def stream(broadcaster, index, first_message=None, keepalive=KEEPALIVE_SECONDS):
+    '''Yields the messages of a subscription until it is closed or dropped, sending a keepalive comment when idle.'''
+    try:
+        if first_message:
+            yield first_message
+        while index is not None:
+            messages, index = broadcaster.read(index, keepalive)
+            if messages is None:
+                return
+            yield b''.join(messages) if messages else keepalive_message
+    finally:
+        broadcaster.unsubscribe()
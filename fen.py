@@ -0,0 +1,154 @@
+# FEN import and export for the 8x8 board lists used by app.py and old.py
+#
+# parse_fen is written for bulk use (test suites run through millions of FENs):
+# ranks and castling fields repeat constantly between positions, so each
+# distinct one is parsed once and looked up after that.
+from app import castling_rights, pieces_moved_from_rights, find_king, is_square_attacked
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+fen_pieces = {
+    'P': 'wp', 'N': 'wn', 'B': 'wb', 'R': 'wr', 'Q': 'wq', 'K': 'wk',
+    'p': 'bp', 'n': 'bn', 'b': 'bb', 'r': 'br', 'q': 'bq', 'k': 'bk'
+}
+piece_letters = {piece: letter for letter, piece in fen_pieces.items()}
+
+# Castling right bit of each FEN letter, as in app.castling_rights
+castling_bits = {'K': 1, 'Q': 2, 'k': 4, 'q': 8}
+
+# Parsed ranks and castling fields, keyed by their text
+rank_rows = {}
+castling_fields = {'-': 0}
+RANK_CACHE_SIZE = 100000
+
+
+def parse_rank(rank):
+    '''Returns the row of piece codes (None for empty squares) described by one rank of a FEN.'''
+    row = rank_rows.get(rank)
+    if row is None:
+        squares = []
+        for char in rank:
+            if char in fen_pieces:
+                squares.append(fen_pieces[char])
+            elif char in '12345678':
+                squares.extend([None] * int(char))
+            else:
+                raise ValueError(f"Invalid FEN: unexpected '{char}' in rank '{rank}'")
+        if len(squares) != 8:
+            raise ValueError(f"Invalid FEN: rank '{rank}' has {len(squares)} squares")
+        row = tuple(squares)
+        if len(rank_rows) < RANK_CACHE_SIZE:
+            rank_rows[rank] = row
+    return list(row)
+
+
+def parse_castling(field):
+    '''Returns the castling rights (as from app.castling_rights) given by a FEN castling field.'''
+    rights = castling_fields.get(field)
+    if rights is None:
+        rights = 0
+        for char in field:
+            if char not in castling_bits:
+                raise ValueError(f"Invalid FEN: unexpected '{char}' in castling field '{field}'")
+            rights |= castling_bits[char]
+        castling_fields[field] = rights
+    return rights
+
+
+def check_setup(board_state, player):
+    '''Raises ValueError if the position can't arise in a game: wrong number of kings,
+    pawns on the first or last rank, or the side not to move in check.'''
+    for color in 'wb':
+        kings = sum(row.count(color + 'k') for row in board_state)
+        if kings != 1:
+            raise ValueError(f"Invalid FEN: {'White' if color == 'w' else 'Black'} has {kings} kings")
+    if any(piece and piece[1] == 'p' for piece in board_state[0] + board_state[7]):
+        raise ValueError("Invalid FEN: pawn on the first or last rank")
+    opponent = 'b' if player == 'w' else 'w'
+    if is_square_attacked(find_king(board_state, opponent), player, board_state):
+        raise ValueError("Invalid FEN: the side not to move is in check")
+
+
+def parse_fen(fen):
+    '''Parses a FEN string.
+
+    Returns (board_state, player, last_move, pieces_moved, halfmove_clock,
+    fullmove_number). An en passant square becomes a last move of a pawn's
+    two-square move over it, and the castling field becomes pieces_moved
+    flags with a lost right marking its rook (or both, the king) as moved.
+    The move counters default to 0 and 1 when the FEN leaves them out.
+    Raises ValueError for a malformed FEN or a position that can't arise in
+    a game (see check_setup).
+    '''
+    fields = fen.split()
+    if len(fields) < 4:
+        raise ValueError(f"Invalid FEN: expected at least 4 fields in '{fen}'")
+    placement, player, castling, en_passant = fields[:4]
+
+    ranks = placement.split('/')
+    if len(ranks) != 8:
+        raise ValueError(f"Invalid FEN: expected 8 ranks in '{placement}'")
+    board_state = [parse_rank(rank) for rank in ranks]
+
+    if player not in ('w', 'b'):
+        raise ValueError(f"Invalid FEN: side to move must be 'w' or 'b', not '{player}'")
+    check_setup(board_state, player)
+
+    moved = pieces_moved_from_rights(parse_castling(castling))
+
+    # An en passant square means the last move was a two-square pawn move over it,
+    # so it is empty with the opponent's pawn on the square beyond it
+    last_move = None
+    if en_passant != '-':
+        if len(en_passant) != 2 or en_passant[0] not in 'abcdefgh' or en_passant[1] != ('6' if player == 'w' else '3'):
+            raise ValueError(f"Invalid FEN: bad en passant square '{en_passant}'")
+        col = ord(en_passant[0]) - ord('a')
+        row, pawn_row, pawn = (2, 3, 'bp') if player == 'w' else (5, 4, 'wp')
+        if board_state[row][col] is not None or board_state[pawn_row][col] != pawn:
+            raise ValueError(f"Invalid FEN: no pawn can be captured en passant on '{en_passant}'")
+        if player == 'b':
+            last_move = {'piece_code': 'wp', 'from_position': (6, col), 'to_position': (4, col)}
+        else:
+            last_move = {'piece_code': 'bp', 'from_position': (1, col), 'to_position': (3, col)}
+
+    try:
+        halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+    except ValueError:
+        raise ValueError(f"Invalid FEN: bad move counters in '{fen}'")
+
+    return board_state, player, last_move, moved, halfmove_clock, fullmove_number
+
+
+def to_fen(board_state, player, last_move=None, moved=None, halfmove_clock=0, fullmove_number=1):
+    '''Returns the FEN string of a position, the inverse of parse_fen.
+
+    The castling rights come from moved (by default app.py's pieces_moved
+    flags), and the en passant square from a two-square pawn last move.
+    '''
+    ranks = []
+    for row in board_state:
+        rank = ''
+        empty = 0
+        for piece in row:
+            if piece is None:
+                empty += 1
+            else:
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece_letters[piece]
+        if empty:
+            rank += str(empty)
+        ranks.append(rank)
+
+    rights = castling_rights(moved)
+    castling = ''.join(letter for letter, bit in castling_bits.items() if rights & bit) or '-'
+
+    en_passant = '-'
+    if last_move and last_move['piece_code'][1] == 'p' and \
+       abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2:
+        row = (last_move['from_position'][0] + last_move['to_position'][0]) // 2
+        en_passant = chr(ord('a') + last_move['to_position'][1]) + str(8 - row)
+
+    return f"{'/'.join(ranks)} {player} {castling} {en_passant} {halfmove_clock} {fullmove_number}"
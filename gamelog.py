@@ -0,0 +1,168 @@
+# Durable storage of a game as an append-only binary log, one file per game
+#
+# The file starts with a 4-byte magic, then holds records:
+#   start     tag 1, version (4 bytes), halfmove clock (2), fullmove number (2),
+#             packed position (33): the game started over from this position
+#   snapshot  tag 2, the same fields: the position the game has reached
+#   move      tag 3, halfmove clock (2), count (1), count pairs of (byte index,
+#             new value) of the packed position, SAN length (1), SAN
+#   takeback  tag 4, version (4 bytes), number of moves taken back (2)
+# A move record holds only the bytes of the packed position (see packed.py)
+# that the move changed, usually 2 or 3, so a move costs about 10 bytes.
+# Every SNAPSHOT_INTERVAL moves the whole position is written again, so a
+# game is recovered by taking its last snapshot and replaying the few move
+# records after it, which needs no rules code at all. Moves taken back to
+# before the last snapshot are followed by a snapshot of the position reached,
+# and moves replayed are logged as moves. A record cut short by a crash is
+# ignored.
+import os
+import struct
+
+from packed import PackedPosition
+
+MAGIC = b'CH50'
+START = 1
+SNAPSHOT = 2
+MOVE = 3
+TAKEBACK = 4
+SNAPSHOT_INTERVAL = 32
+
+position_record = struct.Struct('<BIHH33s')
+move_header = struct.Struct('<BHB')
+takeback_record = struct.Struct('<BIH')
+
+
+def position_bytes(tag, version, halfmove_clock, fullmove_number, position):
+    return position_record.pack(tag, version, halfmove_clock, fullmove_number, position)
+
+
+def move_bytes(before, after, halfmove_clock, san):
+    '''Returns the record of a move from the packed position before to the one after.'''
+    changes = [(index, after[index]) for index in range(33) if before[index] != after[index]]
+    san = san.encode()
+    return move_header.pack(MOVE, halfmove_clock, len(changes)) + \
+        bytes(value for change in changes for value in change) + bytes([len(san)]) + san
+
+
+class GameLog:
+    '''The log file of one game, opened for each append so any number of games can be logged.
+
+    With sync, every append is flushed to disk before it returns.
+    '''
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self.moves_since_snapshot = 0
+
+    def append(self, data):
+        with open(self.path, 'ab') as log_file:
+            if log_file.tell() == 0:
+                log_file.write(MAGIC)
+            log_file.write(data)
+            if self.sync:
+                log_file.flush()
+                os.fsync(log_file.fileno())
+
+    def start(self, game):
+        '''Records that the game has started over from its current position.'''
+        self.moves_since_snapshot = 0
+        self.append(position_bytes(START, game.version, game.halfmove_clock, game.current_move_number, game.history[-1]))
+
+    def snapshot(self, game):
+        self.moves_since_snapshot = 0
+        return position_bytes(SNAPSHOT, game.version, game.halfmove_clock, game.current_move_number, game.history[-1])
+
+    def move(self, game):
+        '''Records the move that took the game to its current position, and a snapshot every SNAPSHOT_INTERVAL moves.'''
+        data = move_bytes(game.history[-2], game.history[-1], game.halfmove_clock, game.moves[-1])
+        self.moves_since_snapshot += 1
+        if self.moves_since_snapshot >= SNAPSHOT_INTERVAL:
+            data += self.snapshot(game)
+        self.append(data)
+
+    def jump(self, game, from_ply):
+        '''Records that moves have been taken back or replayed (see Game.go_to_ply) since the game was at from_ply.'''
+        ply = len(game.moves)
+        if ply < from_ply:
+            data = takeback_record.pack(TAKEBACK, game.version, from_ply - ply)
+            self.moves_since_snapshot -= from_ply - ply
+            if self.moves_since_snapshot < 0:
+                data += self.snapshot(game)
+        else:
+            start = len(game.history) - 1 - (ply - from_ply)
+            data = b''.join(move_bytes(game.history[index - 1], game.history[index], game.clocks[index],
+                                       game.moves[index + game.first_ply - 1])
+                            for index in range(start + 1, len(game.history)))
+            self.moves_since_snapshot += ply - from_ply
+            if self.moves_since_snapshot >= SNAPSHOT_INTERVAL:
+                data += self.snapshot(game)
+        self.append(data)
+
+
+def read_log(path):
+    '''Reads a game log and returns what's needed to restore the game, or None if it holds no game.
+
+    Returns a dict with the positions from the last snapshot on ('history',
+    a list of PackedPosition) and their halfmove clocks, the SAN of every
+    move since the game started, the side to move and the fullmove number at
+    the start, the current fullmove number, and the version the game had
+    after base_ply moves, from which it has gone up by one a move.
+    '''
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    if not data.startswith(MAGIC):
+        return None
+
+    # Moves are only played out on the position from the last snapshot on; before that just their SAN is read
+    game = None
+    replay = []
+    offset = len(MAGIC)
+    while offset < len(data):
+        tag = data[offset]
+        if tag in (START, SNAPSHOT):
+            if offset + position_record.size > len(data):
+                break
+            tag, version, halfmove_clock, fullmove_number, packed = position_record.unpack_from(data, offset)
+            offset += position_record.size
+            if tag == START or game is None:
+                game = {'moves': [], 'first_player': PackedPosition(packed).player, 'first_fullmove': fullmove_number}
+            game.update(position=packed, halfmove_clock=halfmove_clock, fullmove_number=fullmove_number,
+                        base_version=version, base_ply=len(game['moves']))
+            replay = []
+        elif tag == MOVE and game is not None:
+            if offset + move_header.size > len(data):
+                break
+            changes_end = offset + move_header.size + data[offset + 3] * 2
+            if changes_end >= len(data) or changes_end + 1 + data[changes_end] > len(data):
+                break
+            san_end = changes_end + 1 + data[changes_end]
+            game['moves'].append(data[changes_end + 1:san_end].decode())
+            replay.append((offset, changes_end))
+            offset = san_end
+        elif tag == TAKEBACK and game is not None:
+            after = offset + takeback_record.size
+            tag, version, plies = takeback_record.unpack_from(data, offset) if after <= len(data) else (None, 0, 0)
+            # Taking back moves from before the last snapshot needs the snapshot that follows
+            if tag is None or plies > len(replay) and (after + position_record.size > len(data) or data[after] != SNAPSHOT):
+                break
+            del game['moves'][len(game['moves']) - plies:]
+            del replay[max(len(replay) - plies, 0):]
+            game.update(base_version=version, base_ply=len(game['moves']))
+            offset = after
+        else:
+            break
+    if game is None:
+        return None
+
+    position = bytearray(game.pop('position'))
+    history = game['history'] = [PackedPosition(position)]
+    clocks = game['clocks'] = [game.pop('halfmove_clock')]
+    for offset, changes_end in replay:
+        for index in range(offset + move_header.size, changes_end, 2):
+            position[data[index]] = data[index + 1]
+        history.append(PackedPosition(position))
+        clocks.append(move_header.unpack_from(data, offset)[1])
+        if not position[32] & 1:
+            game['fullmove_number'] += 1
+    return game
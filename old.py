@@ -1,5 +1,22 @@
-from flask import Flask, render_template, request, jsonify
-import copy
+from flask import Flask, Response, render_template, request, jsonify, g
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import engine
+from events import sse_message, stream
+from fen import parse_fen, to_fen
+from pgn import plain_san
+from sessions import FileGameStore, MemoryGameStore
+
+from app import zobrist_pieces, zobrist_black_to_move, zobrist_castling, zobrist_en_passant, \
+    castling_rights, castling_squares, knight_targets, king_targets, pawn_attacks, \
+    rook_rays, bishop_rays, is_square_attacked, generate_legal_moves, \
+    piece_square_values, get_taken_pieces, convert_to_square
 
 app = Flask(__name__)
 
@@ -20,171 +37,418 @@ PIECE_TO_SVG = {
     'wp': 'svg/pieces/wp.svg'
 }
 
-# Global variables for the current state of the game
-# Represents the current state of the chessboard
-current_board_state = [
-    ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br'],
-    ['bp'] * 8,
-    [None] * 8,
-    [None] * 8,
-    [None] * 8,
-    [None] * 8,
-    ['wp'] * 8,
-    ['wr', 'wn', 'wb', 'wq', 'wk', 'wb', 'wn', 'wr']
-]
-
-# Stores the initial state of the chessboard for reference
-initial_board_state = copy.deepcopy(current_board_state)
-
-# Tracking the pieces that have been taken during the game
-taken_pieces = {'white': [], 'black': []}
-
-# List of moves made during the game in PGN format
-game_moves = []
-
-# Current move number in the game
-current_move_number = 1
-
-# Flags to track if specific pieces (kings and rooks) have moved, used for castling logic
-pieces_moved = {
-    'wk': False, 'wr1': False, 'wr2': False,
-    'bk': False, 'br1': False, 'br2': False
-}
+# Games being played on this server, each with its own state and lock (see sessions.py).
+# Games idle for GAME_IDLE_TIMEOUT seconds are dropped. With CHESS_DATA_DIR set, every game is
+# also logged to a file there and the games logged there are read back at startup, so they
+# survive a restart; an idle game is then only dropped from memory.
+GAME_IDLE_TIMEOUT = 3600
+GAME_DATA_DIR = os.environ.get('CHESS_DATA_DIR')
+if GAME_DATA_DIR:
+    games = FileGameStore(GAME_DATA_DIR, idle_timeout=GAME_IDLE_TIMEOUT)
+    games.restore_all()
+else:
+    games = MemoryGameStore(idle_timeout=GAME_IDLE_TIMEOUT)
+
+# The routes without a game ID in the URL all play this game, which is started on first use
+DEFAULT_GAME_ID = 'default'
+
+# The engine searches through app.py's module-level game state, so only one search runs at a time
+engine_lock = threading.Lock()
+
+# Memory for the engine's transposition table in each server process, in megabytes
+ENGINE_HASH_MB = 16
+engine.set_hash_size(ENGINE_HASH_MB)
+
+# Logging. CHESS_LOG_LEVEL=DEBUG logs each request's data and response, and with
+# CHESS_TRACE_MOVES=1 as well every piece moved. CHESS_REQUEST_TIMING=1 logs how
+# long each request took. Records are written out by a background thread so
+# requests never wait on stderr.
+log = logging.getLogger('chess50')
+log.setLevel(os.environ.get('CHESS_LOG_LEVEL', 'WARNING').upper())
+timing_log = logging.getLogger('chess50.timing')
+TRACE_MOVES = os.environ.get('CHESS_TRACE_MOVES') == '1' and log.isEnabledFor(logging.DEBUG)
+REQUEST_TIMING = os.environ.get('CHESS_REQUEST_TIMING') == '1'
+
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+log.addHandler(QueueHandler(log_queue))
+log.propagate = False
+
+if REQUEST_TIMING:
+    timing_log.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def log_request_time(response):
+        timing_log.info("%s %s %s %.2fms", request.method, request.path, response.status_code,
+                        (time.perf_counter() - g.request_start) * 1000)
+        return response
 
 # Flask Route Handlers
 
-@app.route('/')
-def home():
-    """Renders the home page."""
-    return render_template('index.html')
+def find_game(game_id):
+    """Returns the game with the ID, or None if it doesn't exist. The default game always exists."""
+    if game_id == DEFAULT_GAME_ID:
+        return games.get_or_create(game_id)
+    return games.get(game_id)
 
-@app.route('/game')
-def game():
-    """Renders the game page with the current board state."""
-    print("Current board state:", current_board_state)
-    return render_template('game.html', board=current_board_state, piece_to_svg=PIECE_TO_SVG, enumerate=enumerate)
+def unknown_game(game_id):
+    """Returns the error response for a game ID that isn't in the store."""
+    return jsonify({'success': False, 'message': f'Unknown game {game_id}'}), 404
 
-@app.route('/record_move', methods=['POST'])
-def record_move():
-    """Handles the recording of a player's move, updates game state."""
-    global current_board_state, taken_pieces, game_moves, current_move_number, last_move
-    data = request.json
-    print("Received move data:", data)
+def not_your_turn(game):
+    """Returns the error response data and status for a move by the side that isn't to move in the game."""
+    return {'success': False, 'message': f"It is {'white' if game.player == 'w' else 'black'}'s turn"}, 400
 
-    from_position = convert_position(data.get('from'))
-    to_position = convert_position(data.get('to'))
-    piece_code = current_board_state[from_position[0]][from_position[1]]
+def stale_version(game, data):
+    """Returns the error response data and status for a move sent with a 'version' other than the game's, or None.
 
-    # Initialize last_move if it does not exist
-    if 'last_move' not in globals():
-        last_move = None
+    A client that gets it back should fetch the game from /sync before moving again.
+    """
+    version = data.get('version')
+    if version is not None and version != game.version:
+        return {'success': False, 'message': 'Stale version, resync', 'resync': True, 'version': game.version}, 409
+    return None
 
-    # Check for invalid move (same square)
-    if from_position == to_position:
-        return jsonify({'success': False, 'message': 'Move to the same square is not allowed'})
+def square_changes(before, after):
+    """Returns the squares that differ between two packed positions of the game, as {'e4': 'wp', 'e2': None}."""
+    return {convert_to_square(position): after.piece_at(position) for position in before.changed_squares(after)}
 
-    if piece_code is None:
-        return jsonify({'success': False, 'message': 'No piece at the source position'})
+def move_delta(game, pgn_move, captured_piece):
+    """Returns what the move just played changed, sent to the game's watchers and as the short response to 'delta' moves."""
+    return {
+        'success': True,
+        'version': game.version,
+        'move': pgn_move,
+        'changes': square_changes(game.history[-2], game.history[-1]),
+        'captured': captured_piece,
+        'evaluation': game.material_score
+    }
+
+@app.route('/')
+def home():
+    """Renders the home page."""
+    return render_template('index.html')
 
-    captured_piece = None
+@app.route('/games', methods=['POST'])
+def create_game():
+    """Starts a new game and returns its ID, which the other routes take as /games/<game_id>/...
 
-    # Castling move detection
-    if piece_code in ['wk', 'bk'] and abs(from_position[1] - to_position[1]) == 2:
+    Takes an optional 'fen' to start from instead of the starting position.
+    """
+    data = request.get_json(silent=True) or {}
+    position = None
+    if data.get('fen'):
         try:
-            rook_col = 7 if to_position[1] > from_position[1] else 0
-            perform_castling((from_position[0], from_position[1]), (from_position[0], rook_col), current_board_state, to_position[1] > from_position[1])
+            position = parse_fen(data['fen'])
         except ValueError as e:
             return jsonify({'success': False, 'message': str(e)})
-    else:
-        # Other moves
-        is_en_passant = False
-        if piece_code[1] == 'p':
-            is_first_move = (piece_code == 'wp' and from_position[0] == 6) or (piece_code == 'bp' and from_position[0] == 1)
-            valid_moves = get_pawn_moves(from_position, current_board_state, is_first_move, last_move)
-            if to_position not in valid_moves:
-                return jsonify({'success': False, 'message': 'Invalid move'})
-            is_en_passant = to_position in [move for move in valid_moves if current_board_state[move[0]][move[1]] is None]
-        else:
-            if not is_legal_move(from_position, to_position, piece_code, current_board_state):
-                return jsonify({'success': False, 'message': 'Invalid move'})
-
-        captured_piece = move_piece(current_board_state, from_position, to_position)
-
-        if is_en_passant:
-            captured_pawn_row = from_position[0]
-            captured_pawn_col = to_position[1]
-            captured_piece = current_board_state[captured_pawn_row][captured_pawn_col]
-            current_board_state[captured_pawn_row][captured_pawn_col] = None
-
-        if captured_piece and captured_piece != piece_code:
-            color = 'white' if captured_piece[0] == 'b' else 'black'
-            taken_pieces[color].append(captured_piece)
-
-    pgn_move = convert_to_pgn(data.get('from'), data.get('to'), piece_code, captured_piece is not None)
-
-    if len(game_moves) == 0 or len(game_moves[-1].split(' ')) == 3:
-        game_moves.append(f"{current_move_number}. {pgn_move}")
-    else:
-        game_moves[-1] += f" {pgn_move}"
-        current_move_number += 1
-
-    last_move = {
-        'from_position': from_position,
-        'to_position': to_position,
-        'piece_code': piece_code
-    }
-
-    # Calculate the taken pieces after the move
-    taken_pieces = calculate_taken_pieces()
-
-    response_data = {
-        'success': True,
-        'message': 'Move recorded',
-        'newBoardState': current_board_state,
-        'takenPieces': taken_pieces,
-        'gameMoves': ' '.join(game_moves)
-    }
-
-    print("Sending response data:", response_data)
-    return jsonify(response_data)
+    game = games.create()
+    if position:
+        with game.lock:
+            game.load(*position)
+    return jsonify({'success': True, 'gameId': game.game_id, 'newBoardState': game.board_state})
+
+@app.route('/games/<game_id>', methods=['DELETE'])
+def delete_game(game_id):
+    """Ends a game and frees its state."""
+    if not games.delete(game_id):
+        return unknown_game(game_id)
+    return jsonify({'success': True, 'message': 'Game deleted'})
+
+@app.route('/game', defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>')
+def game(game_id):
+    """Renders the game page with the current board state."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    with game.lock:
+        log.debug("Game %s board: %s", game.game_id, game.board_state)
+        return render_template('game.html', board=game.board_state, piece_to_svg=PIECE_TO_SVG, enumerate=enumerate,
+                               game_id=game.game_id)
+
+@app.route('/record_move', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/record_move', methods=['POST'])
+def record_move(game_id):
+    """Handles the recording of a player's move, updates game state."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    data = request.json
+    log.debug("Game %s received move: %s", game_id, data)
+    response_data, status = play_move(game, data)
+    return jsonify(response_data), status
 
 
-@app.route('/reset_game', methods=['POST'])
-def reset_game():
+@app.route('/reset_game', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/reset_game', methods=['POST'])
+def reset_game(game_id):
     """Resets the game to its initial state."""
-    global current_board_state, taken_pieces, game_moves, current_move_number, pieces_moved
-
-    current_board_state = [
-        ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br'],
-        ['bp'] * 8,
-        [None] * 8,
-        [None] * 8,
-        [None] * 8,
-        [None] * 8,
-        ['wp'] * 8,
-        ['wr', 'wn', 'wb', 'wq', 'wk', 'wb', 'wn', 'wr']
-    ]
-    taken_pieces = {'white': [], 'black': []}
-    game_moves = []
-    current_move_number = 1
-
-    pieces_moved = {
-        'wk': False, 'wr1': False, 'wr2': False,
-        'bk': False, 'br1': False, 'br2': False
-    }
-
-    print("Game reset")  # For debugging
-    return jsonify({'success': True, 'message': 'Game reset', 'newBoardState': current_board_state, 'gameMoves': ' '.join(game_moves)})
-
-
-@app.route('/attempt_castle', methods=['POST'])
-def attempt_castle():
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+
+    response_data, status = reset(game)
+    return jsonify(response_data), status
+
+
+@app.route('/take_back_move', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/take_back_move', methods=['POST'])
+def take_back_move(game_id):
+    """Takes back the last move, or the last 'plies' moves."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    response_data, status = navigate(game, request.get_json(silent=True) or {}, -1)
+    return jsonify(response_data), status
+
+
+@app.route('/redo_move', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/redo_move', methods=['POST'])
+def redo_move(game_id):
+    """Plays the last move taken back again, or the next 'plies' of them."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    response_data, status = navigate(game, request.get_json(silent=True) or {}, 1)
+    return jsonify(response_data), status
+
+
+@app.route('/go_to_ply', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/go_to_ply', methods=['POST'])
+def go_to_ply(game_id):
+    """Takes back or plays again moves until the request's 'ply' moves have been played since the start."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    response_data, status = navigate(game, request.get_json(silent=True) or {})
+    return jsonify(response_data), status
+
+
+@app.route('/attempt_castle', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/attempt_castle', methods=['POST'])
+def attempt_castle(game_id):
     """Handles a player's attempt to castle."""
-    global current_board_state, game_moves, current_move_number
-    data = request.json
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    response_data, status = play_castle(game, request.json)
+    return jsonify(response_data), status
+
+
+@app.route('/engine_move', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/engine_move', methods=['POST'])
+def engine_move(game_id):
+    """Searches the current position and returns the computer's move for the side to move.
+
+    Takes an optional 'timeLimit' (seconds, default 3) or 'nodeLimit' and
+    'player' ('w' or 'b', by default the side to move).
+    The move isn't played; post it to /record_move like any other move.
+    """
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    response_data, status = search_move(game, request.get_json(silent=True) or {})
+    return jsonify(response_data), status
+
+
+@app.route('/load_fen', methods=['POST'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/load_fen', methods=['POST'])
+def load_fen(game_id):
+    """Sets the game up from the position in the request's 'fen', clearing its moves."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    try:
+        position = parse_fen(request.json.get('fen', ''))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+    with game.lock:
+        game.load(*position)
+        game.events.publish('reset', {'version': game.version}, game.version)
+        return jsonify({'success': True, 'message': 'Position loaded', 'newBoardState': game.board_state,
+                        'takenPieces': game.taken_pieces, 'gameMoves': ' '.join(game.game_moves),
+                        'version': game.version})
+
+
+@app.route('/get_fen', methods=['GET'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/get_fen', methods=['GET'])
+def get_fen(game_id):
+    """Returns the game's current position as a FEN."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    with game.lock:
+        return jsonify({'success': True, 'fen': to_fen(game.board_state, game.player, game.last_move, game.pieces_moved,
+                                                        game.halfmove_clock, game.current_move_number)})
+
+
+@app.route('/sync', methods=['GET'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/sync', methods=['GET'])
+def sync(game_id):
+    """Brings a client at the version in the query string up to date.
+
+    If the game hasn't been reset, loaded or taken back since that version,
+    only the changed squares and the SAN moves since are sent, otherwise the
+    whole board and move list.
+    """
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    version = request.args.get('version', type=int)
+
+    with game.lock:
+        position = game.position_at(version) if version is not None else None
+        if position is None:
+            return jsonify({'success': True, 'full': True, 'version': game.version, 'newBoardState': game.board_state,
+                            'takenPieces': game.taken_pieces, 'evaluation': game.material_score,
+                            'gameMoves': ' '.join(game.game_moves)})
+        return jsonify({'success': True, 'full': False, 'version': game.version,
+                        'changes': square_changes(position, game.history[-1]),
+                        'moves': game.moves_since(version),
+                        'takenPieces': game.taken_pieces, 'evaluation': game.material_score})
+
+
+@app.route('/events', methods=['GET'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/events', methods=['GET'])
+def game_events(game_id):
+    """Streams the game as server-sent events, instead of polling /get_current_board.
+
+    The stream starts with a 'hello' event holding the game's version, then
+    sends a 'move' event (the same data as a 'delta' move response) for every
+    move and a 'reset' event when the game is reset or loaded or moves are
+    taken back or played again. After 'reset',
+    or a 'hello' with a version the client doesn't have, fetch /sync. A
+    client that falls too far behind gets 'resync' and the stream ends.
+    """
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    with game.lock:
+        subscriber = game.events.subscribe()
+        hello = sse_message('hello', {'version': game.version}, game.version)
+    return Response(stream(game.events, subscriber, hello), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/get_current_board', methods=['GET'], defaults={'game_id': DEFAULT_GAME_ID})
+@app.route('/games/<game_id>/get_current_board', methods=['GET'])
+def get_current_board(game_id):
+    """Returns the current state of the chessboard."""
+    game = find_game(game_id)
+    if game is None:
+        return unknown_game(game_id)
+    response_data, status = current_board(game)
+    return jsonify(response_data), status
+
+
+# Request handling shared by the Flask routes and the async server in asgi.py. Each takes
+# the game and the request's JSON data and returns the response data and HTTP status.
+
+def play_move(game, data):
+    """Plays the move in a request's data on the game and returns the response data and status."""
+    with game.lock:
+        stale = stale_version(game, data)
+        if stale:
+            return stale
+        board_state = game.board_state
+        from_position = convert_position(data.get('from'))
+        to_position = convert_position(data.get('to'))
+        piece_code = board_state[from_position[0]][from_position[1]]
+
+        # Check for invalid move (same square)
+        if from_position == to_position:
+            return {'success': False, 'message': 'Move to the same square is not allowed'}, 200
+
+        if piece_code is None:
+            return {'success': False, 'message': 'No piece at the source position'}, 200
+
+        if piece_code[0] != game.player:
+            return not_your_turn(game)
+
+        captured_piece = None
+        pgn_move = None
+
+        # Castling move detection
+        if piece_code in ['wk', 'bk'] and abs(from_position[1] - to_position[1]) == 2:
+            try:
+                rook_col = 7 if to_position[1] > from_position[1] else 0
+                perform_castling(game, (from_position[0], from_position[1]), (from_position[0], rook_col), to_position[1] > from_position[1])
+            except ValueError as e:
+                return {'success': False, 'message': str(e)}, 200
+            pgn_move = 'O-O' if to_position[1] > from_position[1] else 'O-O-O'
+        else:
+            # Other moves, pawns included, must be in the position's legal moves, which
+            # are generated once and also used to write the move's SAN
+            moves = legal_moves(game)
+            if not any(move[0] == from_position and move[1] == to_position for move in moves):
+                return {'success': False, 'message': 'Invalid move'}, 200
+            is_en_passant = piece_code[1] == 'p' and from_position[1] != to_position[1] and \
+                board_state[to_position[0]][to_position[1]] is None
+
+            # A pawn reaching the last rank is promoted, to a queen unless the request names another piece
+            promotion = None
+            if piece_code[1] == 'p' and to_position[0] in (0, 7):
+                promotion = str(data.get('promotion') or 'q').lower()
+                if promotion not in ('q', 'r', 'b', 'n'):
+                    return {'success': False, 'message': 'Invalid promotion piece'}, 200
+
+            pgn_move = convert_to_pgn(game, from_position, to_position, promotion, moves)
+            captured_piece = move_piece(game, from_position, to_position, promotion)
+
+            if is_en_passant:
+                captured_pawn_row = from_position[0]
+                captured_pawn_col = to_position[1]
+                captured_piece = board_state[captured_pawn_row][captured_pawn_col]
+                board_state[captured_pawn_row][captured_pawn_col] = None
+                if captured_piece:
+                    update_zobrist_key(game, captured_piece, captured_pawn_row, captured_pawn_col)
+                    update_material(game, captured_piece, captured_pawn_row, captured_pawn_col, -1)
+
+        game.last_move = {
+            'from_position': from_position,
+            'to_position': to_position,
+            'piece_code': piece_code
+        }
+        game.player = 'b' if piece_code[0] == 'w' else 'w'
+        game.halfmove_clock = 0 if piece_code[1] == 'p' or captured_piece else game.halfmove_clock + 1
+        pgn_move += check_marker(game)
+        game.add_move(pgn_move)
+
+        # Calculate the taken pieces after the move
+        game.taken_pieces = calculate_taken_pieces(game)
+
+        delta = move_delta(game, pgn_move, captured_piece)
+        game.events.publish('move', delta, game.version)
+        if data.get('delta'):
+            return delta, 200
+
+        response_data = {
+            'success': True,
+            'message': 'Move recorded',
+            'version': game.version,
+            'newBoardState': board_state,
+            'takenPieces': game.taken_pieces,
+            'evaluation': game.material_score,
+            'gameMoves': ' '.join(game.game_moves)
+        }
+
+        log.debug("Game %s response: %s", game.game_id, response_data)
+        return response_data, 200
+
+def play_castle(game, data):
+    """Castles as asked in a request's data and returns the response data and status."""
     from_position = data.get('from')
     to_position = data.get('to')
-    piece_code = data.get('piece')
 
     # Convert positions from algebraic notation to row and column indices
     from_row, from_col = convert_position(from_position)
@@ -197,228 +461,143 @@ def attempt_castle():
     rook_col = 7 if is_kingside else 0
     rook_position = (from_row, rook_col)
 
-    try:
-        # Perform the castling move
-        updated_board_state = perform_castling((from_row, from_col), rook_position, current_board_state, is_kingside)
-
-        # Update the board state after successful castling
-        current_board_state = updated_board_state
-
-        # Construct PGN notation for the castling move
-        castling_notation = 'O-O' if is_kingside else 'O-O-O'
-        pgn_move = f"{castling_notation}"
-
-        # Record the move
-        if piece_code.startswith('w'):
-            game_moves.append(f"{current_move_number}. {pgn_move}")
-        else:
-            game_moves[-1] += f" {pgn_move}"
-            current_move_number += 1
-
-        return jsonify({'success': True, 'newBoardState': current_board_state, 'gameMoves': ' '.join(game_moves)})
-    except ValueError as e:
-        return jsonify({'success': False, 'message': str(e)})
-
-
-@app.route('/get_current_board', methods=['GET'])
-def get_current_board():
-    """Returns the current state of the chessboard."""
-    return jsonify(current_board_state)
-
-
-# Game Logic Functions
-
-def store_initial_board_state():
-    """Stores the initial state of the chessboard for reference throughout the game."""
-    global initial_board_state
-    initial_board_state = copy.deepcopy(current_board_state)
-
-def count_pieces(board_state):
-    """Counts the number of each piece on the board."""
-    piece_count = {'wp': 0, 'bp': 0, 'wn': 0, 'bn': 0, 'wb': 0, 'bb': 0, 'wr': 0, 'br': 0, 'wq': 0, 'bq': 0, 'wk': 0, 'bk': 0}
-
-    for row in board_state:
-        for piece in row:
-            if piece:
-                piece_count[piece] += 1
-
-    return piece_count
-
-def calculate_taken_pieces():
-    '''Calculates the pieces that have been taken from the game.'''
-    initial_counts = count_pieces(initial_board_state)
-    current_counts = count_pieces(current_board_state)
-
-    taken_pieces = {'white': [], 'black': []}
-
-    for piece, count in initial_counts.items():
-        taken_count = count - current_counts[piece]
-        for _ in range(taken_count):
-            color = 'white' if piece.startswith('b') else 'black'
-            taken_pieces[color].append(piece)
-
-    return taken_pieces
-
-# Piece movement functions
-
-def get_pawn_moves(start_position, board_state, is_first_move, last_move):
-    '''Returns a list of valid moves for a pawn given the current board state.'''
-    moves = []
-    direction = -1 if board_state[start_position[0]][start_position[1]].startswith('w') else 1
-    row, col = start_position
-
-    print(f"Starting Position: {start_position}, Direction: {direction}")
-
-    # Forward move
-    forward_row = row + direction
-    if 0 <= forward_row < 8 and board_state[forward_row][col] is None:
-        moves.append((forward_row, col))
-        print(f"Forward Move Added: {(forward_row, col)}")
-        if is_first_move:
-            double_forward_row = forward_row + direction
-            if 0 <= double_forward_row < 8 and board_state[double_forward_row][col] is None:
-                moves.append((double_forward_row, col))
-                print(f"Double Forward Move Added: {(double_forward_row, col)}")
-
-    # Diagonal captures including en passant
-    for diagonal_col in [col - 1, col + 1]:
-        if 0 <= diagonal_col < 8:
-            diagonal_row = row + direction
-            target_piece = board_state[diagonal_row][diagonal_col]
-
-            if target_piece and target_piece[0] != board_state[row][col][0]:
-                moves.append((diagonal_row, diagonal_col))
-                print(f"Regular Capture Move Added: {(diagonal_row, diagonal_col)}")
-
-            elif not target_piece and last_move:
-                print(f"Checking En Passant at Diagonal: {(diagonal_row, diagonal_col)}")
-                # Adjusted Conditions for En Passant
-                condition_1 = last_move and last_move['piece_code'][1] == 'p' and abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2
-                condition_2 = abs(last_move['to_position'][1] - col) == 1  # Adjacent column
-                condition_3 = (direction == -1 and row == 3) or (direction == 1 and row == 4)
-                condition_4 = abs(diagonal_col - col) == 1  # Diagonal to adjacent column
-                condition_5 = diagonal_col == last_move['to_position'][1]  # Diagonal towards last move's pawn
-
-                print(f"Last Move Data: {last_move}")
-                print(f"Condition 1 (Last move was a two-square advance): {condition_1}")
-                print(f"Condition 2 (Last move pawn is in the same column as current pawn's start): {condition_2}")
-                print(f"Condition 3 (Pawn is in correct row for en passant): {condition_3}")
-                print(f"Condition 4 (Diagonal move is to adjacent column): {condition_4}")
-                print(f"Condition 5 (Diagonal move is towards last move's pawn): {condition_5}")
-
-                if condition_1 and condition_2 and condition_3 and condition_4 and condition_5:
-                    en_passant_capture_row = row  # The row of the captured pawn
-                    en_passant_capture_col = diagonal_col  # The column of the captured pawn
-                    board_state[en_passant_capture_row][en_passant_capture_col] = None  # Remove the captured pawn
-                    moves.append((diagonal_row, diagonal_col))  # Add en passant move
-                    print(f"En Passant Move Added: {(en_passant_capture_row, en_passant_capture_col)}")
-                else:
-                    print("En Passant Conditions Not Met")
-
-    print(f"Final Move List: {moves}")
-    return moves
-
-def get_knight_moves(start_position, board_state):
-    '''Returns a list of valid moves for a knight given the current board state.'''
-    moves = []
-    directions = [(1, 2), (1, -2), (-1, 2), (-1, -2), (2, 1), (2, -1), (-2, 1), (-2, -1)]
-    start_piece = board_state[start_position[0]][start_position[1]]
-
-    for direction in directions:
-        row = start_position[0] + direction[0]
-        col = start_position[1] + direction[1]
-
-        if 0 <= row < 8 and 0 <= col < 8:
-            target_piece = board_state[row][col]
-            if target_piece is None or target_piece[0] != start_piece[0]:
-                moves.append((row, col))
-    return moves
-
-def get_bishop_moves(start_position, board_state):
-    '''Returns a list of valid moves for a bishop given the current board state.'''
-    moves = []
-    directions = [(1, 1), (1, -1), (-1, -1), (-1, 1)]  # diagonal directions
-    start_piece = board_state[start_position[0]][start_position[1]]
-
-    for direction in directions:
-        for i in range(1, 8):
-            row = start_position[0] + direction[0] * i
-            col = start_position[1] + direction[1] * i
-
-            if not (0 <= row < 8 and 0 <= col < 8):
-                break
-
-            target_piece = board_state[row][col]
-            if target_piece is None:
-                moves.append((row, col))
-            else:
-                if target_piece[0] != start_piece[0]:
-                    moves.append((row, col))
-                break
-    return moves
-
-def get_rook_moves(start_position, board_state):
-    '''Returns a list of valid moves for a rook given the current board state.'''
-    moves = []
-    directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]  # down, up, right, left
-    start_piece = board_state[start_position[0]][start_position[1]]
-
-    for direction in directions:
-        for i in range(1, 8):
-            row = start_position[0] + direction[0] * i
-            col = start_position[1] + direction[1] * i
-
-            if not (0 <= row < 8 and 0 <= col < 8):
-                break
-
-            target_piece = board_state[row][col]
-            if target_piece is None:
-                moves.append((row, col))
+    with game.lock:
+        stale = stale_version(game, data)
+        if stale:
+            return stale
+        try:
+            # Perform the castling move, which raises ValueError before changing anything if it isn't allowed
+            piece_code = game.board_state[from_row][from_col]
+            if piece_code and piece_code[0] != game.player:
+                return not_your_turn(game)
+            perform_castling(game, (from_row, from_col), rook_position, is_kingside)
+            pgn_move = 'O-O' if is_kingside else 'O-O-O'
+
+            game.last_move = {
+                'from_position': (from_row, from_col),
+                'to_position': (to_row, to_col),
+                'piece_code': piece_code
+            }
+            game.player = 'b' if piece_code.startswith('w') else 'w'
+            game.halfmove_clock += 1
+            pgn_move += check_marker(game)
+            game.add_move(pgn_move)
+
+            delta = move_delta(game, pgn_move, None)
+            game.events.publish('move', delta, game.version)
+            if data.get('delta'):
+                return delta, 200
+            return {'success': True, 'newBoardState': game.board_state, 'gameMoves': ' '.join(game.game_moves),
+                    'version': game.version}, 200
+        except ValueError as e:
+            return {'success': False, 'message': str(e)}, 200
+
+def reset(game):
+    """Resets the game to its initial state and returns the response data and status."""
+    with game.lock:
+        game.reset()
+        game.events.publish('reset', {'version': game.version}, game.version)
+
+        log.debug("Game %s reset", game.game_id)
+        return {'success': True, 'message': 'Game reset', 'newBoardState': game.board_state, 'gameMoves': ' '.join(game.game_moves),
+                'version': game.version}, 200
+
+def navigate(game, data, direction=None):
+    """Takes back or plays again moves as asked in a request's data and returns the response data and status.
+
+    Goes to the data's 'ply', the number of moves since the game was started
+    or loaded, or with a direction of -1 or 1, back or forward by the data's
+    'plies' (by default 1) from the current ply.
+    """
+    with game.lock:
+        stale = stale_version(game, data)
+        if stale:
+            return stale
+        try:
+            if direction is None:
+                ply = int(data['ply'])
             else:
-                if target_piece[0] != start_piece[0]:  # Capture if it's an opponent's piece
-                    moves.append((row, col))
-                break
-    return moves
-
-def get_queen_moves(start_position, board_state):
-    '''Returns a list of valid moves for a queen given the current board state.'''
-    # Combine the moves of a rook and a bishop
-    return get_rook_moves(start_position, board_state) + get_bishop_moves(start_position, board_state)
-
-
-def get_king_moves(start_position, board_state):
-    '''Returns a list of valid moves for a king given the current board state.'''
-    moves = []
-    directions = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, -1), (-1, 1)]
-    start_piece = board_state[start_position[0]][start_position[1]]
-
-    for direction in directions:
-        row = start_position[0] + direction[0]
-        col = start_position[1] + direction[1]
+                ply = len(game.moves) + direction * int(data.get('plies', 1))
+        except (KeyError, TypeError, ValueError):
+            return {'success': False, 'message': "Missing or invalid 'ply'" if direction is None else "Invalid 'plies'"}, 200
+        if not game.go_to_ply(ply):
+            return {'success': False, 'message': f'No move to go to at ply {ply}'}, 200
+        game.events.publish('reset', {'version': game.version}, game.version)
+
+        log.debug("Game %s went to ply %s", game.game_id, ply)
+        return {'success': True, 'ply': ply, 'newBoardState': game.board_state, 'takenPieces': game.taken_pieces,
+                'evaluation': game.material_score, 'gameMoves': ' '.join(game.game_moves),
+                'redoMoves': len(game.redo), 'version': game.version}, 200
+
+def search_move(game, data):
+    """Searches the game's position with the limits in a request's data and returns the response data and status."""
+    time_limit, node_limit = search_limits(data)
+
+    # Always take the game's lock before the engine's
+    with game.lock:
+        player = data.get('player') or game.player
+        with engine_lock:
+            move, info = engine.search_position(game.board_state, player, game.last_move, game.pieces_moved,
+                                                time_limit=time_limit, node_limit=node_limit)
+    return search_response(move, info)
+
+def search_limits(data):
+    """Returns the time limit and node limit of a search request, 3 seconds if it gives neither."""
+    time_limit = data.get('timeLimit')
+    node_limit = data.get('nodeLimit')
+    if time_limit is None and node_limit is None:
+        time_limit = 3
+    return time_limit, node_limit
+
+def search_response(move, info):
+    """Returns the response data and status for the result of a search."""
+    if move is None:
+        return {'success': False, 'message': 'No legal moves'}, 200
+
+    from_position, to_position, promotion = move
+    return {
+        'success': True,
+        'from': convert_to_square(from_position),
+        'to': convert_to_square(to_position),
+        'promotion': promotion,
+        'depth': info['depth'],
+        'score': info['score'],
+        'nodes': info['nodes'],
+        'time': info['time'],
+        'nps': info['nps'],
+        'hashfull': info['hashfull']
+    }, 200
+
+def current_board(game):
+    """Returns the game's board as of its last move, and the status.
+
+    Reads the last position of the game's history rather than taking the
+    game's lock, so it never waits on a move being played or a search.
+    """
+    return game.history[-1].unpack()[0], 200
 
-        if 0 <= row < 8 and 0 <= col < 8:
-            target_piece = board_state[row][col]
-            if target_piece is None or target_piece[0] != start_piece[0]:
-                moves.append((row, col))
-    return moves
 
+# Game Logic Functions
 
+def calculate_taken_pieces(game):
+    '''Returns the pieces that have been taken from the game, from the piece counts kept by move_piece.'''
+    return get_taken_pieces(game.piece_counts)
 
-def is_move_valid(start_position, end_position, board_state):
-    '''Returns True if the move is valid, False otherwise.'''
-    piece = board_state[start_position[0]][start_position[1]]
-    temp_board = copy.deepcopy(board_state)
-    move_piece(temp_board, start_position, end_position)
-    king_position = find_king(temp_board, piece[0])
-    return not is_in_check(king_position, temp_board)
+def evaluate(game):
+    '''Returns the material and piece-square score of the game's position, positive when white is better.'''
+    return game.material_score
 
+def move_piece(game, from_index, to_index, promotion=None):
+    '''Moves a piece from the from_index to the to_index on the game's board.
 
-def move_piece(board, from_index, to_index):
-    '''Moves a piece from the from_index to the to_index on the board.'''
-    global pieces_moved
+    A pawn reaching the last rank becomes the promotion piece ('q', 'r', 'b'
+    or 'n') if one is given, and stays a pawn otherwise.
+    '''
+    board = game.board_state
+    pieces_moved = game.pieces_moved
 
-    # Print the move details
-    print(f"Moving from {from_index} to {to_index}")
+    if TRACE_MOVES:
+        log.debug("Moving from %s to %s", from_index, to_index)
 
     piece = board[from_index[0]][from_index[1]]
     captured_piece = board[to_index[0]][to_index[1]]
@@ -426,47 +605,62 @@ def move_piece(board, from_index, to_index):
     board[from_index[0]][from_index[1]] = None
     board[to_index[0]][to_index[1]] = piece
 
-    # Update pieces_moved flag for kings and rooks
-    if piece in ['wk', 'wr', 'bk', 'br']:
-        if piece in ['wk', 'bk']:  # Kings
-            pieces_moved[piece] = True
-        elif piece in ['wr', 'br']:  # Rooks
-            rook_index = '1' if from_index[1] == 0 else '2'
-            pieces_moved[piece + rook_index] = True
-
+    # Update the material counts and evaluation score
+    values = piece_square_values[piece]
+    game.material_score += values[to_index[0]][to_index[1]] - values[from_index[0]][from_index[1]]
+    if captured_piece:
+        game.material_score -= piece_square_values[captured_piece][to_index[0]][to_index[1]]
+        game.piece_counts[captured_piece] -= 1
+
+    # Update the Zobrist key for the moved and captured pieces and the other side to move
+    key = game.zobrist_key ^ zobrist_black_to_move
+    key ^= zobrist_pieces[piece][from_index[0]][from_index[1]] ^ zobrist_pieces[piece][to_index[0]][to_index[1]]
+    if captured_piece:
+        key ^= zobrist_pieces[captured_piece][to_index[0]][to_index[1]]
+
+    # Swap the pawn for the piece it is promoted to
+    if promotion and piece[1] == 'p' and to_index[0] in (0, 7):
+        promoted_piece = piece[0] + promotion
+        board[to_index[0]][to_index[1]] = promoted_piece
+        game.material_score += piece_square_values[promoted_piece][to_index[0]][to_index[1]] - values[to_index[0]][to_index[1]]
+        game.piece_counts[piece] -= 1
+        game.piece_counts[promoted_piece] += 1
+        key ^= zobrist_pieces[piece][to_index[0]][to_index[1]] ^ zobrist_pieces[promoted_piece][to_index[0]][to_index[1]]
+
+    # Only a pawn that has just moved two squares can be captured en passant
+    if game.en_passant_file is not None:
+        key ^= zobrist_en_passant[game.en_passant_file]
+        game.en_passant_file = None
+    if piece[1] == 'p' and abs(from_index[0] - to_index[0]) == 2:
+        game.en_passant_file = to_index[1]
+        key ^= zobrist_en_passant[game.en_passant_file]
+
+    # Update pieces_moved flags when a king or rook leaves its starting square,
+    # or a rook is captured on it
+    if from_index in castling_squares or to_index in castling_squares:
+        key ^= zobrist_castling[castling_rights(pieces_moved)]
+        if from_index in castling_squares:
+            pieces_moved[castling_squares[from_index]] = True
+        if to_index in castling_squares:
+            pieces_moved[castling_squares[to_index]] = True
+        key ^= zobrist_castling[castling_rights(pieces_moved)]
+
+    game.zobrist_key = key
     return captured_piece
 
-# Game Logic
-def is_legal_move(start_position, end_position, piece_code, board_state):
-    '''Returns True if the move is legal, False otherwise.'''
-
-    # Determine valid moves based on the piece type
-    valid_moves = []
-    if piece_code[1] == 'p':
-        valid_moves = get_pawn_moves(from_position, current_board_state, is_first_move, last_move)
-    elif piece_code[1] == 'r':
-        valid_moves = get_rook_moves(start_position, board_state)
-    elif piece_code[1] == 'n':
-        valid_moves = get_knight_moves(start_position, board_state)
-    elif piece_code[1] == 'b':
-        valid_moves = get_bishop_moves(start_position, board_state)
-    elif piece_code[1] == 'q':
-        valid_moves = get_queen_moves(start_position, board_state)
-    elif piece_code[1] == 'k':
-        valid_moves = get_king_moves(start_position, board_state)
-
-    # Check if the end position is within valid moves
-    if end_position not in valid_moves:
-        return False
+def update_zobrist_key(game, piece, row, col):
+    '''XORs a piece on a square in or out of the game's Zobrist key, for board changes made outside move_piece.'''
+    game.zobrist_key ^= zobrist_pieces[piece][row][col]
 
-    # Make a temporary move and check for check
-    temp_board = copy.deepcopy(board_state)
-    move_piece(temp_board, start_position, end_position)
-    king_position = find_king(temp_board, piece_code[0])
-    if is_in_check(king_position, temp_board):
-        return False
+def update_material(game, piece, row, col, count):
+    '''Adds count (1 or -1) of a piece on a square to the game's piece counts and score, for board changes made outside move_piece.'''
+    game.piece_counts[piece] += count
+    game.material_score += count * piece_square_values[piece][row][col]
 
-    return True
+# Game Logic
+def legal_moves(game):
+    '''Returns the legal moves of the side to move in the game, castling included, as (from_position, to_position, promotion) tuples.'''
+    return generate_legal_moves(game.board_state, game.player, game.last_move, game.pieces_moved)
 
 
 def is_in_check(king_position, board_state):
@@ -475,41 +669,42 @@ def is_in_check(king_position, board_state):
     king_piece = board_state[king_row][king_col]
     opponent = 'b' if king_piece[0] == 'w' else 'w'
 
-    # Directions for rooks, bishops, and queens
-    directions = [(1, 0), (0, 1), (-1, 0), (0, -1),  # Rook moves
-                  (1, 1), (1, -1), (-1, -1), (-1, 1)]  # Bishop moves
-
-    # Check for threats from rooks, bishops, and queens
-    for d_row, d_col in directions:
-        r, c = king_row, king_col
-        while 0 <= r < 8 and 0 <= c < 8:
-            r, c = r + d_row, c + d_col
-            if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c]:
-                if board_state[r][c][0] == opponent:
-                    if (abs(d_row) + abs(d_col) == 1 and board_state[r][c][1] in ['r', 'q']) or \
-                       (abs(d_row) + abs(d_col) == 2 and board_state[r][c][1] in ['b', 'q']):
-                        return True
+    # Check for threats from rooks and queens along the ranks and files,
+    # the first piece on each ray is the only one that can attack
+    for ray in rook_rays[king_row][king_col]:
+        for r, c in ray:
+            piece = board_state[r][c]
+            if piece:
+                if piece[0] == opponent and piece[1] in 'rq':
+                    return True
+                break
+
+    # Check for threats from bishops and queens along the diagonals
+    for ray in bishop_rays[king_row][king_col]:
+        for r, c in ray:
+            piece = board_state[r][c]
+            if piece:
+                if piece[0] == opponent and piece[1] in 'bq':
+                    return True
                 break
 
     # Check for threats from knights
-    knight_moves = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
-    for d_row, d_col in knight_moves:
-        r, c = king_row + d_row, king_col + d_col
-        if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c] and board_state[r][c] == opponent + 'n':
+    knight = opponent + 'n'
+    for r, c in knight_targets[king_row][king_col]:
+        if board_state[r][c] == knight:
             return True
 
-    # Check for threats from pawns
-    pawn_directions = [(-1, -1), (-1, 1)] if opponent == 'w' else [(1, -1), (1, 1)]
-    for d_row, d_col in pawn_directions:
-        r, c = king_row + d_row, king_col + d_col
-        if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c] and board_state[r][c] == opponent + 'p':
+    # Check for threats from pawns, an enemy pawn attacks the king from
+    # a square the king's own pawns would attack from the king's square
+    pawn = opponent + 'p'
+    for r, c in pawn_attacks[king_piece[0]][king_row][king_col]:
+        if board_state[r][c] == pawn:
             return True
 
     # Check for threats from the enemy king (not common but possible in some cases)
-    king_moves = [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (1, -1), (-1, -1), (-1, 1)]
-    for d_row, d_col in king_moves:
-        r, c = king_row + d_row, king_col + d_col
-        if 0 <= r < 8 and 0 <= c < 8 and board_state[r][c] and board_state[r][c] == opponent + 'k':
+    king = opponent + 'k'
+    for r, c in king_targets[king_row][king_col]:
+        if board_state[r][c] == king:
             return True
 
     return False
@@ -546,8 +741,9 @@ def is_path_clear(start_position, end_position, board_state):
     return True
 
 
-def perform_castling(king_position, rook_position, board_state, is_kingside):
-    global pieces_moved
+def perform_castling(game, king_position, rook_position, is_kingside):
+    board_state = game.board_state
+    pieces_moved = game.pieces_moved
 
     king_row, king_col = king_position
     rook_row, rook_col = rook_position
@@ -562,6 +758,11 @@ def perform_castling(king_position, rook_position, board_state, is_kingside):
     else:
         raise ValueError("Invalid rook position for castling")
 
+    # The king and rook must be on their starting squares
+    if king_row not in (0, 7) or king_col != 4 or rook_row != king_row or \
+       board_state[king_row][king_col] != king_piece or board_state[rook_row][rook_col] != rook_piece[:2]:
+        raise ValueError("No king and rook to castle with")
+
     # Check if the king or rook has moved
     if pieces_moved[king_piece] or pieces_moved[rook_piece]:
         raise ValueError("Cannot castle if the king or rook has moved")
@@ -581,12 +782,33 @@ def perform_castling(king_position, rook_position, board_state, is_kingside):
         new_king_col = king_col - 2
         new_rook_col = new_king_col + 1
 
+    # The king may not pass over or land on an attacked square either
+    opponent = 'b' if king_piece == 'wk' else 'w'
+    if is_square_attacked((king_row, (king_col + new_king_col) // 2), opponent, board_state) or \
+       is_square_attacked((king_row, new_king_col), opponent, board_state):
+        raise ValueError("Cannot castle through or into check")
+
     # Move king and rook to their new positions
     board_state[king_row][king_col] = None
     board_state[rook_row][rook_col] = None
     board_state[king_row][new_king_col] = 'wk' if king_row == 7 else 'bk'  # Adjust piece code if necessary
     board_state[rook_row][new_rook_col] = 'wr' if rook_row == 7 else 'br'  # Adjust piece code if necessary
 
+    # Update pieces_moved flags, the Zobrist key and the material score
+    rook_code = rook_piece[:2]
+    game.material_score += piece_square_values[king_piece][king_row][new_king_col] - piece_square_values[king_piece][king_row][king_col]
+    game.material_score += piece_square_values[rook_code][rook_row][new_rook_col] - piece_square_values[rook_code][rook_row][rook_col]
+    key = game.zobrist_key ^ zobrist_black_to_move ^ zobrist_castling[castling_rights(pieces_moved)]
+    pieces_moved[king_piece] = True
+    pieces_moved[rook_piece] = True
+    key ^= zobrist_castling[castling_rights(pieces_moved)]
+    key ^= zobrist_pieces[king_piece][king_row][king_col] ^ zobrist_pieces[king_piece][king_row][new_king_col]
+    key ^= zobrist_pieces[rook_code][rook_row][rook_col] ^ zobrist_pieces[rook_code][rook_row][new_rook_col]
+    if game.en_passant_file is not None:
+        key ^= zobrist_en_passant[game.en_passant_file]
+        game.en_passant_file = None
+    game.zobrist_key = key
+
     return board_state
 
 
@@ -599,30 +821,22 @@ def find_king(board_state, color):
                 return (row, col)
     return None
 
-def get_piece_type(piece_code):
-
-    return {
-        'wp': '', 'bp': '',
-        'wn': 'N', 'bn': 'N',
-        'wb': 'B', 'bb': 'B',
-        'wr': 'R', 'br': 'R',
-        'wq': 'Q', 'bq': 'Q',
-        'wk': 'K', 'bk': 'K'
-    }[piece_code]
-
-def convert_to_pgn(from_position, to_position, piece_code, is_capture, promotion=None, check=False, checkmate=False):
-        piece_type = get_piece_type(piece_code)
-        capture_notation = 'x' if is_capture else ''
-        promotion_notation = f'={promotion.upper()}' if promotion else ''
-        check_notation = '+' if check else ('#' if checkmate else '')
+def convert_to_pgn(game, from_position, to_position, promotion, moves):
+    '''Returns the SAN of a legal move in the game's position without check or mate (see check_marker), before it is played.
 
-        # For pawns, include the starting file if there is a capture
-        from_file = from_position[0] if piece_type == '' and is_capture else ''
+    moves are the legal moves of the position, from legal_moves.
+    '''
+    return plain_san((from_position, to_position, promotion), game.board_state, moves)
 
-        # Construct the PGN move notation
-        pgn_move = f"{piece_type}{from_file}{capture_notation}{to_position}{promotion_notation}{check_notation}"
+def check_marker(game):
+    '''Returns '#' if the side to move in the game is mated, '+' if it is in check, or an empty string.
 
-        return pgn_move
+    The position's legal moves are generated once, and only when it is in check.
+    '''
+    king_position = find_king(game.board_state, game.player)
+    if not is_in_check(king_position, game.board_state):
+        return ''
+    return '+' if legal_moves(game) else '#'
 
 def convert_position(pos):
         column = ord(pos[0]) - ord('a')
@@ -630,9 +844,9 @@ def convert_position(pos):
         return row, column
 
 
-def has_moved(piece_code, position):
+def has_moved(game, piece_code, position):
     piece_key = piece_code if piece_code in ['wk', 'bk'] else piece_code + str(position[1])
-    return pieces_moved.get(piece_key, False)
+    return game.pieces_moved.get(piece_key, False)
 
 def is_white_piece(position, board_state):
     piece = board_state[position[0]][position[1]]
@@ -0,0 +1,110 @@
+# Compact, immutable encoding of a position for move histories, caches and storage
+#
+# A position is 33 bytes: 64 four-bit piece codes, two squares to a byte in
+# board order (row 0 is the 8th rank, col 0 the a-file, high nibble first),
+# then a state byte with the side to move in bit 0 and the castling rights
+# from app.castling_rights in bits 1-4.
+#
+# A pawn that has just moved two squares, and so can be taken en passant,
+# gets a code of its own; its colour follows from its row. That keeps the
+# en passant file without another byte, and equal positions pack to equal bytes.
+from app import castling_rights, pieces_moved_from_rights
+
+# Four-bit code of each piece, 0 for an empty square
+piece_nibbles = {
+    None: 0,
+    'wp': 1, 'wn': 2, 'wb': 3, 'wr': 4, 'wq': 5, 'wk': 6,
+    'bp': 9, 'bn': 10, 'bb': 11, 'br': 12, 'bq': 13, 'bk': 14
+}
+EN_PASSANT_PAWN = 7
+
+nibble_pieces = [None] * 16
+for piece, nibble in piece_nibbles.items():
+    nibble_pieces[nibble] = piece
+nibble_pieces[EN_PASSANT_PAWN] = 'ep'
+
+# The two pieces held in each possible byte, for unpacking a byte at a time
+byte_pieces = [(nibble_pieces[byte >> 4], nibble_pieces[byte & 15]) for byte in range(256)]
+
+
+class PackedPosition(bytes):
+    '''A position packed into 33 bytes (see the top of this module).
+
+    Being bytes, it is immutable, hashable and can be written out or sent as
+    is. As an object it takes about 82 bytes, against about 1.6 KB for the
+    board lists, pieces_moved flags and last_move dict it stands for.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def pack(cls, board_state, player, last_move=None, moved=None):
+        '''Packs a position, taking the castling rights from moved (by default app.py's pieces_moved flags).'''
+        codes = [piece_nibbles[piece] for row in board_state for piece in row]
+        if last_move and last_move['piece_code'][1] == 'p' and \
+           abs(last_move['from_position'][0] - last_move['to_position'][0]) == 2:
+            row, col = last_move['to_position']
+            codes[row * 8 + col] = EN_PASSANT_PAWN
+        codes = iter(codes)
+        state = (player == 'b') | castling_rights(moved) << 1
+        return cls(bytes([high << 4 | low for high, low in zip(codes, codes)] + [state]))
+
+    def unpack(self):
+        '''Returns the board, player, last move and pieces_moved flags, as taken by app.load_position.
+
+        The last move is only known when it was a pawn's two-square move, and
+        the flags only as far as the castling rights go.
+        '''
+        board_state = []
+        for row in range(8):
+            squares = []
+            for byte in self[row * 4:row * 4 + 4]:
+                squares.extend(byte_pieces[byte])
+            board_state.append(squares)
+
+        # Only the 4th and 5th ranks can hold a pawn that has just moved two squares
+        last_move = None
+        for row, color, from_row in ((4, 'w', 6), (3, 'b', 1)):
+            if 'ep' in board_state[row]:
+                col = board_state[row].index('ep')
+                board_state[row][col] = color + 'p'
+                last_move = {'piece_code': color + 'p', 'from_position': (from_row, col), 'to_position': (row, col)}
+
+        return board_state, self.player, last_move, pieces_moved_from_rights(self.castling)
+
+    @property
+    def player(self):
+        return 'b' if self[32] & 1 else 'w'
+
+    @property
+    def castling(self):
+        '''The castling rights, as returned by app.castling_rights.'''
+        return self[32] >> 1 & 15
+
+    @property
+    def en_passant_file(self):
+        '''The file of a pawn that can be taken en passant, or None.'''
+        for index in range(12, 20):
+            if self[index] >> 4 == EN_PASSANT_PAWN:
+                return (index * 2) % 8
+            if self[index] & 15 == EN_PASSANT_PAWN:
+                return (index * 2 + 1) % 8
+        return None
+
+    def piece_at(self, position):
+        '''Returns the piece code on a (row, col) square, or None.'''
+        row, col = position
+        index = row * 8 + col
+        nibble = self[index >> 1] >> 4 if index & 1 == 0 else self[index >> 1] & 15
+        if nibble == EN_PASSANT_PAWN:
+            return 'wp' if row == 4 else 'bp'
+        return nibble_pieces[nibble]
+
+    def changed_squares(self, other):
+        '''Returns the (row, col) squares whose piece differs in another packed position.'''
+        squares = []
+        for index in range(32):
+            if self[index] != other[index]:
+                for position in ((index >> 2, (index & 3) * 2), (index >> 2, (index & 3) * 2 + 1)):
+                    if self.piece_at(position) != other.piece_at(position):
+                        squares.append(position)
+        return squares
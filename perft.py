@@ -0,0 +1,253 @@
+# Perft: counts the leaf nodes of the legal move tree to check and time app.py's move generator
+#
+# Usage:
+#   python perft.py                      run the benchmark suite over the standard positions
+#   python perft.py perft <depth> [fen]  count the nodes at depth (default start position)
+#   python perft.py divide <depth> [fen] node counts under each root move
+#
+# perft and divide take --workers=N to split the tree across N processes
+# (0 for one per core) and --hash=N to cache up to N subtree counts per process.
+import multiprocessing
+import os
+import sys
+import time
+
+import app
+from fen import START_FEN, parse_fen
+
+# Standard test positions with their known node counts, one per depth starting at 1
+test_positions = [
+    ('Start position', START_FEN,
+     [20, 400, 8902, 197281]),
+    ('Kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     [48, 2039, 97862]),
+    ('Rook endgame with en passant', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     [14, 191, 2812, 43238]),
+    ('Castling and promotions', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     [6, 264, 9467]),
+    ('Promotion with discovered check', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     [44, 1486, 62379]),
+    ('Illegal en passant (pinned along the rank)', '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1',
+     [18, 92, 1670, 10138]),
+    ('Illegal en passant (bishop pin)', '8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1',
+     [13, 102, 1266, 10276]),
+    ('En passant capture gives check', '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1',
+     [15, 126, 1928, 13931]),
+    ('Short castling gives check', '5k2/8/8/8/8/8/8/4K2R w K - 0 1',
+     [15, 66, 1198, 6399]),
+    ('Long castling gives check', '3k4/8/8/8/8/8/8/R3K3 w Q - 0 1',
+     [16, 71, 1286, 7418]),
+    ('Castling rights lost to rook captures', 'r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1',
+     [26, 1141, 27826]),
+    ('Castling prevented by attacked squares', 'r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1',
+     [44, 1494, 50509]),
+    ('Promote out of check', '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1',
+     [11, 133, 1442, 19174]),
+    ('Discovered check', '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1',
+     [29, 165, 5160, 31961]),
+    ('Underpromotion to give check', '8/P1k5/K7/8/8/8/8/8 w - - 0 1',
+     [6, 27, 273, 1329]),
+    ('Self stalemate', 'K1k5/8/P7/8/8/8/8/8 w - - 0 1',
+     [2, 6, 13, 63]),
+    ('Stalemate and checkmate', '8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1',
+     [37, 183, 6559, 23527]),
+]
+
+
+# Subtree counts of a worker process keyed by (Zobrist key, depth), see init_worker
+perft_cache = None
+perft_cache_size = 0
+
+
+def perft(depth, board_state, player, last_move, cache=None):
+    '''Returns the number of leaf nodes of the legal move tree depth plies deep.
+
+    If cache is a dict, subtree counts are looked up in and added to it by
+    the Zobrist key of the position, so transpositions are only counted once.
+    '''
+    if depth == 0:
+        return 1
+
+    moves = app.generate_legal_moves(board_state, player, last_move)
+    if depth == 1:
+        return len(moves)
+
+    if cache is not None:
+        key = (app.zobrist_key, depth)
+        nodes = cache.get(key)
+        if nodes is not None:
+            return nodes
+
+    opponent = 'b' if player == 'w' else 'w'
+    nodes = 0
+    for from_position, to_position, promotion in moves:
+        piece_code = board_state[from_position[0]][from_position[1]]
+        undo = app.make_move(board_state, from_position, to_position, promotion)
+        move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        nodes += perft(depth - 1, board_state, opponent, move, cache)
+        app.unmake_move(board_state, undo)
+
+    if cache is not None:
+        # Start over rather than grow past the limit
+        if len(cache) >= perft_cache_size:
+            cache.clear()
+        cache[key] = nodes
+    return nodes
+
+
+def divide(depth, board_state, player, last_move):
+    '''Returns a dict of the perft node count below each root move, keyed by the move in 'e2e4' form.'''
+    opponent = 'b' if player == 'w' else 'w'
+    counts = {}
+    for from_position, to_position, promotion in app.generate_legal_moves(board_state, player, last_move):
+        piece_code = board_state[from_position[0]][from_position[1]]
+        undo = app.make_move(board_state, from_position, to_position, promotion)
+        move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        counts[move_name(from_position, to_position, promotion)] = perft(depth - 1, board_state, opponent, move)
+        app.unmake_move(board_state, undo)
+    return counts
+
+
+def split_moves(board_state, player, last_move, plies):
+    '''Returns every line of legal moves plies deep from the position, each a list of (from, to, promotion) moves.
+
+    Lines that end early in mate or stalemate are left out, they have no
+    nodes below them.
+    '''
+    if plies == 0:
+        return [[]]
+    opponent = 'b' if player == 'w' else 'w'
+    lines = []
+    for from_position, to_position, promotion in app.generate_legal_moves(board_state, player, last_move):
+        piece_code = board_state[from_position[0]][from_position[1]]
+        undo = app.make_move(board_state, from_position, to_position, promotion)
+        move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        for line in split_moves(board_state, opponent, move, plies - 1):
+            lines.append([(from_position, to_position, promotion)] + line)
+        app.unmake_move(board_state, undo)
+    return lines
+
+
+def init_worker(cache_size):
+    '''Sets up a worker process, with a perft cache of up to cache_size entries if it isn't 0.'''
+    global perft_cache, perft_cache_size
+    perft_cache = {} if cache_size else None
+    perft_cache_size = cache_size
+
+
+def perft_line(task):
+    '''Worker entry point: plays a line of moves from a FEN and counts the nodes below it.
+
+    Returns the first move of the line in 'e2e4' form and the node count.
+    '''
+    fen, line, depth = task
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    for from_position, to_position, promotion in line:
+        piece_code = board_state[from_position[0]][from_position[1]]
+        app.make_move(board_state, from_position, to_position, promotion)
+        last_move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        player = 'b' if player == 'w' else 'w'
+    return move_name(*line[0]), perft(depth - len(line), board_state, player, last_move, perft_cache)
+
+
+def parallel_divide(fen, depth, workers=0, cache_size=0):
+    '''Returns the same counts as divide, with the tree split across a pool of worker processes.
+
+    The root moves are split further, a ply at a time, until there are
+    enough lines to keep every worker busy. Each worker keeps a perft cache
+    of up to cache_size entries if it isn't 0.
+    '''
+    workers = workers or os.cpu_count() or 1
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position(board_state, player, last_move, moved)
+
+    plies = 1
+    lines = split_moves(board_state, player, last_move, plies)
+    while len(lines) < workers * 16 and plies < depth - 1:
+        plies += 1
+        lines = split_moves(board_state, player, last_move, plies)
+
+    # Root moves with no lines below them (mate or stalemate next) still belong in the counts
+    counts = {move_name(*move): 0 for move in app.generate_legal_moves(board_state, player, last_move)}
+    with multiprocessing.Pool(workers, init_worker, (cache_size,)) as pool:
+        for move, nodes in pool.imap_unordered(perft_line, [(fen, line, depth) for line in lines]):
+            counts[move] += nodes
+    return counts
+
+
+def move_name(from_position, to_position, promotion=None):
+    '''Returns a move in coordinate notation, e.g. 'e2e4' or 'e7e8q'.'''
+    return app.convert_to_square(from_position) + app.convert_to_square(to_position) + (promotion or '')
+
+
+def run_perft(fen, depth, workers=None, cache_size=0):
+    '''Loads the position into app.py's game state and returns its perft count and the seconds taken.
+
+    With workers set (0 for one per core) the count is split across that many
+    processes, as with parallel_divide.
+    '''
+    start = time.perf_counter()
+    if workers is not None and depth > 1:
+        nodes = sum(parallel_divide(fen, depth, workers, cache_size).values())
+    else:
+        board_state, player, last_move, moved = parse_fen(fen)[:4]
+        app.load_position(board_state, player, last_move, moved)
+        init_worker(cache_size)
+        nodes = perft(depth, board_state, player, last_move, perft_cache)
+    return nodes, time.perf_counter() - start
+
+
+def run_suite(max_nodes=100000):
+    '''Runs every test position to the deepest depth with at most max_nodes expected nodes.
+
+    Prints the node count, time and nodes/second of each run and returns False
+    if any count differs from the known one.
+    '''
+    passed = True
+    total_nodes = 0
+    total_time = 0.0
+    for name, fen, counts in test_positions:
+        for depth, expected in enumerate(counts, 1):
+            if expected > max_nodes:
+                break
+            nodes, elapsed = run_perft(fen, depth)
+            total_nodes += nodes
+            total_time += elapsed
+            status = 'ok' if nodes == expected else f'FAIL (expected {expected})'
+            print(f"{name:<45} depth {depth}  {nodes:>9} nodes  {elapsed:7.2f}s  {nodes / elapsed:>9.0f} nps  {status}")
+            passed = passed and nodes == expected
+
+    print(f"Total: {total_nodes} nodes in {total_time:.2f}s, {total_nodes / total_time:.0f} nodes/second")
+    print("All counts correct" if passed else "Some counts are WRONG")
+    return passed
+
+
+def main(args):
+    options = dict(arg[2:].split('=', 1) for arg in args if arg.startswith('--') and '=' in arg)
+    args = [arg for arg in args if not arg.startswith('--')]
+    workers = int(options['workers']) if 'workers' in options else None
+    cache_size = int(options.get('hash', 0))
+    if not args:
+        return 0 if run_suite() else 1
+
+    command, depth = args[0], int(args[1])
+    fen = ' '.join(args[2:]) or START_FEN
+    if command == 'divide':
+        if workers is not None and depth > 1:
+            counts = parallel_divide(fen, depth, workers, cache_size)
+        else:
+            board_state, player, last_move, moved = parse_fen(fen)[:4]
+            app.load_position(board_state, player, last_move, moved)
+            counts = divide(depth, board_state, player, last_move)
+        for move, nodes in sorted(counts.items()):
+            print(f"{move}: {nodes}")
+        print(f"Moves: {len(counts)}  Nodes: {sum(counts.values())}")
+    else:
+        nodes, elapsed = run_perft(fen, depth, workers, cache_size)
+        print(f"Nodes: {nodes}  Time: {elapsed:.2f}s  {nodes / max(elapsed, 1e-9):.0f} nodes/second")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
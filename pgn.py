@@ -0,0 +1,268 @@
+# Streaming PGN reader: replays every game of a PGN archive through app.py's rules engine
+#
+# Usage:
+#   python pgn.py <file.pgn> [...]   replay every game, reporting games/second and any illegal moves
+#   python pgn.py --san <file.pgn>   also write each game's moves back out as SAN and check they match
+#
+# The file is memory-mapped and read a line at a time, so only the game being
+# replayed is ever held in memory, whatever the size of the archive.
+import mmap
+import os
+import re
+import sys
+import time
+
+import app
+from fen import START_FEN, parse_fen
+
+tag_pattern = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+comment_pattern = re.compile(r'\{[^}]*\}|;[^\n]*')
+variation_pattern = re.compile(r'\([^()]*\)')
+move_number_pattern = re.compile(r'^\d+\.+')
+san_pattern = re.compile(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQnbrq]))?[+#]?[!?]*$')
+
+results = ('1-0', '0-1', '1/2-1/2', '*')
+
+
+def read_games(path):
+    '''Yields (tags, movetext) for each game in a PGN file, tags being a dict of the tag pairs.'''
+    with open(path, 'rb') as pgn_file:
+        if os.fstat(pgn_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(pgn_file.fileno(), 0, access=mmap.ACCESS_READ) as archive:
+            tags = {}
+            lines = []
+            for line in iter(archive.readline, b''):
+                line = line.strip()
+                if line.startswith(b'['):
+                    # A tag after movetext starts the next game
+                    if lines:
+                        yield tags, '\n'.join(lines)
+                        tags = {}
+                        lines = []
+                    match = tag_pattern.match(line.decode('utf-8', 'replace'))
+                    if match:
+                        tags[match.group(1)] = match.group(2)
+                elif line and not line.startswith(b'%'):
+                    lines.append(line.decode('utf-8', 'replace'))
+            if tags or lines:
+                yield tags, '\n'.join(lines)
+
+
+def movetext_tokens(movetext):
+    '''Returns the SAN moves of a game's movetext, without comments, variations, move numbers, NAGs or the result.'''
+    movetext = comment_pattern.sub(' ', movetext)
+    # Variations can nest, so take out the innermost ones until none are left
+    while '(' in movetext:
+        stripped = variation_pattern.sub(' ', movetext)
+        if stripped == movetext:
+            raise ValueError("Unbalanced parentheses in movetext")
+        movetext = stripped
+
+    tokens = []
+    for token in movetext.split():
+        token = move_number_pattern.sub('', token)
+        if token and token[0] != '$' and token not in results:
+            tokens.append(token)
+    return tokens
+
+
+def parse_san(san, board_state, player, legal_moves):
+    '''Returns the move in legal_moves that a SAN move such as 'Nbd7', 'exd8=Q+' or 'O-O' stands for.
+
+    Raises ValueError if the SAN matches no legal move or more than one.
+    '''
+    row = 7 if player == 'w' else 0
+    castle = san.rstrip('+#!?')
+    if castle in ('O-O', '0-0'):
+        candidates = [move for move in legal_moves if move[0] == (row, 4) and move[1] == (row, 6)
+                      and board_state[row][4] == player + 'k']
+    elif castle in ('O-O-O', '0-0-0'):
+        candidates = [move for move in legal_moves if move[0] == (row, 4) and move[1] == (row, 2)
+                      and board_state[row][4] == player + 'k']
+    else:
+        match = san_pattern.match(san)
+        if not match:
+            raise ValueError(f"Unreadable move '{san}'")
+        piece, from_file, from_rank, square, promotion = match.groups()
+        piece = player + (piece.lower() if piece else 'p')
+        to_position = (8 - int(square[1]), ord(square[0]) - ord('a'))
+        from_col = ord(from_file) - ord('a') if from_file else None
+        from_row = 8 - int(from_rank) if from_rank else None
+        promotion = promotion.lower() if promotion else None
+        if piece[1] == 'p' and to_position[0] in (0, 7) and promotion is None:
+            promotion = 'q'
+
+        candidates = [move for move in legal_moves
+                      if move[1] == to_position and move[2] == promotion
+                      and board_state[move[0][0]][move[0][1]] == piece
+                      and (from_col is None or move[0][1] == from_col)
+                      and (from_row is None or move[0][0] == from_row)]
+
+    if len(candidates) != 1:
+        raise ValueError(f"{'Ambiguous' if candidates else 'Illegal'} move '{san}'")
+    return candidates[0]
+
+
+def plain_san(move, board_state, legal_moves):
+    '''Returns the SAN of a legal move without its check or mate marker, e.g. 'Nbd7', 'exd8=Q' or 'O-O'.
+
+    legal_moves are the legal moves of the position, used to tell apart
+    pieces of the same kind that can go to the same square.
+    '''
+    (from_row, from_col), to_position, promotion = move
+    piece = board_state[from_row][from_col]
+    if piece[1] == 'k' and abs(to_position[1] - from_col) == 2:
+        return 'O-O' if to_position[1] > from_col else 'O-O-O'
+
+    square = app.convert_to_square(to_position)
+    if piece[1] == 'p':
+        # A pawn moving to another file is always a capture, en passant included
+        san = f"{chr(ord('a') + from_col)}x{square}" if to_position[1] != from_col else square
+        if to_position[0] in (0, 7):
+            san += '=' + (promotion or 'q').upper()
+        return san
+
+    # Name the file, rank or both of the moving piece if another of its kind can go to the square too
+    rivals = [other[0] for other in legal_moves if other[1] == to_position and other[0] != (from_row, from_col)
+              and board_state[other[0][0]][other[0][1]] == piece]
+    origin = app.convert_to_square((from_row, from_col))
+    if not rivals:
+        origin = ''
+    elif all(col != from_col for row, col in rivals):
+        origin = origin[0]
+    elif all(row != from_row for row, col in rivals):
+        origin = origin[1]
+    capture = 'x' if board_state[to_position[0]][to_position[1]] else ''
+    return f"{piece[1].upper()}{origin}{capture}{square}"
+
+
+def move_to_san(move, board_state, player, legal_moves):
+    '''Returns the SAN of a legal move, e.g. 'Nbd7', 'exd8=Q+' or 'O-O#'.
+
+    The position must be app.py's current game state, as the move is played
+    on it to see whether it gives check or mate. To write out a whole game,
+    game_to_san is faster.
+    '''
+    san = plain_san(move, board_state, legal_moves)
+    from_position, to_position, promotion = move
+    piece = board_state[from_position[0]][from_position[1]]
+    opponent = 'b' if player == 'w' else 'w'
+    undo = app.make_move(board_state, from_position, to_position, promotion)
+    try:
+        if app.is_square_attacked(app.get_king_position(opponent), player, board_state):
+            last_move = {'piece_code': piece, 'from_position': from_position, 'to_position': to_position}
+            san += '+' if app.generate_legal_moves(board_state, opponent, last_move) else '#'
+    finally:
+        app.unmake_move(board_state, undo)
+    return san
+
+
+def game_to_san(board_state, player, last_move, moves):
+    '''Plays a game's moves through app.py's game state, which must hold the starting position, and returns their SAN.
+
+    The legal moves of each position are generated once, both to write the
+    move played from it and to tell check from mate after the move before.
+    '''
+    sans = []
+    legal_moves = app.generate_legal_moves(board_state, player, last_move)
+    for move in moves:
+        san = plain_san(move, board_state, legal_moves)
+        from_position, to_position, promotion = move
+        piece_code = board_state[from_position[0]][from_position[1]]
+        app.make_move(board_state, from_position, to_position, promotion)
+        last_move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        opponent = player
+        player = 'b' if player == 'w' else 'w'
+        legal_moves = app.generate_legal_moves(board_state, player, last_move)
+        if app.is_square_attacked(app.get_king_position(player), opponent, board_state):
+            san += '+' if legal_moves else '#'
+        sans.append(san)
+    return sans
+
+
+def replay_game(tags, movetext):
+    '''Plays a game through app.py's game state and returns its moves as (from, to, promotion) tuples.
+
+    The game starts from its FEN tag if it has one. Raises ValueError at the
+    first move that can't be read or isn't legal.
+    '''
+    board_state, player, last_move, moved = parse_fen(tags.get('FEN', START_FEN))[:4]
+    app.load_position(board_state, player, last_move, moved)
+
+    moves = []
+    for ply, san in enumerate(movetext_tokens(movetext)):
+        legal_moves = app.generate_legal_moves(board_state, player, last_move)
+        try:
+            move = parse_san(san, board_state, player, legal_moves)
+        except ValueError as e:
+            raise ValueError(f"{e} at ply {ply + 1}")
+        from_position, to_position, promotion = move
+        piece_code = board_state[from_position[0]][from_position[1]]
+        app.make_move(board_state, from_position, to_position, promotion)
+        last_move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        player = 'b' if player == 'w' else 'w'
+        moves.append(move)
+    return moves
+
+
+def replay_file(path, report_every=1000, check_san=False):
+    '''Replays every game in a PGN file, printing progress every report_every games.
+
+    With check_san, each game's moves are also written back out with
+    game_to_san and a game fails unless that gives the same SAN as the file
+    (ignoring '!' and '?' annotations).
+
+    Returns a dict with the number of games, plies and games that failed, the
+    seconds taken and the games and plies per second.
+    '''
+    games = plies = failed = 0
+    start = time.perf_counter()
+    for tags, movetext in read_games(path):
+        games += 1
+        try:
+            moves = replay_game(tags, movetext)
+            plies += len(moves)
+            if check_san:
+                board_state, player, last_move, moved = parse_fen(tags.get('FEN', START_FEN))[:4]
+                app.load_position(board_state, player, last_move, moved)
+                sans = game_to_san(board_state, player, last_move, moves)
+                for ply, (san, token) in enumerate(zip(sans, movetext_tokens(movetext))):
+                    if san != token.rstrip('!?'):
+                        raise ValueError(f"Wrote '{san}' for '{token}' at ply {ply + 1}")
+        except ValueError as e:
+            failed += 1
+            print(f"Game {games} ({tags.get('White', '?')} - {tags.get('Black', '?')}): {e}")
+        if report_every and games % report_every == 0:
+            elapsed = time.perf_counter() - start
+            print(f"{games} games, {plies} plies, {games / elapsed:.0f} games/second")
+
+    elapsed = time.perf_counter() - start
+    return {
+        'games': games,
+        'plies': plies,
+        'failed': failed,
+        'time': elapsed,
+        'games_per_second': games / elapsed if elapsed > 0 else 0,
+        'plies_per_second': plies / elapsed if elapsed > 0 else 0
+    }
+
+
+def main(args):
+    check_san = '--san' in args
+    paths = [arg for arg in args if arg != '--san']
+    if not paths:
+        print("Usage: python pgn.py [--san] <file.pgn> [...]")
+        return 2
+    failed = 0
+    for path in paths:
+        stats = replay_file(path, check_san=check_san)
+        failed += stats['failed']
+        print(f"{path}: {stats['games']} games ({stats['failed']} failed), {stats['plies']} plies in "
+              f"{stats['time']:.2f}s, {stats['games_per_second']:.0f} games/second, "
+              f"{stats['plies_per_second']:.0f} plies/second")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,123 @@
+# Load test for the server-sent event fan-out: thousands of subscribers watching one game
+#
+# Usage:
+#   python push_bench.py [--subscribers N] [--moves N] [--interval SECONDS] [--backlog N]
+#
+# Each subscriber is a thread reading events.stream, as a request thread of
+# old.py's /events route does. A game of random legal moves is played and
+# each move published with the same data as a 'delta' move response. Reports
+# the cost of publishing a move, how long until every subscriber has it, and
+# checks that every subscriber got every move in order.
+import argparse
+import random
+import sys
+import threading
+import time
+
+import app
+from events import Broadcaster, stream
+from fen import START_FEN, parse_fen
+from packed import PackedPosition
+from pgn import move_to_san
+
+
+def random_game(moves, seed=1):
+    '''Plays up to moves random legal moves from the start position and returns the 'move' event data of each.'''
+    random.seed(seed)
+    board_state, player, last_move, moved = parse_fen(START_FEN)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    before = PackedPosition.pack(board_state, player, last_move)
+    events = []
+    for version in range(2, moves + 2):
+        legal_moves = app.generate_legal_moves(board_state, player, last_move)
+        if not legal_moves:
+            break
+        from_position, to_position, promotion = random.choice(legal_moves)
+        san = move_to_san((from_position, to_position, promotion), board_state, player, legal_moves)
+        piece_code = board_state[from_position[0]][from_position[1]]
+        undo = app.make_move(board_state, from_position, to_position, promotion)
+        last_move = {'piece_code': piece_code, 'from_position': from_position, 'to_position': to_position}
+        player = 'b' if player == 'w' else 'w'
+        after = PackedPosition.pack(board_state, player, last_move)
+        events.append({
+            'success': True,
+            'version': version,
+            'move': san,
+            'changes': {app.convert_to_square(position): after.piece_at(position)
+                        for position in before.changed_squares(after)},
+            'captured': undo[3],
+            'evaluation': app.evaluate()
+        })
+        before = after
+    return events
+
+
+def subscriber_thread(broadcaster, subscriber, received, index):
+    '''Reads a subscription to the end, keeping the version of each move event in received[index].'''
+    versions = received[index] = []
+    for chunk in stream(broadcaster, subscriber):
+        for line in chunk.split(b'\n'):
+            if line.startswith(b'id: '):
+                versions.append(int(line[4:]))
+
+
+def run(subscribers, moves, interval=0.0, backlog=256):
+    '''Runs the benchmark and returns a dict of its results.'''
+    events = random_game(moves)
+    broadcaster = Broadcaster(backlog)
+    received = [None] * subscribers
+
+    # Small stacks so thousands of threads fit
+    threading.stack_size(256 * 1024)
+    threads = []
+    for index in range(subscribers):
+        thread = threading.Thread(target=subscriber_thread, args=(broadcaster, broadcaster.subscribe(), received, index))
+        thread.start()
+        threads.append(thread)
+
+    publish_time = 0.0
+    delivered = 0
+    start = time.perf_counter()
+    for event in events:
+        publish_start = time.perf_counter()
+        delivered += broadcaster.publish('move', event, event['version'])
+        publish_time += time.perf_counter() - publish_start
+        if interval:
+            time.sleep(interval)
+    broadcaster.close()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    expected = [event['version'] for event in events]
+    complete = sum(1 for versions in received if versions == expected)
+    return {
+        'subscribers': subscribers,
+        'moves': len(events),
+        'delivered': delivered,
+        'complete': complete,
+        'dropped': subscribers - complete,
+        'publish_microseconds': publish_time / len(events) * 1e6 if events else 0,
+        'time': elapsed,
+        'events_per_second': delivered / elapsed if elapsed > 0 else 0
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Fan out a game's move events to many simulated subscribers.")
+    parser.add_argument('--subscribers', type=int, default=2000)
+    parser.add_argument('--moves', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=0.0, help="seconds between moves")
+    parser.add_argument('--backlog', type=int, default=256, help="events a subscriber can fall behind before it is dropped")
+    options = parser.parse_args(args)
+
+    results = run(options.subscribers, options.moves, options.interval, options.backlog)
+    print(f"{results['subscribers']} subscribers, {results['moves']} moves: {results['delivered']} events delivered "
+          f"in {results['time']:.2f}s, {results['events_per_second']:.0f} events/second")
+    print(f"Publishing a move took {results['publish_microseconds']:.0f} microseconds")
+    print(f"{results['complete']} subscribers got every move in order, {results['dropped']} were dropped to resync")
+    return 0 if results['dropped'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
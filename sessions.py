@@ -0,0 +1,350 @@
+# Per-game state for the Flask server and stores of games keyed by game ID, in memory or logged to files
+import os
+import re
+import threading
+import time
+import uuid
+
+from app import compute_zobrist_key, compute_material, get_taken_pieces
+from events import Broadcaster
+from gamelog import GameLog, read_log
+from packed import PackedPosition
+
+starting_board = [
+    ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br'],
+    ['bp'] * 8,
+    [None] * 8,
+    [None] * 8,
+    [None] * 8,
+    [None] * 8,
+    ['wp'] * 8,
+    ['wr', 'wn', 'wb', 'wq', 'wk', 'wb', 'wn', 'wr']
+]
+
+
+class Game:
+    '''The state of one game: the board, the moves so far and everything kept up to date as they are played.
+
+    Hold lock while reading or changing a game, requests for the same game
+    can arrive on several threads at once.
+    '''
+
+    def __init__(self, game_id, log=None):
+        self.game_id = game_id
+        self.lock = threading.Lock()
+        self.last_access = time.monotonic()
+        # Goes up by one with every move and every reset, load or takeback, so clients can tell when they are out of date
+        self.version = 0
+        # Clients watching the game, sent its moves as they are played
+        self.events = Broadcaster()
+        # The gamelog.GameLog its moves are written to, if it is kept on disk
+        self.log = log
+        self.reset()
+
+    def reset(self):
+        '''Puts the game back to the starting position.'''
+        self.load([row[:] for row in starting_board], 'w')
+
+    def load(self, board_state, player, last_move=None, moved=None, halfmove_clock=0, fullmove_number=1):
+        '''Starts the game from a position, e.g. one from fen.parse_fen, with no moves played yet.'''
+        self.set_position(board_state, player, last_move, moved, halfmove_clock)
+
+        # The moves so far in PGN format and the fullmove number of the FEN.
+        # When black moves first the move list starts with '<n>. ...' for white's missing move.
+        self.game_moves = [] if player == 'w' else [f"{fullmove_number}. ..."]
+        self.current_move_number = fullmove_number
+
+        # Every position of the game so far, packed, starting with the initial one, with its
+        # halfmove clock, and the SAN of each move. history[i] is the position after first_ply + i
+        # moves (first_ply is only above 0 for a game restored from its log, whose history starts
+        # at its last snapshot). The history is never empty, so its last position can be read
+        # without the lock.
+        self.history = [PackedPosition.pack(board_state, player, last_move, self.pieces_moved)]
+        self.clocks = [halfmove_clock]
+        self.moves = []
+        self.first_ply = 0
+
+        # The positions, clocks and SAN of moves taken back, the last taken back at the end,
+        # which go_to_ply can play again until another move is played
+        self.redo = []
+
+        # The version is base_version after base_ply moves, and goes up by one with each move
+        # since; taking moves back starts the count again from the position reached
+        self.version += 1
+        self.base_version = self.version
+        self.base_ply = 0
+        if self.log:
+            self.log.start(self)
+
+    def set_position(self, board_state, player, last_move, moved, halfmove_clock):
+        '''Makes a position the game's current one, with everything worked out from it.'''
+        self.board_state = board_state
+        self.player = player
+
+        # Flags to track if the kings and rooks have moved, used for castling
+        self.pieces_moved = moved if moved is not None else {
+            'wk': False, 'wr1': False, 'wr2': False,
+            'bk': False, 'br1': False, 'br2': False
+        }
+
+        # The last move played, used for en passant
+        self.last_move = last_move
+
+        # Zobrist key, en passant file, piece counts and material score of the position,
+        # kept up to date by old.py's move_piece and perform_castling
+        self.zobrist_key, self.en_passant_file = compute_zobrist_key(board_state, player, last_move, self.pieces_moved)
+        self.piece_counts, self.material_score = compute_material(board_state)
+
+        # Pieces taken during the game and the halfmove clock of the FEN
+        self.taken_pieces = get_taken_pieces(self.piece_counts)
+        self.halfmove_clock = halfmove_clock
+
+    def restore(self, saved):
+        '''Puts the game in the state read back from its log by gamelog.read_log.
+
+        The history starts at the log's last snapshot, so neither versions nor
+        moves from before it can be gone back to.
+        '''
+        self.load(*saved['history'][-1].unpack(), saved['clocks'][-1], saved['fullmove_number'])
+        mover = saved['first_player']
+        self.game_moves = [] if mover == 'w' else [f"{saved['first_fullmove']}. ..."]
+        self.current_move_number = saved['first_fullmove']
+        for san in saved['moves']:
+            self.add_pgn_move(san, mover)
+            mover = 'b' if mover == 'w' else 'w'
+        self.moves = saved['moves']
+        self.history = saved['history']
+        self.clocks = saved['clocks']
+        self.first_ply = len(self.moves) - len(self.history) + 1
+        self.base_version = saved['base_version']
+        self.base_ply = saved['base_ply']
+        self.version = self.base_version + len(self.moves) - self.base_ply
+
+    def record_position(self):
+        '''Adds the current position and halfmove clock to the history.'''
+        self.history.append(PackedPosition.pack(self.board_state, self.player, self.last_move, self.pieces_moved))
+        self.clocks.append(self.halfmove_clock)
+
+    def add_move(self, san):
+        '''Records a move that has been played on the board, with player already the side to move next.
+
+        Adds the move to the PGN move list and the position to the history,
+        and moves on to the next version. Moves taken back can't be replayed
+        any more.
+        '''
+        self.add_pgn_move(san, 'b' if self.player == 'w' else 'w')
+        self.moves.append(san)
+        self.version += 1
+        self.record_position()
+        self.redo.clear()
+        if self.log:
+            self.log.move(self)
+
+    def add_pgn_move(self, san, mover):
+        '''Adds a move by mover ('w' or 'b') to the PGN move list.'''
+        if mover == 'w' or not self.game_moves:
+            self.game_moves.append(f"{self.current_move_number}. {san}")
+        else:
+            self.game_moves[-1] += f" {san}"
+            self.current_move_number += 1
+
+    def remove_pgn_move(self, mover):
+        '''Takes the last move, by mover, off the PGN move list.'''
+        if mover == 'w':
+            self.game_moves.pop()
+        else:
+            self.game_moves[-1] = self.game_moves[-1].rsplit(' ', 1)[0]
+            self.current_move_number -= 1
+
+    def go_to_ply(self, ply):
+        '''Takes back or replays moves until ply moves have been played since the start, returning False if it can't.
+
+        Each move is one step, popped from or pushed back onto the history,
+        and the position is then unpacked from the history in one go, so
+        nothing is replayed from the start. Moves can be replayed until
+        another one is played. Replayed moves are new versions as played
+        moves are; taking moves back is one new version, from which the count
+        starts again.
+        '''
+        from_ply = len(self.moves)
+        if ply < self.first_ply or ply > from_ply + len(self.redo):
+            return False
+        if ply == from_ply:
+            return True
+
+        while len(self.moves) > ply:
+            position = self.history.pop()
+            self.redo.append((position, self.clocks.pop(), self.moves.pop()))
+            self.remove_pgn_move('w' if position.player == 'b' else 'b')
+        while len(self.moves) < ply:
+            position, clock, san = self.redo.pop()
+            self.history.append(position)
+            self.clocks.append(clock)
+            self.moves.append(san)
+            self.add_pgn_move(san, 'w' if position.player == 'b' else 'b')
+        self.set_position(*self.history[-1].unpack(), self.clocks[-1])
+
+        if ply < from_ply:
+            self.version += 1
+            self.base_version = self.version
+            self.base_ply = ply
+        else:
+            self.version += ply - from_ply
+        if self.log:
+            self.log.jump(self, from_ply)
+        return True
+
+    def position_at(self, version):
+        '''Returns the packed position at a version of the game, or None if the game has been reset, loaded or taken back since.'''
+        if self.base_version <= version <= self.version:
+            return self.history[self.base_ply - self.first_ply + version - self.base_version]
+        return None
+
+    def moves_since(self, version):
+        '''Returns the SAN of the moves played since a version that position_at knows.'''
+        return self.moves[self.base_ply + version - self.base_version:]
+
+
+class MemoryGameStore:
+    '''Keeps games in memory by game ID, dropping games nobody has used for idle_timeout seconds.
+
+    Idle games are swept out at most once every sweep_interval seconds, as
+    part of looking a game up, so there is no background thread.
+    '''
+
+    def __init__(self, idle_timeout=3600, sweep_interval=60):
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.games = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self.games)
+
+    def create(self, game_id=None):
+        '''Starts a new game and returns it, with a random ID unless one is given.'''
+        game = self.new_game(game_id or uuid.uuid4().hex)
+        with self.lock:
+            self.games[game.game_id] = game
+        return game
+
+    def get(self, game_id):
+        '''Returns the game with the ID, or None if there is no such game or it has been evicted.'''
+        now = time.monotonic()
+        if now - self.last_sweep >= self.sweep_interval:
+            self.evict_idle(now)
+        game = self.games.get(game_id)
+        if game is not None:
+            game.last_access = now
+        return game
+
+    def get_or_create(self, game_id):
+        '''Returns the game with the ID, starting it if it doesn't exist.'''
+        game = self.get(game_id)
+        if game is None:
+            with self.lock:
+                game = self.games.get(game_id)
+                if game is None:
+                    game = self.games[game_id] = self.new_game(game_id)
+        return game
+
+    def new_game(self, game_id):
+        return Game(game_id)
+
+    def delete(self, game_id):
+        '''Removes a game, returning True if it existed.'''
+        with self.lock:
+            game = self.games.pop(game_id, None)
+        if game is None:
+            return False
+        game.events.close()
+        return True
+
+    def evict_idle(self, now=None):
+        '''Removes every game idle for longer than idle_timeout and returns how many were removed.'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.last_sweep = now
+            idle = [game_id for game_id, game in self.games.items() if now - game.last_access > self.idle_timeout]
+            for game_id in idle:
+                self.games.pop(game_id).events.close()
+        return len(idle)
+
+
+# Game IDs that can be used as file names
+game_id_pattern = re.compile(r'[\w-]+')
+
+
+class FileGameStore(MemoryGameStore):
+    '''Keeps games in memory as MemoryGameStore does, and logs each one to a file in directory (see gamelog.py).
+
+    restore_all reads every game back, e.g. at startup. A game evicted for
+    being idle stays on disk and is read back the next time it is asked
+    for; deleting a game deletes its log. With sync, each move is on disk
+    before the request that played it returns.
+    '''
+
+    def __init__(self, directory, idle_timeout=3600, sweep_interval=60, sync=False):
+        super().__init__(idle_timeout, sweep_interval)
+        self.directory = directory
+        self.sync = sync
+        os.makedirs(directory, exist_ok=True)
+
+    def log_path(self, game_id):
+        if not game_id_pattern.fullmatch(game_id):
+            raise ValueError(f"Game ID {game_id!r} can't be used as a file name")
+        return os.path.join(self.directory, game_id + '.log')
+
+    def new_game(self, game_id):
+        return Game(game_id, GameLog(self.log_path(game_id), self.sync))
+
+    def restore(self, game_id):
+        '''Reads a game back from its log and returns it, or None if it has no log.'''
+        path = self.log_path(game_id)
+        try:
+            saved = read_log(path)
+        except FileNotFoundError:
+            return None
+        if saved is None:
+            return None
+        game = Game(game_id)
+        game.restore(saved)
+        game.log = GameLog(path, self.sync)
+        game.log.moves_since_snapshot = len(game.history) - 1
+        return game
+
+    def restore_all(self):
+        '''Reads back every game logged in the directory that isn't in memory already and returns how many were.'''
+        restored = 0
+        for name in os.listdir(self.directory):
+            game_id, extension = os.path.splitext(name)
+            if extension != '.log' or not game_id_pattern.fullmatch(game_id) or game_id in self.games:
+                continue
+            game = self.restore(game_id)
+            if game is not None:
+                with self.lock:
+                    self.games.setdefault(game_id, game)
+                restored += 1
+        return restored
+
+    def get(self, game_id):
+        game = super().get(game_id)
+        if game is None and game_id_pattern.fullmatch(game_id):
+            with self.lock:
+                game = self.games.get(game_id)
+                if game is None:
+                    game = self.restore(game_id)
+                    if game is not None:
+                        self.games[game_id] = game
+        return game
+
+    def delete(self, game_id):
+        deleted = super().delete(game_id)
+        if not game_id_pattern.fullmatch(game_id):
+            return deleted
+        path = self.log_path(game_id)
+        if os.path.exists(path):
+            os.remove(path)
+            deleted = True
+        return deleted
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+import engine
+from fen import START_FEN, parse_fen
+from perft import test_positions
+
+
+@pytest.mark.parametrize('fen', [fen for name, fen, counts in test_positions])
+def test_legal_moves_of_another_board(fen):
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position([row[:] for row in board_state], player, last_move, dict(moved))
+    loaded = app.generate_legal_moves(app.current_board_state, player, last_move)
+
+    # Another board gets the same moves without the game state's king squares or castling flags
+    app.load_position(parse_fen(START_FEN)[0])
+    state = app.save_state()
+    assert sorted(app.generate_legal_moves(board_state, player, last_move, moved), key=str) == sorted(loaded, key=str)
+    assert app.save_state() == state
+    assert board_state == parse_fen(fen)[0]
+
+
+def test_castling_needs_the_flags_of_another_board():
+    board_state, player, last_move, moved = parse_fen('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1')[:4]
+    app.load_position(parse_fen(START_FEN)[0])
+    castles = [move for move in app.generate_legal_moves(board_state, player, last_move, moved)
+               if move[0] == (7, 4) and move[1] in ((7, 2), (7, 6))]
+    assert len(castles) == 2
+    assert not [move for move in app.generate_legal_moves(board_state, player, last_move)
+                if move[0] == (7, 4) and move[1] in ((7, 2), (7, 6))]
+
+
+def test_search_position_keeps_the_game_state():
+    board_state, player, last_move, moved, halfmove, fullmove = parse_fen(
+        'r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3')
+    app.load_position(board_state, player, last_move, moved, halfmove, fullmove)
+    state = app.save_state()
+    key, material, counts, kings = app.zobrist_key, app.material_score, dict(app.piece_counts), dict(app.king_positions)
+
+    other = parse_fen('4k3/8/8/8/8/8/8/R3K3 w Q - 7 40')
+    move, info = engine.search_position(*other[:4], node_limit=2000)
+    assert move is not None
+    assert app.save_state() == state and app.current_board_state is board_state
+    assert (app.zobrist_key, app.material_score, app.piece_counts, app.king_positions) == (key, material, counts, kings)
+    assert (app.halfmove_clock, app.fullmove_number) == (2, 3)
+
+
+def test_search_position_in_a_new_process():
+    # As the engine processes of asgi.py run it, with app.py's game state as it is on import
+    script = ("import engine, fen\n"
+              "print(engine.search_position(*fen.parse_fen('4k3/8/8/8/8/8/8/R3K3 w Q - 0 1')[:4], node_limit=500))")
+    result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,30 @@
+import app
+import engine
+from fen import parse_fen
+
+
+def quiescence_score(fen):
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    moves = app.generate_legal_moves(board_state, player, last_move)
+    return engine.Search(board_state).quiescence(-engine.INFINITY, engine.INFINITY, player, last_move, 0, moves)
+
+
+def evaluate_after(fen, move):
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    app.make_move(board_state, *move)
+    return app.evaluate() if player == 'w' else -app.evaluate()
+
+
+def test_quiescence_plays_en_passant():
+    # exd6 wins a pawn that nothing can take back
+    fen = '4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1'
+    assert quiescence_score(fen) == evaluate_after(fen, ((3, 4), (2, 3)))
+    fen = '4k3/8/8/8/3Pp3/8/8/4K3 b - d3 0 1'
+    assert quiescence_score(fen) == evaluate_after(fen, ((4, 4), (5, 3)))
+
+
+def test_quiescence_plays_captures():
+    fen = '4k3/8/8/3p4/4P3/8/8/4K3 w - - 0 1'
+    assert quiescence_score(fen) == evaluate_after(fen, ((4, 4), (3, 3)))
@@ -0,0 +1,79 @@
+import pytest
+
+from fen import START_FEN, parse_fen, to_fen
+
+
+@pytest.mark.parametrize('fen', [
+    START_FEN,
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    'rnbqkbnr/ppp1pppp/8/3pP3/8/8/PPPP1PPP/RNBQKBNR w Kq d6 0 3',
+    'rnbqkbnr/pppp1ppp/8/8/3Pp3/8/PPP1PPPP/RNBQKBNR b KQkq d3 0 3',
+    '4k3/8/8/8/8/8/8/R3K3 b Q - 12 40',
+])
+def test_round_trip(fen):
+    assert to_fen(*parse_fen(fen)) == fen
+
+
+def test_start_position():
+    board_state, player, last_move, moved, halfmove_clock, fullmove_number = parse_fen(START_FEN)
+    assert board_state[0] == ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br']
+    assert board_state[6] == ['wp'] * 8
+    assert board_state[4] == [None] * 8
+    assert (player, last_move, halfmove_clock, fullmove_number) == ('w', None, 0, 1)
+
+
+def test_en_passant_square_becomes_last_move():
+    last_move = parse_fen('rnbqkbnr/pppp1ppp/8/8/3Pp3/8/PPP1PPPP/RNBQKBNR b KQkq d3 0 3')[2]
+    assert last_move == {'piece_code': 'wp', 'from_position': (6, 3), 'to_position': (4, 3)}
+
+
+def test_move_counters_default():
+    assert parse_fen('4k3/8/8/8/8/8/8/4K3 w - -')[4:] == (0, 1)
+
+
+@pytest.mark.parametrize('fen', [
+    '',
+    '4k3/8/8/8/8/8/8/4K3 w -',
+    '4k3/8/8/8/8/8/4K3 w - - 0 1',
+    '4k3/8/8/8/8/8/8/4K2 w - - 0 1',
+    '4k3/8/8/8/8/8/8/4K4 w - - 0 1',
+    '4k3/8/8/8/8/8/8/4X3 w - - 0 1',
+    '4k3/8/8/8/8/8/8/4K3 x - - 0 1',
+    '4k3/8/8/8/8/8/8/4K3 w X - 0 1',
+    '4k3/8/8/8/8/8/8/4K3 w - e4 0 1',
+    '4k3/8/8/8/8/8/8/4K3 w - e3 0 1',
+    # En passant squares with no pawn that has just moved over them
+    '4k3/8/8/3P4/8/8/8/4K3 w - e6 0 1',
+    '4k3/8/8/3PP3/8/8/8/4K3 w - e6 0 1',
+    '4k3/8/4p3/3Pp3/8/8/8/4K3 w - e6 0 1',
+    '4k3/8/8/8/3p4/8/8/4K3 b - e3 0 1',
+    '4k3/8/8/8/8/8/8/4K3 w - - x 1',
+])
+def test_malformed(fen):
+    with pytest.raises(ValueError):
+        parse_fen(fen)
+
+
+@pytest.mark.parametrize('fen', [
+    '8/8/8/8/8/8/8/4K3 w - - 0 1',
+    '4k3/8/8/8/8/8/8/8 w - - 0 1',
+    '4k3/8/8/8/8/8/8/8 b - - 0 1',
+    '4k3/8/8/8/8/8/8/K3K3 w - - 0 1',
+    'k3k3/8/8/8/8/8/8/4K3 b - - 0 1',
+])
+def test_one_king_each(fen):
+    with pytest.raises(ValueError, match='kings'):
+        parse_fen(fen)
+
+
+def test_side_not_to_move_in_check():
+    with pytest.raises(ValueError, match='in check'):
+        parse_fen('4k3/8/8/8/8/8/8/4RK2 w - - 0 1')
+    # The side to move may be in check
+    assert parse_fen('4k3/8/8/8/8/8/8/4RK2 b - - 0 1')[1] == 'b'
+
+
+def test_pawn_on_back_rank():
+    with pytest.raises(ValueError, match='rank'):
+        parse_fen('P3k3/8/8/8/8/8/8/4K3 w - - 0 1')
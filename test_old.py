@@ -0,0 +1,161 @@
+import threading
+
+import pytest
+
+pytest.importorskip('flask')
+
+import old
+from fen import parse_fen
+from sessions import MemoryGameStore
+
+
+def new_game(fen):
+    game = MemoryGameStore().create()
+    game.load(*parse_fen(fen))
+    return game
+
+
+def play(game, *moves):
+    '''Plays moves given as e.g. 'g1f3' on the game and returns the last response.'''
+    for move in moves:
+        response, status = old.play_move(game, {'from': move[:2], 'to': move[2:4]})
+        assert status == 200
+    return response
+
+
+@pytest.mark.parametrize('fen, moves, san', [
+    ('4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1', ['b1d2'], 'Nbd2'),
+    ('4k3/8/8/1N6/8/1N6/8/4K3 w - - 0 1', ['b5d4'], 'N5d4'),
+    ('6k1/8/8/8/Q6Q/8/8/Q3K3 w - - 0 1', ['a4d4'], 'Qa4d4'),
+    ('4k3/4r3/8/8/8/8/4R3/R3K3 w - - 0 1', ['a1a2'], 'Ra2'),
+    ('rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3', ['e5f6'], 'exf6'),
+    ('4k3/8/8/8/4N3/8/8/4R1K1 w - - 0 1', ['e4c5'], 'Nc5+'),
+    ('6k1/5ppp/8/8/8/8/8/R3K3 w - - 0 1', ['a1a8'], 'Ra8#'),
+    ('7k/8/6Q1/8/8/8/8/4K3 w - - 0 1', ['g6f7'], 'Qf7'),
+    ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', ['f2f3', 'e7e5', 'g2g4', 'd8h4'], 'Qh4#'),
+    ('5k2/8/8/8/8/8/8/4K2R w K - 0 1', ['e1g1'], 'O-O+'),
+    ('r3k3/8/8/8/8/8/8/4K3 b q - 0 1', ['e8c8'], 'O-O-O'),
+])
+def test_san(fen, moves, san):
+    game = new_game(fen)
+    assert play(game, *moves)['success']
+    assert game.moves[-1] == san
+
+
+def test_san_does_not_wait_for_the_engine():
+    game = new_game('4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1')
+    with old.engine_lock:
+        player = threading.Thread(target=play, args=(game, 'b1d2'), daemon=True)
+        player.start()
+        player.join(5)
+        assert not player.is_alive()
+    assert game.moves == ['Nbd2']
+
+
+@pytest.mark.parametrize('fen, move', [
+    # No rook, with and without the right to castle, a rook that has moved, and a king in check
+    ('4k3/8/8/8/8/8/8/4K3 w - - 0 1', 'e1g1'),
+    ('4k3/8/8/8/8/8/8/4K3 w - - 0 1', 'e1c1'),
+    ('4k3/8/8/8/8/8/8/4K3 w K - 0 1', 'e1g1'),
+    ('4k3/8/8/8/8/8/8/4K3 w Q - 0 1', 'e1c1'),
+    ('4k3/8/8/8/8/8/8/4K2R w - - 0 1', 'e1g1'),
+    ('4k3/8/8/8/8/8/8/4K1R1 w K - 0 1', 'e1g1'),
+    ('4k3/4r3/8/8/8/8/8/4K2R w K - 0 1', 'e1g1'),
+])
+def test_castling_refused(fen, move):
+    game = new_game(fen)
+    board_state = [row[:] for row in game.board_state]
+    for response, status in (old.play_move(game, {'from': move[:2], 'to': move[2:]}),
+                             old.play_castle(game, {'from': move[:2], 'to': move[2:]})):
+        assert status == 200
+        assert not response['success']
+    assert game.board_state == board_state
+    assert game.moves == []
+
+
+def test_castle():
+    game = new_game('r3k3/8/8/8/8/8/8/4K2R w Kq - 0 1')
+    response, status = old.play_castle(game, {'from': 'e1', 'to': 'g1'})
+    assert response['success']
+    response, status = old.play_castle(game, {'from': 'e8', 'to': 'c8'})
+    assert response['success']
+    assert game.board_state[7][5:7] == ['wr', 'wk'] and game.board_state[0][2:4] == ['bk', 'br']
+    assert game.moves == ['O-O', 'O-O-O'] and game.player == 'w'
+
+
+@pytest.mark.parametrize('fen, move, promotion, piece, san', [
+    ('4k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7a8', None, 'wq', 'a8=Q+'),
+    ('4k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7a8', 'r', 'wr', 'a8=R+'),
+    ('4k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7a8', 'B', 'wb', 'a8=B'),
+    ('1n2k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7b8', 'n', 'wn', 'axb8=N'),
+    ('4k3/8/8/8/8/8/6p1/4K2R b - - 0 1', 'g2h1', 'q', 'bq', 'gxh1=Q+'),
+    ('6k1/8/8/8/8/8/1p4PP/7K b - - 0 1', 'b2b1', None, 'bq', 'b1=Q#'),
+])
+def test_promotion(fen, move, promotion, piece, san):
+    game = new_game(fen)
+    response, status = old.play_move(game, {'from': move[:2], 'to': move[2:], 'promotion': promotion})
+    assert response['success']
+    row, col = old.convert_position(move[2:])
+    assert game.board_state[row][col] == piece
+    assert game.moves == [san]
+    # The game's counts and key are those of the position set up afresh
+    position = new_game(old.to_fen(game.board_state, game.player, game.last_move, game.pieces_moved))
+    assert (game.piece_counts, game.material_score, game.zobrist_key) == \
+        (position.piece_counts, position.material_score, position.zobrist_key)
+
+
+def test_promotion_refused():
+    game = new_game('4k3/P7/8/8/8/8/8/4K3 w - - 0 1')
+    response, status = old.play_move(game, {'from': 'a7', 'to': 'a8', 'promotion': 'k'})
+    assert not response['success']
+    assert game.board_state[1][0] == 'wp' and game.moves == []
+
+
+@pytest.mark.parametrize('fen, moves, after', [
+    # A rook captured on its starting square takes its side's right with it
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', ['h1h8'], 'r3k2R/8/8/8/8/8/8/R3K3 b Qq - 0 1'),
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', ['a1a8'], 'R3k2r/8/8/8/8/8/8/4K2R b Kk - 0 1'),
+    # A rook or king that has left its square doesn't get the right back by returning
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', ['a1a2', 'a8a7', 'a2a1', 'a7a8'], 'r3k2r/8/8/8/8/8/8/R3K2R w Kk - 4 3'),
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', ['e1e2'], 'r3k2r/8/8/8/8/8/4K3/R6R b kq - 1 1'),
+])
+def test_castling_rights(fen, moves, after):
+    game = new_game(fen)
+    play(game, *moves)
+    assert old.to_fen(game.board_state, game.player, game.last_move, game.pieces_moved,
+                      game.halfmove_clock, game.current_move_number) == after
+    # The key and packed position are those of the position set up afresh
+    position = new_game(after)
+    assert (game.zobrist_key, game.history[-1]) == (position.zobrist_key, position.history[-1])
+
+
+@pytest.mark.parametrize('fen, move', [
+    # A pawn move that leaves the king in check, a pinned pawn, and en passant uncovering a rook
+    ('4k3/8/8/8/8/8/3P4/r3K3 w - - 0 1', 'd2d3'),
+    ('4k3/8/8/8/1b6/8/3P4/4K3 w - - 0 1', 'd2d3'),
+    ('4k3/8/8/8/1b6/8/3P4/4K3 w - - 0 1', 'd2d4'),
+    ('8/8/8/K2pP2r/8/8/8/7k w - d6 0 1', 'e5d6'),
+    # A pawn capturing straight ahead or onto an empty square
+    ('4k3/8/8/8/4p3/4P3/8/4K3 w - - 0 1', 'e3e4'),
+    ('4k3/8/8/8/8/4P3/8/4K3 w - - 0 1', 'e3f4'),
+])
+def test_illegal_pawn_move(fen, move):
+    game = new_game(fen)
+    board_state = [row[:] for row in game.board_state]
+    response, status = old.play_move(game, {'from': move[:2], 'to': move[2:]})
+    assert not response['success']
+    assert game.board_state == board_state and game.moves == []
+
+
+def test_out_of_turn():
+    game = new_game('r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1')
+    play(game, 'e2e4')
+    board_state = [row[:] for row in game.board_state]
+    for response, status in (old.play_move(game, {'from': 'd2', 'to': 'd4'}),
+                             old.play_move(game, {'from': 'e4', 'to': 'e5'}),
+                             old.play_castle(game, {'from': 'e1', 'to': 'g1'})):
+        assert status == 400
+        assert not response['success']
+    assert game.board_state == board_state
+    assert game.moves == ['e4'] and game.player == 'b'
+    assert play(game, 'e7e5')['gameMoves'] == '1. e4 e5'
@@ -0,0 +1,109 @@
+import pytest
+
+import app
+from fen import START_FEN, parse_fen
+from pgn import game_to_san, move_to_san, parse_san, replay_game
+
+
+def san_of(fen, move):
+    '''Returns the SAN that move_to_san writes for a move given as e.g. 'g1f3' or 'a7a8n' in a FEN's position.'''
+    board_state, player, last_move, moved = parse_fen(fen)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    legal_moves = app.generate_legal_moves(board_state, player, last_move)
+    from_position = (8 - int(move[1]), ord(move[0]) - ord('a'))
+    to_position = (8 - int(move[3]), ord(move[2]) - ord('a'))
+    promotion = move[4] if len(move) > 4 else ('q' if board_state[from_position[0]][from_position[1]][1] == 'p'
+                                                 and to_position[0] in (0, 7) else None)
+    return move_to_san((from_position, to_position, promotion), board_state, player, legal_moves)
+
+
+@pytest.mark.parametrize('fen, move, san', [
+    (START_FEN, 'g1f3', 'Nf3'),
+    (START_FEN, 'e2e4', 'e4'),
+    ('rnbqkbnr/ppp1pppp/8/3p4/4P3/8/PPPP1PPP/RNBQKBNR w KQkq d6 0 2', 'e4d5', 'exd5'),
+    ('rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3', 'e5f6', 'exf6'),
+])
+def test_plain_moves(fen, move, san):
+    assert san_of(fen, move) == san
+
+
+@pytest.mark.parametrize('fen, move, san', [
+    # Knights on the same rank, then on the same file, then on neither
+    ('4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1', 'b1d2', 'Nbd2'),
+    ('4k3/8/8/1N6/8/1N6/8/4K3 w - - 0 1', 'b5d4', 'N5d4'),
+    ('4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1', 'f1g3', 'Ng3'),
+    # Three queens, two sharing the file and two the rank of the one moving
+    ('6k1/8/8/8/Q6Q/8/8/Q3K3 w - - 0 1', 'a4d4', 'Qa4d4'),
+    # Rooks that both reach the square, one of them pinned
+    ('4k3/8/8/8/8/8/K7/R6R w - - 0 1', 'a1d1', 'Rad1'),
+    ('4k3/4r3/8/8/8/8/4R3/R3K3 w - - 0 1', 'a1a2', 'Ra2'),
+    ('4k3/8/8/8/8/8/8/R3K2R w - - 0 1', 'h1h8', 'Rh8+'),
+    ('4k3/8/8/8/8/8/p7/R3K2R w - - 0 1', 'a1a2', 'Rxa2'),
+])
+def test_disambiguation(fen, move, san):
+    assert san_of(fen, move) == san
+
+
+@pytest.mark.parametrize('fen, move, san', [
+    ('4k3/8/8/8/8/8/8/4K2R w K - 0 1', 'e1g1', 'O-O'),
+    ('r3k3/8/8/8/8/8/8/4K3 b q - 0 1', 'e8c8', 'O-O-O'),
+    ('5k2/8/8/8/8/8/8/4K2R w K - 0 1', 'e1g1', 'O-O+'),
+    ('3k4/8/8/8/8/8/8/R3K3 w Q - 0 1', 'e1c1', 'O-O-O+'),
+])
+def test_castling(fen, move, san):
+    assert san_of(fen, move) == san
+
+
+@pytest.mark.parametrize('fen, move, san', [
+    ('4k3/8/8/8/8/8/8/R3K3 w - - 0 1', 'a1a8', 'Ra8+'),
+    ('6k1/5ppp/8/8/8/8/8/R3K3 w - - 0 1', 'a1a8', 'Ra8#'),
+    ('rnbqkbnr/pppp1ppp/8/4p3/6P1/5P2/PPPPP2P/RNBQKBNR b KQkq g3 0 2', 'd8h4', 'Qh4#'),
+    # A discovered check and a double check
+    ('4k3/8/8/8/4N3/8/8/4R1K1 w - - 0 1', 'e4c5', 'Nc5+'),
+    ('4k3/8/8/8/4N3/8/8/4R1K1 w - - 0 1', 'e4f6', 'Nf6+'),
+    # Stalemate is not marked
+    ('7k/8/6Q1/8/8/8/8/4K3 w - - 0 1', 'g6f7', 'Qf7'),
+])
+def test_check_and_mate(fen, move, san):
+    assert san_of(fen, move) == san
+
+
+@pytest.mark.parametrize('fen, move, san', [
+    ('4k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7a8', 'a8=Q+'),
+    ('4k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7a8r', 'a8=R+'),
+    ('4k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7a8b', 'a8=B'),
+    ('1n2k3/P7/8/8/8/8/8/4K3 w - - 0 1', 'a7b8n', 'axb8=N'),
+    ('4k3/8/8/8/8/8/6p1/4K2R b - - 0 1', 'g2h1n', 'gxh1=N'),
+    ('4k3/8/8/8/8/8/6p1/4K2R b - - 0 1', 'g2h1q', 'gxh1=Q+'),
+])
+def test_promotion(fen, move, san):
+    assert san_of(fen, move) == san
+
+
+def test_game_to_san_matches_movetext():
+    movetext = '1. e4 e5 2. Nf3 Nc6 3. Bc4 Nf6 4. Ng5 d5 5. exd5 Na5 6. Bb5+ c6 7. dxc6 bxc6 8. Qf3 Rb8 9. Bd3 h6 ' \
+               '10. Ne4 Nxe4 11. Bxe4 f5 12. Bd3 e4 13. Qe2 Qh4 14. g3 Qe7 15. O-O Nc4 16. b3 Ne5 17. Bb2 Nf3+ ' \
+               '18. Kh1 Qf7 19. Bxg7 Bxg7 20. Qxf3 exf3'
+    moves = replay_game({}, movetext)
+    board_state, player, last_move, moved = parse_fen(START_FEN)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    assert ' '.join(game_to_san(board_state, player, last_move, moves)) == \
+        ' '.join(token for token in movetext.split() if not token.endswith('.'))
+
+
+@pytest.mark.parametrize('san', ['Nf3', 'Nh3', 'e4', 'a3'])
+def test_parse_san_round_trip(san):
+    board_state, player, last_move, moved = parse_fen(START_FEN)[:4]
+    app.load_position(board_state, player, last_move, moved)
+    legal_moves = app.generate_legal_moves(board_state, player, last_move)
+    assert move_to_san(parse_san(san, board_state, player, legal_moves), board_state, player, legal_moves) == san
+
+
+def test_parse_san_rejects():
+    board_state, player, last_move, moved = parse_fen('4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1')[:4]
+    app.load_position(board_state, player, last_move, moved)
+    legal_moves = app.generate_legal_moves(board_state, player, last_move)
+    with pytest.raises(ValueError, match='Ambiguous'):
+        parse_san('Nd2', board_state, player, legal_moves)
+    with pytest.raises(ValueError, match='Illegal'):
+        parse_san('Nd4', board_state, player, legal_moves)